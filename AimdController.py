@@ -0,0 +1,191 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Adaptive limit on the number of queries in flight, for closed-loop
+scenarios run with --adaptive.
+
+Every attempt of a sample takes a slot before it is submitted and gives it
+back with its outcome. The limit follows additive-increase/multiplicative-
+decrease, as TCP congestion control does: every successful attempt adds
+1 / limit to it (about one more query in flight per round of queries), while a
+quota error, or a response time above the latency target, multiplies it by the
+decrease factor. Only attempts started after the last decrease can decrease it
+again, so that a burst of errors caused by the previous limit counts once.
+
+Threads wait for a slot on a condition, and coroutines on a future of their
+event loop, which release() resolves once a slot is free. """
+
+import time
+import asyncio
+import threading
+from collections import deque
+
+class AimdController(object):
+    def __init__(self,
+                 maximum,
+                 initial=None,
+                 minimum=1,
+                 increase=1.0,
+                 decrease=0.5,
+                 latency_target=None):
+
+        self._maximum = maximum
+        self._minimum = minimum
+        self._increase = increase
+        self._decrease = decrease
+        self._latency_target = latency_target
+
+        self._limit = float(min(initial or maximum, maximum))
+        self._in_flight = 0
+        self._decreases = 0
+        self._lowest = self._limit
+        self._condition = threading.Condition()
+
+        # (event loop, future) of every coroutine waiting for a slot
+        self._waiters = deque()
+
+        self._start = time.perf_counter()
+        self._last_change = self._start
+        self._last_decrease = None
+        self._limit_seconds = 0.0
+
+    def __repr__(self):
+        return 'AimdController(limit = {:0.1f}, maximum = {}, latency_target = {})'.format(
+            self._limit,
+            self._maximum,
+            self._latency_target)
+
+    @classmethod
+    def from_options(cls, options, maximum):
+        return cls(maximum=maximum,
+                   initial=options.get('adaptive_initial'),
+                   latency_target=options.get('adaptive_latency'))
+
+    def acquire(self):
+        """ Wait for a slot, return the time it was taken """
+        with self._condition:
+            self._condition.wait_for(self._available)
+            return self._take()
+
+    def try_acquire(self):
+        """ Take a slot if one is free, return the time it was taken or None """
+        with self._condition:
+            if not self._available():
+                return None
+
+            return self._take()
+
+    async def acquire_async(self):
+        """ Coroutine equivalent of acquire(): wait for release() to resolve a
+        future rather than blocking the event loop """
+        loop = asyncio.get_event_loop()
+
+        while True:
+            with self._condition:
+                if self._available():
+                    return self._take()
+
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # A cancelled coroutine passes on a slot it was woken for
+                with self._condition:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+                    else:
+                        self._wake()
+                raise
+
+    def release(self, started, error_class=None, response_time=None):
+        """ Give back the slot taken at started, with the outcome of the
+        attempt that used it """
+
+        with self._condition:
+            self._in_flight -= 1
+
+            congested = (error_class == 'quota'
+                         or (error_class is None
+                             and self._latency_target is not None
+                             and response_time > self._latency_target))
+
+            if congested:
+                if self._last_decrease is None or started > self._last_decrease:
+                    self._set_limit(max(self._minimum, self._limit * self._decrease))
+                    self._last_decrease = time.perf_counter()
+                    self._decreases += 1
+            elif error_class is None:
+                self._set_limit(min(self._maximum,
+                                    self._limit + self._increase / self._limit))
+
+            self._condition.notify_all()
+            self._wake()
+
+    def _available(self):
+        return self._in_flight < max(self._minimum, int(self._limit))
+
+    def _wake(self):
+        """ Resolve the futures of as many waiting coroutines as there are
+        free slots, in their own event loops """
+        free = max(self._minimum, int(self._limit)) - self._in_flight
+        while free > 0 and self._waiters:
+            loop, waiter = self._waiters.popleft()
+            loop.call_soon_threadsafe(_resolve, waiter)
+            free -= 1
+
+    def _take(self):
+        self._in_flight += 1
+        return time.perf_counter()
+
+    def _set_limit(self, limit):
+        now = time.perf_counter()
+        self._limit_seconds += self._limit * (now - self._last_change)
+        self._last_change = now
+
+        self._limit = limit
+        self._lowest = min(self._lowest, limit)
+
+    def report(self):
+        print(('-- Adaptive concurrency: limit = {:0.1f} (mean = {:0.1f}, '
+               'lowest = {:0.1f}, maximum = {}), decreases = {}')
+              .format(self._limit,
+                      self.mean_limit(),
+                      self._lowest,
+                      self._maximum,
+                      self._decreases))
+
+    def mean_limit(self):
+        """ Time weighted mean of the limit since the controller started """
+        with self._condition:
+            now = time.perf_counter()
+            elapsed = now - self._start
+            if elapsed <= 0:
+                return self._limit
+
+            return (self._limit_seconds
+                    + self._limit * (now - self._last_change)) / elapsed
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @property
+    def decreases(self):
+        return self._decreases
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,64 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Scenario variant that runs its Trials as coroutines on a single event loop
+rather than one OS thread per Trial """
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from Scenario import Scenario
+
+class AsyncScenario(Scenario):
+    def run(self):
+        # Each scenario gets a fresh event loop, so that scenarios remain
+        # independent of each other, as they are with the threaded engine
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            return super().run()
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def _execute(self, trials):
+        """ Run all trials concurrently on the event loop. Only the blocking
+        BigQuery API calls (job insert, status poll, result) are executed on a
+        small pool of I/O threads, so the number of in-flight queries is not
+        bounded by the number of OS threads, and the shared client pool only
+        needs as many connections as there are I/O threads """
+
+        io_threads = self._options['io_threads']
+
+        with ThreadPoolExecutor(max_workers=io_threads) as executor:
+            return asyncio.get_event_loop().run_until_complete(
+                self._gather(trials, executor))
+
+    async def _gather(self, trials, executor):
+        response_results = {}
+
+        outcomes = await asyncio.gather(
+            *[trial.run_async(executor=executor,
+                              poll_interval=self._options['poll_interval'])
+              for trial in trials],
+            return_exceptions=True)
+
+        for trial, outcome in zip(trials, outcomes):
+            query_name = trial.query.name
+            if isinstance(outcome, Exception):
+                print('Query "{}" generated exception: {}'
+                      .format(query_name, repr(outcome)))
+            else:
+                self._add_result(response_results, trial)
+
+        return response_results
@@ -0,0 +1,176 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Backends that queries are run against. A backend builds the job
+configuration of a Query, a standalone client for a Trial, and the client pool
+shared by the Scenarios of an Experiment:
+
+    bigquery    the BigQuery API
+    simulated   a local simulation of BigQuery (see SimulatedClient), with
+                its model read from the --simulation file
+    stub        jobs that complete after a fixed --stub-latency, to measure
+                the overhead of the harness itself
+
+Only the bigquery backend needs the google-cloud-bigquery client library,
+which it imports when it is first used, so that the simulated and stub
+backends run without it. """
+
+import os
+import json
+import yaml
+from SimulatedClient import (SimulatedClient, SimulatedClientPool,
+                             SimulatedJobConfig, StubClient)
+
+BACKENDS = ('bigquery', 'simulated', 'stub')
+
+class BigQueryBackend(object):
+    def __init__(self,
+                 options):
+
+        self._options = options
+
+    def __repr__(self):
+        return 'BigQueryBackend()'
+
+    def job_config(self, query, binding=None):
+        from google.cloud import bigquery
+
+        # BQ client behavior now dictates a unique QueryJobConfig() per query
+        job_config = bigquery.QueryJobConfig()
+
+        job_config.use_query_cache = query.options['use_cache']
+
+        if binding is not None and binding.parameters:
+            job_config.query_parameters = [
+                bigquery.ScalarQueryParameter(name, parameter_type, value)
+                for name, parameter_type, value in binding.parameters]
+
+        return job_config
+
+    def client(self):
+        from google.cloud import bigquery
+        return bigquery.Client()
+
+    def client_pool(self, size):
+        from ClientPool import ClientPool
+        return ClientPool(size=size)
+
+    def client_pools(self, sizes, shards):
+        """ {shard name: ClientPool} of every shard, of its size in sizes (see
+        Shards.split) """
+        from ClientPool import ClientPool
+        return {shard.name: ClientPool(size=sizes[shard.name],
+                                       project=shard.project,
+                                       credentials_file=shard.credentials,
+                                       location=shard.location)
+                for shard in shards}
+
+class SimulatedBackend(object):
+    def __init__(self,
+                 options):
+
+        self._options = options
+        self._config = {}
+
+        # Workers are sent the model itself rather than the name of its file
+        if options.get('simulation_model') is not None:
+            self._config = dict(options['simulation_model'])
+        elif options.get('simulation_file'):
+            self._config = load_simulation(options['simulation_file'])
+
+        # The experiment seed makes simulations reproducible too, unless the
+        # simulation sets its own
+        if options.get('seed') is not None:
+            self._config.setdefault('seed', options['seed'])
+
+    def __repr__(self):
+        return 'SimulatedBackend(config = {})'.format(self._config)
+
+    def job_config(self, query, binding=None):
+        # Queries describe their simulated work in their 'simulation' option
+        return SimulatedJobConfig(use_query_cache=query.options['use_cache'],
+                                  profile=query.options.get('simulation'),
+                                  query_parameters=(binding.parameters
+                                                    if binding is not None else ()))
+
+    def client(self):
+        return SimulatedClient(config=self._config)
+
+    def client_pool(self, size):
+        return SimulatedClientPool(size=size, client=self.client())
+
+    def client_pools(self, sizes, shards):
+        # Projects share a reservation, so shards share the simulated slots,
+        # and a single pool of all their connections
+        pool = self.client_pool(sum(sizes.values()))
+        return {shard.name: pool for shard in shards}
+
+class StubBackend(object):
+    def __init__(self,
+                 options):
+
+        self._latency = options.get('stub_latency', 0.0)
+
+    def __repr__(self):
+        return 'StubBackend(latency = {})'.format(self._latency)
+
+    def job_config(self, query, binding=None):
+        return SimulatedJobConfig(use_query_cache=query.options['use_cache'],
+                                  query_parameters=(binding.parameters
+                                                    if binding is not None else ()))
+
+    def client(self):
+        return StubClient(latency=self._latency)
+
+    def client_pool(self, size):
+        return SimulatedClientPool(size=size, client=self.client())
+
+    def client_pools(self, sizes, shards):
+        pool = self.client_pool(sum(sizes.values()))
+        return {shard.name: pool for shard in shards}
+
+def load_simulation(simulation_file):
+    """ Read a simulation model from a JSON or YAML file """
+
+    _, extension = os.path.splitext(simulation_file)
+
+    with open(simulation_file) as f:
+        if extension in ['.yaml', '.yml']:
+            return yaml.safe_load(f)
+
+        return json.load(f)
+
+# Backends are stateless apart from their configuration, so a single instance
+# serves every Query of a given configuration
+_backends = {}
+
+def get_backend(options):
+    name = options.get('backend', 'bigquery')
+    key = (name,
+           options.get('simulation_file'),
+           json.dumps(options.get('simulation_model'), sort_keys=True),
+           options.get('seed'),
+           options.get('stub_latency'))
+
+    if key not in _backends:
+        if name == 'bigquery':
+            _backends[key] = BigQueryBackend(options)
+        elif name == 'simulated':
+            _backends[key] = SimulatedBackend(options)
+        elif name == 'stub':
+            _backends[key] = StubBackend(options)
+        else:
+            raise ValueError('Unknown backend: {}'.format(name))
+
+    return _backends[key]
@@ -0,0 +1,169 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Shared BigQuery client backed by a single, bounded and instrumented HTTP
+connection pool. One pool is created per Experiment and reused by every Trial
+of every Scenario, so credential refreshes and TLS handshakes are paid once
+rather than inside the measured latencies """
+
+import time
+import threading
+from collections import Counter
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2 import service_account
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+class PoolStats(object):
+    """ Thread-safe counters for connection pool activity """
+
+    FIELDS = ['requests', 'opened', 'reused', 'waits', 'wait_seconds']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+
+        counters['reused'] = counters.get('requests', 0) - counters.get('opened', 0)
+        return {field: counters.get(field, 0) for field in self.FIELDS}
+
+def _instrumented(pool_class, stats):
+    """ Return a subclass of a urllib3 connection pool that reports to stats """
+
+    def _new_conn(self):
+        stats.increment('opened')
+        return pool_class._new_conn(self)
+
+    def _get_conn(self, timeout=None):
+        stats.increment('requests')
+
+        # All connections are checked out, so with pool_block=True the caller
+        # has to wait for another request to release one
+        if self.pool is not None and self.pool.empty():
+            start = time.time()
+            conn = pool_class._get_conn(self, timeout=timeout)
+            stats.increment('waits')
+            stats.increment('wait_seconds', time.time() - start)
+            return conn
+
+        return pool_class._get_conn(self, timeout=timeout)
+
+    return type('Instrumented' + pool_class.__name__,
+                (pool_class,),
+                {'_new_conn': _new_conn, '_get_conn': _get_conn})
+
+class _InstrumentedAdapter(HTTPAdapter):
+    def __init__(self, stats, **kwargs):
+        # Must be set before HTTPAdapter.__init__(), which builds the pool
+        # manager
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _instrumented(HTTPConnectionPool, self._stats),
+            'https': _instrumented(HTTPSConnectionPool, self._stats)}
+
+class ClientPool(object):
+    def __init__(self,
+                 size,
+                 project=None,
+                 credentials_file=None,
+                 location=None):
+
+        self._size = size
+        self._project = project
+
+        # Shards (see Shards.py) may authenticate with a service account key
+        # of their own, rather than the application default credentials
+        self._credentials_file = credentials_file
+        self._location = location
+        self._stats = PoolStats()
+        self._lock = threading.Lock()
+        self._client = None
+
+    def _connect(self):
+        if self._credentials_file:
+            credentials = service_account.Credentials.from_service_account_file(
+                self._credentials_file,
+                scopes=bigquery.Client.SCOPE)
+            default_project = credentials.project_id
+        else:
+            credentials, default_project = google.auth.default(
+                scopes=bigquery.Client.SCOPE)
+
+        # pool_block=True caps the number of open connections at size; callers
+        # beyond that wait for a free connection, which is counted in the stats
+        adapter = _InstrumentedAdapter(stats=self._stats,
+                                       pool_connections=4,
+                                       pool_maxsize=self._size,
+                                       pool_block=True)
+
+        session = AuthorizedSession(credentials)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        # bigquery.Client is thread-safe, so a single instance sharing the
+        # credentials and the bounded session serves every Trial
+        return bigquery.Client(project=self._project or default_project,
+                               credentials=credentials,
+                               location=self._location,
+                               _http=session)
+
+    def __repr__(self):
+        return 'ClientPool(size = {}, stats = {})'.format(self._size,
+                                                         self.stats())
+
+    def get_client(self):
+        # Connect on first use, so that an Experiment rebuilt entirely from
+        # raw samples never needs credentials
+        with self._lock:
+            if self._client is None:
+                self._client = self._connect()
+
+        return self._client
+
+    def stats(self):
+        return self._stats.snapshot()
+
+    def report(self, since=None):
+        """ Print pool activity, optionally relative to an earlier stats() """
+
+        stats = self.stats()
+        if since:
+            stats = {field: stats[field] - since.get(field, 0)
+                     for field in stats}
+
+        print(('-- Client pool: size = {}, requests = {}, opened = {}, '
+               'reused = {}, waits = {} ({:0.2f}s)')
+              .format(self._size,
+                      stats['requests'],
+                      stats['opened'],
+                      stats['reused'],
+                      stats['waits'],
+                      stats['wait_seconds']))
+
+    @property
+    def size(self):
+        return self._size
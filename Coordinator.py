@@ -0,0 +1,371 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Distribute the load of each Scenario across Worker processes, on this host
+(--processes) or on others (--workers), and merge their results.
+
+A closed-loop scenario of N threads is allocated to queries once, for all of
+its threads, then striped across the workers: worker k runs threads k, k + W,
+k + 2W etc., so the overall mix is the same as in a single process. An
+open-loop scenario is split into one arrival stream per worker, each at the
+target rate / W with its own seed.
+
+Every worker starts its share at the same time, a few seconds after the
+request is sent (start_delay), and returns mergeable histograms rather than
+raw samples, so the load generated is not limited by a single process or host
+and the coordinator only ever handles summaries.
+
+Requests carry the shared secret of the workers: that of the
+BQ_PARALLEL_SECRET environment variable for --workers, or a random one given
+to the processes started for --processes. """
+
+import os
+import sys
+import json
+import time
+import secrets
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import Worker
+from MixScheduler import MixScheduler
+from Backend import load_simulation
+from Shards import parse_shards, assign
+from QueryResult import QueryResult, result_name
+from Scenario import Scenario
+
+class Coordinator(object):
+    def __init__(self,
+                 workers,
+                 queries,
+                 options,
+                 start_delay=2.0,
+                 secret=None):
+
+        self._workers = workers
+        self._queries = queries
+        self._options = options
+        self._start_delay = start_delay
+        self._processes = []
+        self._shards_file = None
+
+        self._secret = secret or os.environ.get(Worker.SECRET_ENV)
+        if not self._secret:
+            raise ValueError('Workers require a shared secret, in the {} environment '
+                             'variable'.format(Worker.SECRET_ENV))
+
+        # Workers only accept some options, and never print per trial
+        # results, as there would be one set of them per worker. The
+        # simulation model is sent rather than the name of its file.
+        self._worker_options = {name: options.get(name) for name in Worker.WORKER_OPTIONS}
+        self._worker_options['quiet'] = True
+        if options.get('simulation_file'):
+            self._worker_options['simulation_model'] = load_simulation(
+                options['simulation_file'])
+
+        # Workers generate the same bindings of templated queries, from the
+        # same seed, and each takes its own share of them
+        template_seed = options['seed']
+        if template_seed is None:
+            template_seed = int(np.random.randint(2**31))
+
+        self._query_specs = [{'name': query.name,
+                              'sql': query.sql,
+                              'weight': query.weight,
+                              'template': ({'seed': template_seed, **query.template_spec}
+                                           if query.template_spec else None),
+                              'options': {name: value
+                                          for name, value in query.options.items()
+                                          if name in Worker.QUERY_OPTIONS}}
+                             for query in queries]
+
+        for address in self._workers:
+            Worker.send(address, {'command': 'ping'}, self._secret, timeout=10)
+
+    @classmethod
+    def local(cls, processes, queries, options, start_delay=2.0):
+        """ Start processes Workers on this host, and a Coordinator of them """
+
+        worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'Worker.py')
+
+        # Local workers share a secret of their own, passed in their
+        # environment, and read the key files of shards from a file
+        secret = secrets.token_hex(16)
+        environment = {**os.environ, Worker.SECRET_ENV: secret}
+
+        arguments = [sys.executable, worker_script, '--port', '0']
+        shards_file = None
+        if options.get('shards'):
+            with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+                json.dump(options['shards'], f)
+            shards_file = f.name
+            arguments += ['--shards', shards_file]
+
+        started = []
+        workers = []
+        for worker in range(processes):
+            process = subprocess.Popen(arguments,
+                                       stdout=subprocess.PIPE,
+                                       universal_newlines=True,
+                                       env=environment)
+            started.append(process)
+
+            # The first line of a worker is the address it listens on
+            line = process.stdout.readline()
+            if not line.startswith('Worker listening on '):
+                for process in started:
+                    process.kill()
+                if shards_file is not None:
+                    os.remove(shards_file)
+                raise RuntimeError('Worker process failed to start')
+
+            host, port = line.rsplit(' ', 1)[1].strip().rsplit(':', 1)
+            workers.append((host, int(port)))
+
+            # Anything else it prints is passed through
+            threading.Thread(target=_forward,
+                             args=(process.stdout, worker),
+                             daemon=True).start()
+
+        coordinator = cls(workers=workers,
+                          queries=queries,
+                          options=options,
+                          start_delay=start_delay,
+                          secret=secret)
+        coordinator._processes = started
+        coordinator._shards_file = shards_file
+
+        return coordinator
+
+    def __repr__(self):
+        return 'Coordinator(workers = {})'.format(self._workers)
+
+    def close(self):
+        """ Stop the Workers started by this Coordinator """
+
+        for address in self._workers[:len(self._processes)]:
+            try:
+                Worker.send(address, {'command': 'shutdown'}, self._secret, timeout=10)
+            except OSError:
+                pass
+
+        for process in self._processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+        self._processes = []
+
+        if self._shards_file is not None:
+            os.remove(self._shards_file)
+            self._shards_file = None
+
+    def run(self, index, value, samples=None, sink=None, meter=None):
+        """ Run scenario index, of value threads (closed loop) or queries per
+        second (open loop), across every worker. Return (results by query
+        name, column values). Workers share what is left of the budget of
+        meter, and their cost is added to it. """
+
+        start_at = time.time() + self._start_delay
+        requests = self._requests(index, value, samples, start_at, sink is not None,
+                                  meter)
+
+        with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+            responses = list(executor.map(
+                lambda request: Worker.send(request[0], request[1], self._secret,
+                                            timeout=request[2]), requests))
+
+        response_results = {}
+        column_values = {}
+        reported = {}
+        for worker, response in enumerate(responses):
+            for query_name, state in response['results'].items():
+                result = QueryResult.from_dict(state)
+                if query_name in response_results:
+                    response_results[query_name].merge(result)
+                else:
+                    response_results[query_name] = result
+
+            # Scenario columns are mostly rates or concurrencies, so the
+            # overall value is their sum
+            for column, column_value in response['columns'].items():
+                if column_value is not None:
+                    column_values[column] = column_values.get(column, 0) + column_value
+                    reported[column] = reported.get(column, 0) + 1
+
+            if sink is not None:
+                for record in response['samples']:
+                    self._remap(record, worker)
+                    sink.append(record)
+
+        for column in Scenario.MEAN_COLUMNS:
+            if column in column_values:
+                column_values[column] /= reported[column]
+
+        # A parameter bucket drawn by the threads of only some workers reports
+        # the threads of its query across all of them, as in a single process
+        if self._options['load'] != 'open':
+            threads = Counter(result_name(query_name, shard=shard)
+                              for _, request, _ in requests
+                              for query_name, shard in zip(
+                                  request['allocation'],
+                                  request.get('shards') or [None] * len(request['allocation'])))
+            for result in response_results.values():
+                if result.query is not None:
+                    result.concurrency = threads[result_name(result.query,
+                                                             shard=result.shard)]
+
+        if meter is not None:
+            meter.add(column_values.get('cost') or 0.0,
+                      exhausted=any(response.get('budget_reached')
+                                    for response in responses))
+
+        # Results follow the order of the queries, and of the parameter
+        # buckets of each, as in a single process
+        ordered = {}
+        for query in self._queries:
+            for query_name in sorted(response_results):
+                if (query_name == query.name
+                        or query_name.startswith(query.name + ' [')):
+                    ordered[query_name] = response_results[query_name]
+
+        return ordered, column_values
+
+    def _requests(self, index, value, samples, start_at, raw, meter=None):
+        count = len(self._workers)
+
+        common = {'command': 'run',
+                  'options': self._worker_options,
+                  'queries': self._query_specs,
+                  'index': index,
+                  'samples': samples,
+                  'start_at': start_at,
+                  'raw': raw,
+                  'budget': meter.share(count) if meter else None,
+                  'estimates': meter.estimates if meter else {}}
+
+        if self._options['load'] == 'open':
+            seed = self._options['seed']
+            shares = [{'rate': value / count,
+                       'seed': None if seed is None else seed + worker}
+                      for worker in range(count)]
+        else:
+            scheduler = MixScheduler(queries=self._queries,
+                                     seed=self._options['seed'])
+            allocation = [query.name for query in
+                          scheduler.allocate(value, mode=self._options['mix'])]
+
+            shares = [{'allocation': allocation[worker::count]}
+                      for worker in range(count)]
+
+            # Threads are assigned to shards over the whole scenario, so that
+            # every worker does not start over with the first shard
+            if self._options.get('shards'):
+                shards = assign(parse_shards(self._options['shards']), len(allocation))
+                for worker, share in enumerate(shares):
+                    share['shards'] = shards[worker::count]
+
+        # Workers take their own share of the bindings of templated queries
+        for worker, share in enumerate(shares):
+            share.update({'worker': worker, 'workers': count})
+
+        # Workers without a thread of a small scenario are left idle
+        return [(address, {**common, **share}, None)
+                for address, share in zip(self._workers, shares)
+                if share.get('allocation', True)]
+
+    def _remap(self, record, worker):
+        """ Tag a raw sample with its worker, and map its thread number to the
+        thread of the whole scenario """
+
+        record['worker'] = worker
+        if self._options['load'] != 'open' and record.get('thread') is not None:
+            record['thread'] = worker + record['thread'] * len(self._workers)
+
+    @property
+    def workers(self):
+        return self._workers
+
+class DistributedScenario(object):
+    """ A Scenario run by a Coordinator. The local scenario describes it
+    (label, columns and series) but never runs. """
+
+    def __init__(self,
+                 scenario,
+                 value,
+                 coordinator,
+                 samples=None,
+                 sink=None,
+                 meter=None):
+
+        self._scenario = scenario
+        self._value = value
+        self._coordinator = coordinator
+        self._samples = samples
+        self._sink = sink
+        self._meter = meter
+        self._column_values = {}
+
+        self.COLUMNS = scenario.COLUMNS
+
+    def __repr__(self):
+        return 'DistributedScenario(scenario = {}, workers = {})'.format(
+            self._scenario,
+            len(self._coordinator.workers))
+
+    def run(self):
+        print('-- Running on {} workers'.format(len(self._coordinator.workers)))
+
+        response_results, self._column_values = self._coordinator.run(
+            index=self._scenario.index,
+            value=self._value,
+            samples=self._samples,
+            sink=self._sink,
+            meter=self._meter)
+
+        return response_results
+
+    def column_values(self):
+        return self._column_values
+
+    @property
+    def label(self):
+        return self._scenario.label
+
+    @property
+    def index(self):
+        return self._scenario.index
+
+    @property
+    def series_names(self):
+        return self._scenario.series_names
+
+def parse_workers(text):
+    """ Parse a comma separated list of host:port worker addresses """
+
+    workers = []
+    for address in text.split(','):
+        host, port = address.strip().rsplit(':', 1)
+        workers.append((host, int(port)))
+
+    return workers
+
+def _forward(stream, worker):
+    for line in stream:
+        print('[worker {}] {}'.format(worker, line), end='')
@@ -0,0 +1,97 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Running cost of an Experiment, enforcing the --max-cost budget while
+scenarios run.
+
+Every sample reserves the estimated cost of its query (see Preflight) before
+it is dispatched, and settles it with the bytes its job actually billed once
+done. A sample whose reservation would take the cost spent or in flight over
+the budget is not dispatched, and the meter is then exhausted: Trials stop
+taking samples and open-loop scenarios stop dispatching arrivals. Queries
+already in flight still complete, so the budget can only be exceeded by the
+difference between their estimated and billed costs. """
+
+import threading
+from Pricing import COST_PER_MB
+
+class CostMeter(object):
+    def __init__(self,
+                 budget=None,
+                 estimates=None):
+
+        self._budget = budget
+        self._estimates = estimates or {}
+
+        self._lock = threading.Lock()
+        self._spent = 0.0
+        self._reserved = 0.0
+        self._exhausted = False
+
+    def __repr__(self):
+        return 'CostMeter(spent = ${:0.4f}, budget = {})'.format(
+            self._spent,
+            'none' if self._budget is None else '${:0.2f}'.format(self._budget))
+
+    def reserve(self, query_name):
+        """ Reserve the estimated cost of a sample of a query, return the
+        reservation or None if the budget does not allow for it """
+        estimate = self._estimates.get(query_name) or 0.0
+
+        with self._lock:
+            if self._budget is not None and (
+                    self._spent + self._reserved + estimate > self._budget
+                    or self._spent >= self._budget):
+                self._exhausted = True
+                return None
+
+            self._reserved += estimate
+            return estimate
+
+    def settle(self, reservation, mbytes_billed=0.0):
+        """ Replace a reservation with the cost actually billed """
+        with self._lock:
+            self._reserved -= reservation
+            self._spent += mbytes_billed * COST_PER_MB
+
+    def add(self, cost, exhausted=False):
+        """ Add the cost of samples metered elsewhere, i.e. by Workers, and
+        whether their share of the budget was reached """
+        with self._lock:
+            self._spent += cost
+            if exhausted or (self._budget is not None and self._spent >= self._budget):
+                self._exhausted = True
+
+    def share(self, parts):
+        """ Budget left for each of parts processes, or None """
+        if self._budget is None:
+            return None
+
+        return max(0.0, self._budget - self._spent) / parts
+
+    @property
+    def exhausted(self):
+        return self._exhausted
+
+    @property
+    def spent(self):
+        return self._spent
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @property
+    def estimates(self):
+        return self._estimates
@@ -15,12 +15,42 @@
 """ Class to construct and run a parallel query experiment """
 
 import csv
-import numpy as np
-import itertools
 from Scenario import Scenario
+from AsyncScenario import AsyncScenario
+from OpenLoopScenario import OpenLoopScenario
+from ReplayScenario import ReplayScenario
+from Backend import get_backend
+from Coordinator import Coordinator, DistributedScenario
+from Shards import client_pool, parse_shards
+from SampleSink import SampleSink, completed_scenarios, rebuild_results
+from SampleStore import SampleStore
+from MixScheduler import MixScheduler
+from Retry import ERROR_CLASSES
+from Preflight import Preflight, BudgetExceeded
+from CostMeter import CostMeter
+from LiveMetrics import LiveMetrics
+from Histogram import Histogram
+import ScenarioPlan
 from Statistic import Statistic
 from stats_config import stats_cfg
 
+def parse_plan(scenario_plan, options):
+    """ Parse the scenario plan of the load model of options: concurrency
+    levels for closed loops, arrival rates (i.e. 5..50:5/s) for open loops and
+    speeds (i.e. 1,2x) for replays. Raises ValueError if it is malformed. """
+
+    if options['load'] == 'open':
+        return ScenarioPlan.parse(scenario_plan.rstrip('/s'),
+                                  number=float)
+    elif options['load'] == 'replay':
+        return ScenarioPlan.parse(scenario_plan.rstrip('x'),
+                                  number=float)
+
+    return ScenarioPlan.parse(scenario_plan,
+                              number=int,
+                              efficiency=options['knee_efficiency'],
+                              latency_factor=options['knee_latency'])
+
 class Experiment(object):
     def __init__(self,
                  queries,
@@ -34,21 +64,152 @@ class Experiment(object):
         self._scenario_plan = scenario_plan
 
         self._scenarios = []
-        self._results = []
         self._stats = []
 
-        # TODO (djrut): Implement more sophisticated scenario plans, with
-        # idioms such as: 'range(x..y) step z'
-        for scenario in scenario_plan.split(','):
-            self._scenarios.append(Scenario(threads=int(scenario),
-                                            samples=self._samples,
-                                            queries=self._queries,
-                                            options=self._options))
+        self._backend = get_backend(options)
+
+        self._sink = None
+        if self._options['raw_output']:
+            self._sink = SampleSink(path=self._options['raw_output'],
+                                    format=self._options['raw_format'])
+
+        # Values of every sample of the experiment, read by the summaries of
+        # every Trial, mapped to a file under --sample-store if set
+        self._store = SampleStore(path=self._options.get('sample_store'))
+
+        if self._options['load'] == 'open':
+            self._build_open_loop(scenario_plan)
+        elif self._options['load'] == 'replay':
+            self._build_replay(scenario_plan)
+        else:
+            self._build_closed_loop(scenario_plan)
+
+        # With --processes or --workers, scenarios are run by Worker processes
+        # and only their merged results come back to this one
+        self._coordinator = None
+
+        # Running cost of the experiment, set up by the pre-flight stage
+        self._meter = None
+
+        # Optional live metrics of the running scenarios (--live,
+        # --metrics-log, --metrics-port)
+        self._metrics = LiveMetrics.from_options(options)
 
         for stat_name, stat_function in stats_cfg.items():
             self._stats.append(Statistic(name=stat_name,
                                          function=stat_function))
 
+    def _build_closed_loop(self, scenario_plan):
+        """ Closed-loop plans are concurrency levels, as a comma separated
+        list, ranges such as 10..100:10 or 1..64*2, or an adaptive
+        'search:X..Y' for the throughput knee (see ScenarioPlan) """
+
+        self._plan = parse_plan(scenario_plan, self._options)
+
+        # One connection pool serves every scenario. Unless sized explicitly,
+        # it holds one connection per concurrent API caller: every thread of
+        # the largest scenario, or the I/O threads of the asyncio engine.
+        pool_size = self._options['pool_size']
+        if not pool_size:
+            if self._options['engine'] == 'asyncio':
+                pool_size = self._options['io_threads']
+            else:
+                pool_size = self._plan.max
+
+        self._client_pool = client_pool(self._backend, self._options, pool_size)
+
+    def _build_open_loop(self, scenario_plan):
+        """ Open-loop plans are arrival rates in queries per second, as a
+        comma separated list or ranges (i.e. 5..50:5/s), each run for the
+        configured duration. A list of increasing rates forms a step ramp. """
+
+        self._plan = parse_plan(scenario_plan, self._options)
+
+        # Open-loop scenarios always run on the event loop, so API calls are
+        # only ever made by the I/O threads
+        self._client_pool = client_pool(self._backend,
+                                        self._options,
+                                        self._options['pool_size'] or self._options['io_threads'])
+
+    def _build_replay(self, scenario_plan):
+        """ Replay plans are speeds of the replay of a job history, as a comma
+        separated list or ranges, each replaying the whole history (or the
+        first --duration seconds of it, once scaled) """
+
+        self._plan = parse_plan(scenario_plan, self._options)
+
+        # Replays run on the event loop, as open-loop scenarios do
+        self._client_pool = client_pool(self._backend,
+                                        self._options,
+                                        self._options['pool_size'] or self._options['io_threads'])
+
+    def _make_scenario(self, index, value):
+        """ Scenarios are built as the plan is consumed, so that an adaptive
+        plan can choose each one from the results so far """
+
+        if self._options['load'] == 'open':
+            scenario = OpenLoopScenario(rate=value,
+                                        duration=self._options['duration'],
+                                        arrivals=self._options['arrivals'],
+                                        seed=self._options['seed'],
+                                        queries=self._queries,
+                                        options=self._options,
+                                        client_pool=self._client_pool,
+                                        sink=self._sink,
+                                        index=index,
+                                        meter=self._meter,
+                                        metrics=self._metrics,
+                                        store=self._store)
+        elif self._options['load'] == 'replay':
+            scenario = ReplayScenario(speed=value,
+                                      queries=self._queries,
+                                      options=self._options,
+                                      client_pool=self._client_pool,
+                                      sink=self._sink,
+                                      index=index,
+                                      meter=self._meter,
+                                      metrics=self._metrics,
+                                      store=self._store)
+        else:
+            if self._options['engine'] == 'asyncio':
+                scenario_class = AsyncScenario
+            else:
+                scenario_class = Scenario
+
+            scenario = scenario_class(threads=value,
+                                      samples=self._samples,
+                                      queries=self._queries,
+                                      options=self._options,
+                                      client_pool=self._client_pool,
+                                      sink=self._sink,
+                                      index=index,
+                                      meter=self._meter,
+                                      metrics=self._metrics,
+                                      store=self._store)
+
+        if self._coordinator:
+            return DistributedScenario(scenario=scenario,
+                                       value=value,
+                                       coordinator=self._coordinator,
+                                       samples=self._samples,
+                                       sink=self._sink,
+                                       meter=self._meter)
+
+        return scenario
+
+    def _start_coordinator(self):
+        if self._options.get('processes'):
+            print('- Starting {} worker processes'.format(self._options['processes']))
+            self._coordinator = Coordinator.local(processes=self._options['processes'],
+                                                  queries=self._queries,
+                                                  options=self._options)
+        elif self._options.get('workers'):
+            print('- Using workers {}'.format(', '.join(
+                '{}:{}'.format(host, port) for host, port in self._options['workers'])))
+            self._coordinator = Coordinator(workers=self._options['workers'],
+                                            queries=self._queries,
+                                            options=self._options)
+
     def __repr__(self):
         return 'Experiment(queries = {}, options = {}, scenarios = {})'.format(self._queries,
                                                                                self._options,
@@ -59,43 +220,231 @@ class Experiment(object):
 
         """ Execute an experiment """
 
+        # Before the output file is opened, so that an experiment over its
+        # budget leaves no trace
+        self._preflight()
+
         with open(output_file, 'w+', newline='') as output_file:
             if self._options['format'] == 'csv':
                 results_writer = csv.writer(output_file, delimiter=',')
 
                 # Write header row
-                header_row = ['query_name','num_threads','num_samples']
+                header_row = ['query_name','num_threads','num_samples',
+                              'intended_mix','achieved_mix','retries']
+
+                # Samples that failed after their last attempt, by error class
+                header_row.extend('errors_{}'.format(error_class)
+                                  for error_class in ERROR_CLASSES)
+
+                # Every scenario of a plan has the same type and options, so
+                # the first one describes the columns of all of them
+                template = self._make_scenario(0, self._plan.first)
+
+                columns = list(template.COLUMNS)
+                header_row.extend(columns)
 
                 # TODO (djrut): Allow user to specify the set and sequence of
                 # stats to output
-                for stat in self._stats:
-                    header_row.append(stat.name)
+                series_names = list(template.series_names)
+                for series_name in series_names:
+                    for stat in self._stats:
+                        header_row.append(self._column_name(series_name, stat))
 
                 results_writer.writerow(header_row)
 
             print(('- Starting experiment with scenarios = {}, '
-                   'samples = {}, use_query_cache = {}')
+                   '{}, use_query_cache = {}')
                   .format(self._scenario_plan,
-                          self._samples,
+                          self._length(),
                           self._options['use_cache']))
 
+            if self._options['load'] == 'replay':
+                print('-- Replaying {}'.format(self._options['replay_file']))
 
-            for scenario in self._scenarios:
-                print('-- Scenario = {} concurrent threads'
-                      .format(scenario.threads))
+            if self._options.get('shards'):
+                print('-- Shards: {}'.format(', '.join(
+                    '{} (weight = {})'.format(shard.name, shard.weight)
+                    for shard in parse_shards(self._options['shards']))))
 
-                scenario_result = scenario.run()
+            for query in self._queries:
+                if query.template is not None:
+                    print('-- Query "{}": {}'.format(query.name,
+                                                     query.template.describe()))
 
-                self._results.append(scenario_result)
+            resumed = self._resume()
 
-                for query_name, response_times in scenario_result.items():
-                    row = [query_name,
-                           len(response_times),
-                           len(list(itertools
-                                    .chain
-                                    .from_iterable(response_times)))]
+            intended_mix = MixScheduler(queries=self._queries).intended_mix()
 
-                    for stat in self._stats:
-                        row.append(stat.execute(response_times))
+            try:
+                self._start_coordinator()
+
+                if self._metrics:
+                    self._metrics.start()
+
+                while True:
+                    value = self._plan.next()
+                    if value is None:
+                        break
+
+                    scenario = self._make_scenario(len(self._scenarios), value)
+                    self._scenarios.append(scenario)
+
+                    print('-- Scenario = {}'
+                          .format(scenario.label))
+
+                    # Only trust a completed scenario if the plan still matches
+                    if (scenario.index in resumed
+                            and resumed[scenario.index][2] == scenario.label):
+                        print('-- Resumed from raw samples in {}'
+                              .format(self._options['raw_output']))
+                        scenario_result, column_values, _ = resumed[scenario.index]
+                        self._meter.add(column_values.get('cost') or 0.0)
+                    else:
+                        if self._metrics:
+                            self._metrics.scenario(scenario.index, scenario.label)
+
+                        pool_stats = self._client_pool.stats()
+
+                        scenario_result = scenario.run()
+
+                        if not (self._options['quiet'] or self._coordinator):
+                            self._client_pool.report(since=pool_stats)
+
+                        column_values = scenario.column_values()
+
+                        if self._sink:
+                            self._sink.end_scenario(scenario.index,
+                                                    scenario,
+                                                    scenario_result)
+
+                    total_samples = sum(result.num_samples
+                                        for result in scenario_result.values())
+
+                    self._plan.record(value,
+                                      column_values.get('throughput') or 0.0,
+                                      self._p95(scenario_result))
+
+                    for query_name, result in scenario_result.items():
+                        row = [query_name,
+                               result.concurrency,
+                               result.num_samples,
+                               intended_mix.get(result.query or query_name, ''),
+                               (result.num_samples / total_samples
+                                if total_samples else ''),
+                               sum(result.retries.values())]
+
+                        row.extend(result.errors.get(error_class, 0)
+                                   for error_class in ERROR_CLASSES)
+
+                        row.extend(column_values.get(column, '') for column in columns)
+
+                        for series_name in series_names:
+                            values = result.series(series_name)
+                            for stat in self._stats:
+                                row.append(stat.execute(values) if values else '')
+
+                        results_writer.writerow(row)
+
+                    # Rows reach the disk as soon as their scenario completes
+                    output_file.flush()
+
+                    if self._meter.exhausted:
+                        print('- Budget of ${:0.2f} reached, stopping the experiment'
+                              .format(self._meter.budget))
+                        break
+
+                self._plan.report()
+
+                print('- Experiment cost: ${:0.5f}'.format(self._meter.spent))
+            finally:
+                if self._metrics:
+                    self._metrics.stop()
+
+                if self._coordinator:
+                    self._coordinator.close()
+
+                if self._sink:
+                    self._sink.close()
+
+                self._store.close()
+
+    def _preflight(self):
+        """ Dry-run the queries and project the cost of the plan, unless
+        --no-preflight, and set up the CostMeter enforcing --max-cost """
+
+        budget = self._options.get('max_cost')
+        estimates = {}
+
+        if self._options.get('preflight'):
+            preflight = Preflight.from_options(queries=self._queries,
+                                               options=self._options,
+                                               backend=self._backend)
+            # Replayed jobs are estimated from the history rather than
+            # dry-run
+            if self._options['load'] != 'replay':
+                preflight.run()
+
+            counts, cost = preflight.project(self._plan.values, self._samples)
+            preflight.report(counts, cost)
+
+            # Queries without an estimate would be free to the CostMeter
+            if budget is not None and preflight.unknown:
+                raise BudgetExceeded(
+                    'Projected cost is unknown, with no estimate of {}; refusing '
+                    'to run with a --max-cost budget'
+                    .format(', '.join('"{}"'.format(name)
+                                      for name in preflight.unknown)))
+
+            if budget is not None and cost is not None and cost > budget:
+                raise BudgetExceeded(
+                    'Projected cost of ${:,.4f} is over the --max-cost budget of ${:,.2f}'
+                    .format(cost, budget))
+
+            estimates = preflight.costs()
+
+        self._meter = CostMeter(budget=budget, estimates=estimates)
+
+    def _length(self):
+        """ How long each scenario runs for """
+        if self._options['duration']:
+            return 'duration = {}s'.format(self._options['duration'])
+
+        if self._options['load'] == 'replay':
+            return 'whole history'
+
+        return 'samples = {}'.format(self._samples)
+
+    def _resume(self):
+        """ With --resume, return {scenario index: (results, column values,
+        label)} rebuilt from the raw samples of every scenario that has already
+        completed, so that they are not run again """
+
+        if not self._options['resume']:
+            return {}
+
+        completed = completed_scenarios(self._options['raw_output'])
+        rebuilt = rebuild_results(self._options['raw_output'], completed)
+
+        print('- Resuming: {} scenarios already completed'
+              .format(len(completed)))
+
+        return {index: (rebuilt[index], info['columns'], info['label'])
+                for index, (_, info) in completed.items()}
+
+    @staticmethod
+    def _p95(scenario_result):
+        """ p95 response time over all the queries of a scenario """
+        response_times = Histogram()
+        for result in scenario_result.values():
+            if result.series('response_time'):
+                response_times.merge(result.series('response_time'))
+
+        return response_times.percentile(95)
+
+    @staticmethod
+    def _column_name(series_name, stat):
+        # Response time statistics keep their original, unprefixed names
+        if series_name == 'response_time':
+            return stat.name
 
-                    results_writer.writerow(row)
+        return '{}_{}'.format(series_name, stat.name)
@@ -0,0 +1,310 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Streaming, mergeable log-bucketed histogram of sample values.
+
+Values are counted in buckets whose boundaries grow geometrically by a factor
+gamma = (1 + a) / (1 - a), where a is the relative accuracy. Every value is
+represented by the midpoint of its bucket, so any percentile is returned
+within a relative error of a of the true sample value (1% by default).
+Percentiles interpolate linearly between the values of the two nearest ranks,
+as np.percentile() does. Trimmed min/max are within 2a, as the trim cut-off
+itself is only resolved to a bucket. Count, mean, standard deviation, min and
+max are exact. Memory is bounded by the dynamic range rather than the number
+of samples: about 1,400 buckets cover 1 microsecond to 1 week at 1% accuracy.
+
+Histograms with the same relative accuracy can be merged, so summaries can be
+built per Trial and combined per Scenario, or shipped between processes with
+to_dict()/from_dict(). """
+
+import math
+import numpy as np
+
+RELATIVE_ACCURACY = 0.01
+
+# Values closer to zero than this are counted in a dedicated zero bucket
+MIN_VALUE = 1e-9
+
+class Histogram(object):
+    def __init__(self,
+                 relative_accuracy=RELATIVE_ACCURACY):
+
+        self._relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+
+        self._positive = {}
+        self._negative = {}
+        self._zero = 0
+
+        self._count = 0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+        self._min = math.inf
+        self._max = -math.inf
+
+        self._buckets = None
+        self._cumulative = None
+        self._trims = {}
+
+    def __repr__(self):
+        return 'Histogram(count = {}, buckets = {}, relative_accuracy = {})'.format(
+            self._count,
+            len(self._positive) + len(self._negative) + bool(self._zero),
+            self._relative_accuracy)
+
+    def __len__(self):
+        return self._count
+
+    def record(self, value, count=1):
+        """ Add a value (count times) to the histogram """
+
+        if value > MIN_VALUE:
+            index = int(math.ceil(math.log(value) / self._log_gamma))
+            self._positive[index] = self._positive.get(index, 0) + count
+        elif value < -MIN_VALUE:
+            index = int(math.ceil(math.log(-value) / self._log_gamma))
+            self._negative[index] = self._negative.get(index, 0) + count
+        else:
+            self._zero += count
+
+        self._count += count
+        self._sum += value * count
+        self._sum_squares += value * value * count
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+
+        self._invalidate()
+
+    def merge(self, other):
+        """ Add all the values of another histogram to this one """
+
+        if other._relative_accuracy != self._relative_accuracy:
+            raise ValueError('Cannot merge histograms with relative accuracy '
+                             '{} and {}'.format(self._relative_accuracy,
+                                                other._relative_accuracy))
+
+        for index, count in other._positive.items():
+            self._positive[index] = self._positive.get(index, 0) + count
+        for index, count in other._negative.items():
+            self._negative[index] = self._negative.get(index, 0) + count
+        self._zero += other._zero
+
+        self._count += other._count
+        self._sum += other._sum
+        self._sum_squares += other._sum_squares
+        self._min = min(self._min, other._min)
+        self._max = max(self._max, other._max)
+
+        self._invalidate()
+        return self
+
+    @classmethod
+    def from_values(cls, values, relative_accuracy=RELATIVE_ACCURACY):
+        """ Histogram of an array of values (i.e. a column of a SampleStore),
+        in a single vectorized pass. NaN values, which stand for unknown
+        ones, are left out. """
+        histogram = cls(relative_accuracy=relative_accuracy)
+
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return histogram
+
+        for buckets, selected in ((histogram._positive, values[values > MIN_VALUE]),
+                                  (histogram._negative, -values[values < -MIN_VALUE])):
+            indexes, counts = np.unique(np.ceil(np.log(selected) / histogram._log_gamma),
+                                        return_counts=True)
+            buckets.update(zip(indexes.astype(int).tolist(), counts.tolist()))
+
+        histogram._zero = int(np.count_nonzero(np.abs(values) <= MIN_VALUE))
+        histogram._count = len(values)
+        histogram._sum = float(values.sum())
+        histogram._sum_squares = float(np.dot(values, values))
+        histogram._min = float(values.min())
+        histogram._max = float(values.max())
+
+        return histogram
+
+    def to_dict(self):
+        """ Serializable form, for merging summaries across processes """
+        return {'relative_accuracy': self._relative_accuracy,
+                'positive': sorted(self._positive.items()),
+                'negative': sorted(self._negative.items()),
+                'zero': self._zero,
+                'count': self._count,
+                'sum': self._sum,
+                'sum_squares': self._sum_squares,
+                'min': self._min if self._count else None,
+                'max': self._max if self._count else None}
+
+    @classmethod
+    def from_dict(cls, state):
+        histogram = cls(relative_accuracy=state['relative_accuracy'])
+        histogram._positive = {int(index): count for index, count in state['positive']}
+        histogram._negative = {int(index): count for index, count in state['negative']}
+        histogram._zero = state['zero']
+        histogram._count = state['count']
+        histogram._sum = state['sum']
+        histogram._sum_squares = state['sum_squares']
+        if state['count']:
+            histogram._min = state['min']
+            histogram._max = state['max']
+
+        return histogram
+
+    # Exact statistics
+
+    @property
+    def count(self):
+        return self._count
+
+    def mean(self):
+        if not self._count:
+            return math.nan
+
+        return self._sum / self._count
+
+    def std(self):
+        """ Population standard deviation, as np.std() """
+        if not self._count:
+            return math.nan
+
+        variance = self._sum_squares / self._count - self.mean() ** 2
+        return math.sqrt(max(variance, 0.0))
+
+    def min(self):
+        return self._min if self._count else math.nan
+
+    def max(self):
+        return self._max if self._count else math.nan
+
+    # Statistics within the relative accuracy
+
+    def buckets(self):
+        """ Return the bucket representative values (ascending) and their
+        counts, as two NumPy arrays. Cached until the next update, so that
+        every statistic computed on the same summary shares a single pass """
+
+        if self._buckets is None:
+            negative = sorted(self._negative.items(), reverse=True)
+            positive = sorted(self._positive.items())
+
+            values = ([-self._value(index) for index, _ in negative]
+                      + ([0.0] if self._zero else [])
+                      + [self._value(index) for index, _ in positive])
+            counts = ([count for _, count in negative]
+                      + ([self._zero] if self._zero else [])
+                      + [count for _, count in positive])
+
+            self._buckets = (np.array(values, dtype=float),
+                             np.array(counts, dtype=np.int64))
+            self._cumulative = np.cumsum(self._buckets[1])
+
+        return self._buckets
+
+    def percentile(self, q):
+        """ q-th percentile, interpolated linearly between the two nearest
+        ranks as by np.percentile() """
+        if not self._count:
+            return math.nan
+
+        rank = q / 100 * (self._count - 1)
+        lower = math.floor(rank)
+        upper = math.ceil(rank)
+
+        lower_value = self._ranked(lower)
+        if upper == lower:
+            return lower_value
+
+        return lower_value + (rank - lower) * (self._ranked(upper) - lower_value)
+
+    def _ranked(self, rank):
+        """ Value of the rank-th smallest sample (from 0): exact for the
+        smallest and largest ones, within the relative accuracy otherwise """
+        if rank <= 0:
+            return self._min
+        if rank >= self._count - 1:
+            return self._max
+
+        values, _ = self.buckets()
+        position = np.searchsorted(self._cumulative, rank, side='right')
+
+        return self._clamp(values[min(position, len(values) - 1)])
+
+    def median(self):
+        return self.percentile(50)
+
+    def std_trim(self, m=3):
+        """ (min, max) of the values left after trimming outliers using the
+        mean/std deviation method """
+
+        key = ('std', m)
+        if key not in self._trims:
+            mean, std = self.mean(), self.std()
+            self._trims[key] = self._trimmed_range(mean - m * std,
+                                                   mean + m * std)
+
+        return self._trims[key]
+
+    def median_trim(self, m=3.):
+        """ (min, max) of the values left after trimming outliers using the
+        scaled median distance method """
+
+        key = ('median', m)
+        if key not in self._trims:
+            values, counts = self.buckets()
+            median = self.median()
+
+            # Median absolute deviation, from the same buckets
+            distance = np.abs(values - median)
+            order = np.argsort(distance, kind='mergesort')
+            cumulative = np.cumsum(counts[order])
+            rank = 0.5 * (self._count - 1)
+            mdev = distance[order][min(np.searchsorted(cumulative, rank, side='right'),
+                                       len(order) - 1)]
+
+            mdev = mdev if mdev else 1.
+            self._trims[key] = self._trimmed_range(median - m * mdev,
+                                                   median + m * mdev)
+
+        return self._trims[key]
+
+    def _trimmed_range(self, lower, upper):
+        if not self._count:
+            return math.nan, math.nan
+
+        values, _ = self.buckets()
+        kept = values[(values > lower) & (values < upper)]
+        if not len(kept):
+            return math.nan, math.nan
+
+        return self._clamp(kept[0]), self._clamp(kept[-1])
+
+    def _value(self, index):
+        # Midpoint of the bucket (gamma^(index-1), gamma^index], which is
+        # within the relative accuracy of every value in the bucket
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def _clamp(self, value):
+        return float(min(max(value, self._min), self._max))
+
+    def _invalidate(self):
+        if self._buckets is not None or self._trims:
+            self._buckets = None
+            self._trims = {}
+
+    @property
+    def relative_accuracy(self):
+        return self._relative_accuracy
@@ -0,0 +1,304 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Streaming reader of an export of historical jobs (i.e. of
+INFORMATION_SCHEMA.JOBS) to replay, as CSV, JSONL or Parquet.
+
+Every record needs a creation time, a statement type and either the text of
+its query or a hash of it; the user and bytes processed are optional. Columns are found under the
+names of INFORMATION_SCHEMA.JOBS or a few common aliases (see COLUMNS).
+Creation times may be timestamps (Parquet), ISO 8601 or BigQuery text
+('2018-06-01 12:00:00.123 UTC') or epoch seconds, milliseconds or
+microseconds.
+
+Records are read one at a time (one row group at a time for Parquet), so the
+size of the export does not matter. Exports are expected in creation time
+order; a bounded buffer puts slightly out of order records back in order, and
+records later than that are replayed immediately and counted as late.
+
+Only SELECT statements are replayed unless other statement types are allowed
+explicitly (--replay-statements), since the jobs of an export also modify
+data (INSERT, DELETE, MERGE) and tables (CREATE, DROP). Records without a
+statement type are skipped and counted as untyped, and so are jobs other than
+queries. The parent jobs of scripts are always skipped: the statements of a
+script are jobs of their own in the export.
+
+Queries are grouped by fingerprint: a hash of their text without comments,
+literals and whitespace differences, so that the executions of the same
+query with different filter values are reported together. A record that only
+has a hash of its query is replayed with the SQL of the query of the query
+file named after that hash, if there is one. """
+
+import os
+import re
+import csv
+import json
+import heapq
+import hashlib
+import datetime
+from collections import namedtuple
+import numpy as np
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# A job to replay: its offset in seconds from the first job, its SQL and
+# fingerprint, its user and the bytes it processed (or None)
+Job = namedtuple('Job', ['offset', 'sql', 'fingerprint', 'user', 'bytes'])
+
+# Field -> accepted column names, the INFORMATION_SCHEMA.JOBS one first
+COLUMNS = {'creation_time': ('creation_time', 'created', 'start_time', 'timestamp'),
+           'query': ('query', 'query_text', 'sql'),
+           'query_hash': ('query_hash', 'query_info.query_hashes.normalized_literals',
+                          'normalized_literals', 'fingerprint'),
+           'statement_type': ('statement_type',),
+           'job_type': ('job_type',),
+           'user': ('user_email', 'user'),
+           'bytes': ('total_bytes_processed', 'total_bytes_billed', 'bytes')}
+
+class JobHistory(object):
+    def __init__(self,
+                 path,
+                 sample=1.0,
+                 users=None,
+                 limit=None,
+                 seed=None,
+                 known=None,
+                 statements=('SELECT',),
+                 reorder=10000):
+
+        self._path = path
+        self._sample = sample
+        self._users = set(users) if users else None
+        self._limit = limit
+        self._seed = seed
+        self._known = known or {}
+        self._statements = {statement.upper() for statement in statements}
+        self._reorder = reorder
+
+        self.read = 0
+        self.skipped = 0
+        self.late = 0
+
+        # Jobs not replayed for their statement type: without one, or of a
+        # type not allowed
+        self.untyped = 0
+        self.excluded = 0
+
+    def __repr__(self):
+        return 'JobHistory(path = {}, sample = {}, users = {})'.format(self._path,
+                                                                      self._sample,
+                                                                      self._users)
+
+    @classmethod
+    def from_options(cls, options, known=None):
+        return cls(path=options['replay_file'],
+                   sample=options.get('replay_sample') or 1.0,
+                   users=options.get('replay_users'),
+                   limit=options.get('replay_limit'),
+                   seed=options.get('seed'),
+                   known=known,
+                   statements=options.get('replay_statements') or ('SELECT',))
+
+    def __iter__(self):
+        """ Yield the Jobs to replay, in creation time order """
+
+        # Every replay of a history samples the same jobs, so that replays at
+        # different speeds (and the projection of their cost) are comparable
+        random_state = np.random.RandomState(self._seed or 0)
+        buffer = []
+        sequence = 0
+        first = None
+        last = None
+        emitted = 0
+
+        for record in self._records():
+            self.read += 1
+
+            job = self._job(record)
+            if job is None:
+                self.skipped += 1
+                continue
+
+            # Sampling draws for every selected job, so that a seeded sample
+            # does not depend on the size of the buffer
+            if self._sample < 1.0 and random_state.random_sample() >= self._sample:
+                continue
+
+            heapq.heappush(buffer, (job[0], sequence, job))
+            sequence += 1
+
+            if len(buffer) > self._reorder:
+                created, _, job = heapq.heappop(buffer)
+                first, last = self._first_last(first, last, created)
+                yield self._offset(job, first, last)
+                emitted += 1
+                if self._limit and emitted >= self._limit:
+                    return
+
+        while buffer:
+            created, _, job = heapq.heappop(buffer)
+            first, last = self._first_last(first, last, created)
+            yield self._offset(job, first, last)
+            emitted += 1
+            if self._limit and emitted >= self._limit:
+                return
+
+    def _first_last(self, first, last, created):
+        if first is None:
+            first = created
+
+        if last is not None and created < last:
+            self.late += 1
+        else:
+            last = created
+
+        return first, last
+
+    @staticmethod
+    def _offset(job, first, last):
+        # Late jobs are replayed at the time of the last job replayed
+        created, sql, fingerprint_, user, total_bytes = job
+        return Job(offset=max(created, last) - first,
+                   sql=sql,
+                   fingerprint=fingerprint_,
+                   user=user,
+                   bytes=total_bytes)
+
+    def _job(self, record):
+        """ (creation time, sql, fingerprint, user, bytes) of a record, or
+        None if it can not be replayed """
+
+        created = _timestamp(_field(record, 'creation_time'))
+        if created is None:
+            return None
+
+        job_type = _field(record, 'job_type')
+        if job_type is not None and str(job_type).upper() != 'QUERY':
+            self.excluded += 1
+            return None
+
+        statement_type = _field(record, 'statement_type')
+        if statement_type is None:
+            self.untyped += 1
+            return None
+
+        statement_type = str(statement_type).upper()
+        if statement_type == 'SCRIPT' or statement_type not in self._statements:
+            self.excluded += 1
+            return None
+
+        user = _field(record, 'user')
+        if self._users is not None and user not in self._users:
+            return None
+
+        sql = _field(record, 'query')
+        query_hash = _field(record, 'query_hash')
+        if sql:
+            query_fingerprint = fingerprint(sql)
+        elif query_hash and str(query_hash) in self._known:
+            query_fingerprint = str(query_hash)
+            sql = self._known[query_fingerprint]
+        else:
+            return None
+
+        total_bytes = _field(record, 'bytes')
+        return (created,
+                sql,
+                query_fingerprint,
+                user,
+                int(total_bytes) if total_bytes not in (None, '') else None)
+
+    def _records(self):
+        _, extension = os.path.splitext(self._path)
+
+        if extension == '.parquet':
+            if pq is None:
+                raise ImportError('Replaying a Parquet export requires pyarrow')
+
+            parquet_file = pq.ParquetFile(self._path)
+            for batch_index in range(parquet_file.num_row_groups):
+                for record in parquet_file.read_row_group(batch_index).to_pylist():
+                    yield record
+        elif extension == '.csv':
+            with open(self._path, newline='') as f:
+                yield from csv.DictReader(f)
+        else:
+            with open(self._path) as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+def fingerprint(sql):
+    """ Hash of the text of a query without its comments, literals and
+    whitespace differences """
+
+    text = re.sub(r'--[^\n]*|#[^\n]*|/\*.*?\*/', ' ', sql, flags=re.S)
+    text = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", '?', text)
+    text = re.sub(r'\b\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b', '?', text)
+    text = re.sub(r'\s*([=<>!(),;+*/-])\s*', r'\1', text)
+    text = re.sub(r'\s+', ' ', text).strip().lower()
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+def _field(record, field):
+    for column in COLUMNS[field]:
+        value = record.get(column)
+
+        # Nested columns of Parquet or JSONL exports, i.e. query_info
+        if value is None and '.' in column:
+            value = record
+            for key in column.split('.'):
+                value = value.get(key) if isinstance(value, dict) else None
+
+        if value not in (None, ''):
+            return value
+
+    return None
+
+def _timestamp(value):
+    """ Epoch seconds of a creation time, or None """
+    if value is None:
+        return None
+
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        number = None
+
+    if number is not None:
+        # Epoch microseconds, milliseconds or seconds
+        if number > 1e14:
+            return number / 1e6
+        if number > 1e11:
+            return number / 1e3
+        return number
+
+    text = str(value).strip()
+    if text.endswith(' UTC'):
+        text = text[:-4] + '+00:00'
+    elif text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+
+    try:
+        return _timestamp(datetime.datetime.fromisoformat(text))
+    except ValueError:
+        return None
@@ -0,0 +1,293 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Single poller of the status of every job in flight in a Scenario
+(--polling=batch), in place of one polling loop per thread (--polling=per_job,
+the default).
+
+Every poll lists the pending and the running jobs of the project created by
+the caller since the oldest tracked job (less a margin for clock skew), one
+API call per page of jobs whatever the number of jobs in flight. A tracked
+job in neither list has completed: it is reloaded once, for its final state
+and statistics, and its future is completed as soon as its reload returns.
+Reloads run concurrently, reload_threads at a time, so that completions do not
+wait in line behind each other. A job whose reload keeps failing
+(i.e. NotFound for the wrong location) fails with the error of its last
+reload after MAX_RELOAD_FAILURES polls, and waits for a job time out after
+timeout seconds, so that a job the poller can not follow never hangs its
+Trial. The interval between polls adapts
+between a minimum and a maximum: it halves whenever a poll finds completed
+jobs, and grows by half when none did.
+
+The poller counts its API calls per completed job, and the delay between the
+end of each job (its server side 'ended' timestamp) and the time the poller
+reported it done, which is the latency error due to polling.
+
+With shards (see Shards), every poll lists the jobs of the client of every
+shard, as each only lists the jobs of its own project. """
+
+import time
+import asyncio
+import datetime
+import threading
+import concurrent.futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from Histogram import Histogram
+
+# States listed by every poll; any other state is DONE
+LISTED_STATES = ('pending', 'running')
+
+# Consecutive failed reloads after which a job fails
+MAX_RELOAD_FAILURES = 5
+
+# Seconds listed before the creation of the oldest tracked job, for the skew
+# between the clocks of this host and of the service
+CLOCK_SKEW = 60.0
+
+# Seconds to wait for a job by default: BigQuery jobs time out after 6 hours
+WAIT_TIMEOUT = 6 * 3600 + 600
+
+# Reloads of completed jobs in flight at a time
+RELOAD_THREADS = 16
+
+class JobPoller(object):
+    def __init__(self,
+                 bq_client,
+                 min_interval=0.1,
+                 max_interval=0.5,
+                 other_clients=(),
+                 timeout=WAIT_TIMEOUT,
+                 reload_threads=RELOAD_THREADS):
+
+        self._bq_client = bq_client
+
+        # Clients of the other shards, without duplicates of shards sharing
+        # a client
+        self._clients = [bq_client]
+        for client in other_clients:
+            if all(client is not known for known in self._clients):
+                self._clients.append(client)
+        self._min_interval = min(min_interval, max_interval)
+        self._max_interval = max_interval
+        self._interval = self._min_interval
+        self._timeout = timeout
+        self._reload_threads = reload_threads
+        self._executor = None
+
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._registered = {}
+        self._reload_failures = {}
+        self._stopped = False
+        self._thread = None
+
+        self._polls = 0
+        self._api_calls = 0
+        self._completed = 0
+        self._poll_errors = 0
+        self._poll_delay = Histogram()
+
+    def __repr__(self):
+        return 'JobPoller(interval = {}s..{}s, jobs = {})'.format(self._min_interval,
+                                                                 self._max_interval,
+                                                                 len(self._jobs))
+
+    @classmethod
+    def from_options(cls, options, bq_client, other_clients=()):
+        return cls(bq_client=bq_client,
+                   min_interval=options.get('poll_min_interval', 0.1),
+                   max_interval=options.get('poll_interval', 0.5),
+                   other_clients=other_clients)
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self._reload_threads)
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop polling; jobs still tracked fail with a RuntimeError """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        if self._executor is not None:
+            self._executor.shutdown()
+
+        for _, future in self._jobs.values():
+            future.set_exception(RuntimeError('Job poller stopped'))
+        self._jobs = {}
+        self._registered = {}
+        self._reload_failures = {}
+
+    def register(self, query_job):
+        """ Track a job, return a Future completed once the job is done """
+        future = Future()
+
+        with self._condition:
+            # Only a loop idle without jobs is woken up: otherwise the job
+            # waits for the next poll, at the adaptive interval
+            idle = not self._jobs
+            self._jobs[query_job.job_id] = (query_job, future)
+            self._registered[query_job.job_id] = time.time()
+            if idle:
+                self._condition.notify()
+
+        return future
+
+    def wait(self, query_job):
+        """ Block until a job is done, or raise a TimeoutError after the
+        timeout of the poller """
+        future = self.register(query_job)
+        try:
+            future.result(self._timeout)
+        except concurrent.futures.TimeoutError:
+            self._forget(query_job.job_id)
+            raise
+
+    async def wait_async(self, query_job):
+        """ Wait for a job to be done on the event loop, as wait() does """
+        future = self.register(query_job)
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(future), self._timeout)
+        except asyncio.TimeoutError:
+            self._forget(query_job.job_id)
+            raise
+
+    def _forget(self, job_id):
+        with self._condition:
+            self._jobs.pop(job_id, None)
+            self._registered.pop(job_id, None)
+            self._reload_failures.pop(job_id, None)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._jobs and not self._stopped:
+                    self._condition.wait()
+
+                if self._stopped:
+                    return
+
+                # Jobs registered while the lists are read wait for the next
+                # poll, as they may not be listed yet
+                jobs = dict(self._jobs)
+
+            try:
+                completed = self._poll(jobs)
+            except Exception as e:
+                self._poll_errors += 1
+                print('Job poller generated exception: {}'.format(repr(e)))
+                completed = []
+
+            if completed:
+                self._interval = max(self._min_interval, self._interval / 2)
+            else:
+                self._interval = min(self._max_interval, self._interval * 1.5)
+
+            with self._condition:
+                if not self._stopped:
+                    self._condition.wait(self._interval)
+
+    def _poll(self, jobs):
+        """ Complete the futures of the jobs that are done, return their ids """
+
+        self._polls += 1
+
+        # Only the jobs of the caller (the default of list_jobs) created since
+        # the oldest tracked job are listed, rather than every job in flight
+        # in the project
+        with self._condition:
+            oldest = min((self._registered[job_id] for job_id in jobs
+                          if job_id in self._registered), default=time.time())
+        since = datetime.datetime.fromtimestamp(oldest - CLOCK_SKEW,
+                                                tz=datetime.timezone.utc)
+
+        in_flight = set()
+        for client in self._clients:
+            for state in LISTED_STATES:
+                for page in client.list_jobs(state_filter=state,
+                                             min_creation_time=since).pages:
+                    self._api_calls += 1
+                    in_flight.update(job.job_id for job in page)
+
+        # A job that has only just been created may not be listed yet, so
+        # its state is confirmed by a reload before it is reported done
+        reloads = [self._executor.submit(self._confirm, job_id, query_job, future)
+                   for job_id, (query_job, future) in jobs.items()
+                   if job_id not in in_flight]
+        self._api_calls += len(reloads)
+
+        return [job_id for job_id in (reload.result() for reload in reloads)
+                if job_id is not None]
+
+    def _confirm(self, job_id, query_job, future):
+        """ Reload a job missing from the lists, complete its future if it is
+        done and return its id, or None. A failed reload only fails the job it
+        was for. """
+        try:
+            query_job.reload()
+        except Exception as e:
+            with self._condition:
+                self._poll_errors += 1
+                failures = self._reload_failures.get(job_id, 0) + 1
+                self._reload_failures[job_id] = failures
+            if failures >= MAX_RELOAD_FAILURES:
+                self._forget(job_id)
+                future.set_exception(e)
+            return None
+
+        with self._condition:
+            self._reload_failures.pop(job_id, None)
+        if query_job.state != 'DONE':
+            return None
+
+        observed = time.time()
+        self._forget(job_id)
+
+        with self._condition:
+            if query_job.ended:
+                self._poll_delay.record(max(0.0, observed - query_job.ended.timestamp()))
+            self._completed += 1
+
+        future.set_result(query_job)
+        return job_id
+
+    def stats(self):
+        return {'polls': self._polls,
+                'api_calls': self._api_calls,
+                'completed': self._completed,
+                'poll_errors': self._poll_errors,
+                'api_calls_per_query': (self._api_calls / self._completed
+                                        if self._completed else None),
+                'poll_delay_mean': (self._poll_delay.mean()
+                                    if self._poll_delay else None),
+                'poll_delay_p95': (self._poll_delay.percentile(95)
+                                   if self._poll_delay else None)}
+
+    def report(self):
+        stats = self.stats()
+        if not stats['completed']:
+            return
+
+        print(('-- Job poller: jobs = {}, polls = {}, API calls = {} '
+               '({:0.2f} per query), poll delay mean = {:0.3f}s, p95 = {:0.3f}s')
+              .format(stats['completed'],
+                      stats['polls'],
+                      stats['api_calls'],
+                      stats['api_calls_per_query'],
+                      stats['poll_delay_mean'] or 0.0,
+                      stats['poll_delay_p95'] or 0.0))
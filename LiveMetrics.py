@@ -0,0 +1,290 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Live metrics of a running Experiment, over a sliding window of the last
+few seconds: jobs in flight, completions and errors per second, p50/p95
+response times, slot-ms and bytes processed per second.
+
+Trials only append an event to a deque for every sample started, completed
+or failed, which is atomic and takes no lock. A reporter thread drains the
+events every interval into one bucket of counters and a Histogram of
+response times per interval, and the window is the last buckets, merged.
+Every interval, the reporter prints a console line (--live), appends the
+snapshot to a JSONL log (--metrics-log), and keeps it for a local HTTP
+endpoint serving /metrics in the Prometheus text format (--metrics-port).
+
+Metrics cover the scenarios run by this process: the Workers of a
+distributed experiment do not report any. """
+
+import json
+import time
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Histogram import Histogram
+
+# Kinds of events recorded by Trials
+STARTED = 0
+COMPLETED = 1
+FAILED = 2
+
+# Snapshot fields exposed on /metrics, and their Prometheus type
+GAUGES = ('in_flight',
+          'completed_per_second',
+          'errors_per_second',
+          'response_time_p50',
+          'response_time_p95',
+          'slot_millis_per_second',
+          'mbytes_per_second')
+
+COUNTERS = ('completed_total',
+            'errors_total')
+
+class LiveMetrics(object):
+    def __init__(self,
+                 interval=5.0,
+                 window=60.0,
+                 console=True,
+                 log_path=None,
+                 port=None):
+
+        self._interval = interval
+        self._window = max(window, interval)
+        self._console = console
+        self._log_path = log_path
+        self._port = port
+
+        self._events = deque()
+        self._buckets = deque(maxlen=max(1, int(round(self._window / interval))))
+
+        self._in_flight = 0
+        self._completed = 0
+        self._errors = 0
+        self._scenario = None
+        self._snapshot = None
+
+        self._stopped = threading.Event()
+        self._thread = None
+        self._log = None
+        self._server = None
+        self._start = None
+
+    def __repr__(self):
+        return 'LiveMetrics(interval = {}s, window = {}s, port = {})'.format(self._interval,
+                                                                          self._window,
+                                                                          self._port)
+
+    @classmethod
+    def from_options(cls, options):
+        """ LiveMetrics of the options, or None if none are requested """
+        if not (options.get('live') or options.get('metrics_log')
+                or options.get('metrics_port')):
+            return None
+
+        return cls(interval=options.get('live_interval') or 5.0,
+                   window=options.get('live_window') or 60.0,
+                   console=bool(options.get('live')) and not options.get('quiet'),
+                   log_path=options.get('metrics_log'),
+                   port=options.get('metrics_port'))
+
+    def start(self):
+        self._start = time.perf_counter()
+
+        if self._log_path:
+            self._log = open(self._log_path, 'a')
+
+        if self._port:
+            self._server = ThreadingHTTPServer(('localhost', self._port),
+                                               self._handler())
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            print('- Serving live metrics on http://localhost:{}/metrics'.format(
+                self._server.server_address[1]))
+
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop reporting, after a last snapshot of the events so far """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+        if self._log is not None:
+            self._log.close()
+
+    def scenario(self, index, label):
+        """ Set the scenario the following events belong to """
+        self._scenario = (index, label)
+
+    # Hot path: called by Trials, from any thread or the event loop
+
+    def started(self):
+        self._events.append((STARTED,))
+
+    def completed(self, response_time, slot_millis=0, total_bytes=0):
+        self._events.append((COMPLETED, response_time, slot_millis or 0, total_bytes or 0))
+
+    def failed(self, error_class):
+        self._events.append((FAILED, error_class))
+
+    # Reporter thread
+
+    def _loop(self):
+        while not self._stopped.wait(self._interval):
+            self._tick()
+
+        self._tick()
+
+    def _tick(self):
+        bucket = {'completed': 0,
+                  'errors': 0,
+                  'slot_millis': 0.0,
+                  'bytes': 0.0,
+                  'response_time': Histogram()}
+
+        while True:
+            try:
+                event = self._events.popleft()
+            except IndexError:
+                break
+
+            if event[0] == STARTED:
+                self._in_flight += 1
+            elif event[0] == COMPLETED:
+                self._in_flight -= 1
+                bucket['completed'] += 1
+                bucket['response_time'].record(event[1])
+                bucket['slot_millis'] += event[2]
+                bucket['bytes'] += event[3]
+            else:
+                self._in_flight -= 1
+                bucket['errors'] += 1
+
+        self._completed += bucket['completed']
+        self._errors += bucket['errors']
+        self._buckets.append(bucket)
+
+        self._snapshot = self._summarize()
+
+        if self._console:
+            self._print(self._snapshot)
+
+        if self._log is not None:
+            self._log.write(json.dumps(self._snapshot) + '\n')
+            self._log.flush()
+
+    def _summarize(self):
+        """ Snapshot of the window, as a dict """
+        elapsed = time.perf_counter() - self._start
+
+        # The window is shorter than configured until it has filled up
+        span = min(len(self._buckets) * self._interval, max(elapsed, self._interval))
+
+        response_times = Histogram()
+        for bucket in self._buckets:
+            response_times.merge(bucket['response_time'])
+
+        def rate(field):
+            return sum(bucket[field] for bucket in self._buckets) / span
+
+        index, label = self._scenario or (None, None)
+        return {'time': time.time(),
+                'elapsed': elapsed,
+                'scenario': index,
+                'label': label,
+                'window': span,
+                'in_flight': self._in_flight,
+                'completed_per_second': rate('completed'),
+                'errors_per_second': rate('errors'),
+                'response_time_p50': (response_times.percentile(50)
+                                      if response_times.count else None),
+                'response_time_p95': (response_times.percentile(95)
+                                      if response_times.count else None),
+                'slot_millis_per_second': rate('slot_millis'),
+                'mbytes_per_second': rate('bytes') / 1024 / 1024,
+                'completed_total': self._completed,
+                'errors_total': self._errors}
+
+    @staticmethod
+    def _print(snapshot):
+        def seconds(value):
+            return '-' if value is None else '{:0.2f}s'.format(value)
+
+        print(('-- Live {:0.0f}s: in flight = {}, completed = {:0.2f}/s, '
+               'errors = {:0.2f}/s, p50 = {}, p95 = {}, slot-ms = {:,.0f}/s, '
+               'MB = {:,.1f}/s')
+              .format(snapshot['elapsed'],
+                      snapshot['in_flight'],
+                      snapshot['completed_per_second'],
+                      snapshot['errors_per_second'],
+                      seconds(snapshot['response_time_p50']),
+                      seconds(snapshot['response_time_p95']),
+                      snapshot['slot_millis_per_second'],
+                      snapshot['mbytes_per_second']))
+
+    def exposition(self):
+        """ The latest snapshot in the Prometheus text format """
+        snapshot = self._snapshot
+        if snapshot is None:
+            return ''
+
+        labels = ''
+        if snapshot['label'] is not None:
+            labels = '{{scenario="{}"}}'.format(snapshot['label'].replace('"', '\\"'))
+
+        # Gauges are labelled with the current scenario, counters run over
+        # the whole experiment
+        lines = []
+        for fields, metric_type, field_labels in ((GAUGES, 'gauge', labels),
+                                                  (COUNTERS, 'counter', '')):
+            for field in fields:
+                if snapshot[field] is None:
+                    continue
+
+                name = 'bq_parallel_{}'.format(field)
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                lines.append('{}{} {}'.format(name, field_labels, snapshot[field]))
+
+        return '\n'.join(lines) + '\n'
+
+    def _handler(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+
+                body = metrics.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would otherwise be logged on stderr
+                pass
+
+        return Handler
+
+    @property
+    def snapshot(self):
+        return self._snapshot
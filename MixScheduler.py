@@ -0,0 +1,128 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Turn the weights of a QuerySet into a reproducible query mix.
+
+Threads of a closed-loop Scenario are either split between queries with the
+largest remainder method (deterministic), or drawn one by one with weighted
+random draws from a seed. Open-loop arrivals are always weighted draws. Queries
+may set a 'max_concurrency' option, which caps the number of threads allocated
+to them; the threads they cannot take are shared between the other queries. """
+
+import numpy as np
+
+class MixScheduler(object):
+    def __init__(self,
+                 queries,
+                 seed=None):
+
+        self._queries = list(queries)
+        self._seed = seed
+        self._weights = np.array([query.weight for query in self._queries],
+                                 dtype=float)
+
+        if not len(self._queries) or self._weights.sum() <= 0:
+            raise ValueError('Query weights must add up to more than zero')
+
+    def __repr__(self):
+        return 'MixScheduler(mix = {}, seed = {})'.format(self.intended_mix(),
+                                                          self._seed)
+
+    def intended_mix(self):
+        """ Return {query name: share of the total weight} """
+        shares = self._weights / self._weights.sum()
+        return {query.name: float(share)
+                for query, share in zip(self._queries, shares)}
+
+    def allocate(self, threads, mode='split'):
+        """ Return the query to run on each of (up to) threads threads """
+
+        if mode == 'split':
+            counts = self._split(threads)
+        elif mode == 'draw':
+            counts = self._draw_threads(threads)
+        else:
+            raise ValueError('Unknown query mix mode: {}'.format(mode))
+
+        allocation = []
+        for query, count in zip(self._queries, counts):
+            allocation.extend([query] * int(count))
+
+        if len(allocation) < threads:
+            print(('--- Warning: max_concurrency caps only allow {} of {} '
+                   'threads to be allocated').format(len(allocation), threads))
+
+        return allocation
+
+    def draw(self, count):
+        """ Return the indexes of count queries drawn according to the
+        weights, e.g. one per open-loop arrival """
+        random_state = np.random.RandomState(self._seed)
+        return random_state.choice(len(self._queries),
+                                   size=count,
+                                   p=self._weights / self._weights.sum())
+
+    def cap(self, query):
+        return query.options.get('max_concurrency')
+
+    def _split(self, threads):
+        """ Largest remainder split of threads according to the weights,
+        honouring caps. Ties are broken by the order of the queries. """
+
+        caps = np.array([self.cap(query) or np.inf for query in self._queries])
+        counts = np.zeros(len(self._queries), dtype=int)
+        open_queries = np.ones(len(self._queries), dtype=bool)
+        remaining = threads
+
+        # Capped queries are fixed at their cap and the remaining threads are
+        # split again between the others, until no allocation exceeds a cap
+        while remaining > 0 and open_queries.any():
+            weights = np.where(open_queries, self._weights, 0)
+            if weights.sum() <= 0:
+                break
+
+            quotas = remaining * weights / weights.sum()
+            split = np.floor(quotas).astype(int)
+            leftover = remaining - split.sum()
+            order = np.argsort(-(quotas - split), kind='mergesort')
+            split[order[:leftover]] += 1
+
+            over = open_queries & (counts + split > caps)
+            if not over.any():
+                counts += split
+                break
+
+            capped = caps[over].astype(int) - counts[over]
+            counts[over] += capped
+            remaining -= capped.sum()
+            open_queries &= ~over
+
+        return counts
+
+    def _draw_threads(self, threads):
+        random_state = np.random.RandomState(self._seed)
+        caps = [self.cap(query) or np.inf for query in self._queries]
+        counts = np.zeros(len(self._queries), dtype=int)
+        weights = self._weights.copy()
+
+        for _ in range(threads):
+            if weights.sum() <= 0:
+                break
+
+            index = random_state.choice(len(weights), p=weights / weights.sum())
+            counts[index] += 1
+            if counts[index] >= caps[index]:
+                weights[index] = 0
+
+        return counts
@@ -0,0 +1,244 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Open-loop Scenario, in which queries are dispatched at a target arrival
+rate for a fixed duration, regardless of how long earlier queries take to
+complete """
+
+import time
+import asyncio
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from AsyncScenario import AsyncScenario
+from Scenario import Scenario
+from Trial import Trial
+from MixScheduler import MixScheduler
+from SteadyWindow import SteadyWindow
+
+class OpenLoopScenario(AsyncScenario):
+    # Open-loop samples always have an intended (scheduled) send time
+    SERIES = Scenario.SERIES + ('corrected_response_time',
+                                'dispatch_delay',
+                                'in_flight')
+    PACED_SERIES = ()
+    COLUMNS = AsyncScenario.COLUMNS + ('target_rate', 'achieved_rate')
+
+    def __init__(self,
+                 rate,
+                 duration,
+                 queries,
+                 options,
+                 client_pool,
+                 arrivals='poisson',
+                 seed=None,
+                 sink=None,
+                 index=0,
+                 meter=None,
+                 metrics=None,
+                 store=None):
+
+        super().__init__(threads=None,
+                         samples=None,
+                         queries=queries,
+                         options=options,
+                         client_pool=client_pool,
+                         sink=sink,
+                         index=index,
+                         meter=meter,
+                         metrics=metrics,
+                         store=store)
+
+        self._rate = rate
+        self._duration = duration
+        self._arrivals = arrivals
+        self._seed = seed
+        self._in_flight = 0
+        self._dispatched = 0
+        self._caps = {}
+
+        # Only a warm-up or cool-down restricts statistics to a steady-state
+        # window; otherwise every arrival counts, including the stragglers
+        # completing after the end of the schedule
+        if options.get('warmup') or options.get('cooldown'):
+            self._window = SteadyWindow(duration=duration,
+                                        warmup=options.get('warmup') or 0.0,
+                                        cooldown=options.get('cooldown') or 0.0)
+            self.COLUMNS = self.COLUMNS + self.WINDOW_COLUMNS
+
+    def __repr__(self):
+        return ' '.join(['OpenLoopScenario(rate = {}/s,',
+                         'duration = {}s,',
+                         'arrivals = {},',
+                         'num. queries = {})']).format(self._rate,
+                                                       self._duration,
+                                                       self._arrivals,
+                                                       len(self._queries))
+
+    def _announce(self):
+        print(('--- Starting open-loop scenario with rate = {}/s, '
+               'duration = {}s, arrivals = {}, use_query_cache = {}')
+              .format(self._rate,
+                      self._duration,
+                      self._arrivals,
+                      self._options['use_cache']))
+
+    def column_values(self):
+        values = super().column_values()
+        values.update({'target_rate': self._rate,
+                       'achieved_rate': self._dispatched / self._duration})
+        return values
+
+    def schedule(self):
+        """ Return the arrival offsets (in seconds from the scenario start) and
+        the index of the query to dispatch at each of them. The whole schedule
+        is computed up front, so the dispatcher only has to sleep and launch """
+
+        random_state = np.random.RandomState(self._seed)
+        expected = self._rate * self._duration
+
+        if self._arrivals == 'constant':
+            offsets = np.arange(int(expected)) / self._rate
+        elif self._arrivals == 'poisson':
+            # Draw comfortably more exponential inter-arrival gaps than needed
+            # and drop the ones that land beyond the end of the scenario
+            count = int(expected + 6 * np.sqrt(expected) + 10)
+            offsets = np.cumsum(random_state.exponential(1 / self._rate,
+                                                         size=count))
+            offsets = offsets[offsets < self._duration]
+        else:
+            raise ValueError('Unknown arrival process: {}'.format(self._arrivals))
+
+        # Arrivals are shared between queries by weighted draws
+        scheduler = MixScheduler(queries=self._queries,
+                                 seed=self._seed)
+
+        return offsets, scheduler.draw(len(offsets))
+
+    def _build_trials(self):
+        # One Trial per query (and shard) accumulates the samples of every
+        # arrival of that query; a Trial is never run in a loop of its own here
+        shards = [shard.name for shard in self._shards] if self._shards else [None]
+        pairs = [(query, shard) for query in self._queries for shard in shards]
+        return [Trial(query=query,
+                      options=self._options,
+                      samples=0,
+                      bq_client=self._get_client(shard),
+                      sink=self._sink,
+                      tags={'scenario': self._index},
+                      window=self._window,
+                      poller=self._poller,
+                      meter=self._meter,
+                      metrics=self._metrics,
+                      shard=shard,
+                      store=self._store,
+                      thread=thread)
+                for thread, (query, shard) in enumerate(pairs)]
+
+    def _execute(self, trials):
+        io_threads = self._options['io_threads']
+
+        with ThreadPoolExecutor(max_workers=io_threads) as executor:
+            asyncio.get_event_loop().run_until_complete(
+                self._dispatch(trials, executor))
+
+        response_results = {}
+        for trial in trials:
+            for query_name, (series, errors, retries) in trial.results().items():
+                if series['response_time'].count:
+                    self._add_series(response_results, query_name, series, errors, retries)
+                    response_results[query_name].concurrency = int(series['in_flight'].max())
+                elif errors:
+                    self._add_series(response_results, query_name, series, errors, retries)
+                    response_results[query_name].concurrency = 0
+
+        return response_results
+
+    async def _dispatch(self, trials, executor):
+        """ Launch every arrival at its scheduled time without waiting for
+        earlier ones, and wait for the stragglers once the schedule is done """
+
+        loop = asyncio.get_event_loop()
+        offsets, query_indexes = self.schedule()
+        pending = set()
+
+        # Trials are by query, then by shard
+        width = len(self._shards) if self._shards else 1
+        positions = {shard.name: position
+                     for position, shard in enumerate(self._shards or [])}
+        shards = self._assign_shards(len(offsets))
+
+        # Arrivals of a query capped by max_concurrency queue for a free slot;
+        # the wait is included in their corrected response time
+        self._caps = {trial.query.name: asyncio.Semaphore(trial.query.options['max_concurrency'])
+                      for trial in trials
+                      if trial.query.options.get('max_concurrency')}
+
+        self._in_flight = 0
+        self._dispatched = 0
+
+        start = time.perf_counter()
+        if self._window:
+            self._window.start(start)
+
+        for offset, query_index, shard in zip(offsets, query_indexes, shards):
+            # Arrivals stop once the --max-cost budget is reached
+            if self._meter.exhausted:
+                break
+
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            trial = trials[query_index * width + positions.get(shard, 0)]
+            task = loop.create_task(self._sample(trial,
+                                                 executor,
+                                                 scheduled))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.wait(pending)
+
+    async def _sample(self, trial, executor, scheduled):
+        self._dispatched += 1
+
+        cap = self._caps.get(trial.query.name)
+        if cap:
+            await cap.acquire()
+
+        self._in_flight += 1
+        try:
+            await trial.sample_async(executor=executor,
+                                     poll_interval=self._options['poll_interval'],
+                                     intended=scheduled,
+                                     in_flight=self._in_flight)
+        except Exception as e:
+            print('Query "{}" generated exception: {}'
+                  .format(trial.query.name, repr(e)))
+        finally:
+            self._in_flight -= 1
+            if cap:
+                cap.release()
+
+    @property
+    def label(self):
+        if self._window:
+            return '{}/s {} arrivals for {}'.format(self._rate,
+                                                    self._arrivals,
+                                                    self._window.label)
+
+        return '{}/s {} arrivals for {}s'.format(self._rate,
+                                                 self._arrivals,
+                                                 self._duration)
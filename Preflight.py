@@ -0,0 +1,289 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Pre-flight stage of an Experiment: dry-run every query, project the cost
+of the whole experiment from its scenario plan, and refuse to start one that
+would cost more than --max-cost.
+
+Dry runs are free and run in parallel. Their estimates are kept in a local
+cache file, keyed by a hash of the backend, the SQL and the query parameters,
+so that repeated experiments only dry-run new or changed queries; entries
+older than max_age are refreshed, as tables grow. Templated queries are
+dry-run for their first few bindings, and estimated by the mean of them.
+
+Estimates are of bytes billed: bytes processed rounded up to the MB, with a
+minimum of 10 MB per query. The projection is the estimate of every query
+times the samples the plan will take of it, which is only known for
+closed-loop scenarios of a number of samples and for open-loop ones (their
+expected number of arrivals). Duration-based closed-loop scenarios and
+the bisection steps of a saturation search are not projected, but remain
+bounded by the running CostMeter. A query without an estimate, i.e. whose
+dry run failed, makes the projection unknown rather than free, and an
+experiment with a budget then refuses to start.
+
+Replays (see ReplayScenario) are not dry-run: their jobs are estimated from
+the bytes they processed originally, read from the history in one pass. """
+
+import os
+import json
+import math
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from MixScheduler import MixScheduler
+from JobHistory import JobHistory
+from Pricing import COST_PER_MB, MIN_MBYTES_BILLED
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'bq_parallel',
+                             'dry_run_cache.json')
+
+class BudgetExceeded(Exception):
+    """ The projected cost of an experiment is over its budget """
+    pass
+
+class Preflight(object):
+    def __init__(self,
+                 queries,
+                 options,
+                 backend,
+                 cache_path=DEFAULT_CACHE,
+                 max_age=24 * 3600,
+                 threads=8,
+                 bindings=3):
+
+        self._queries = queries
+        self._options = options
+        self._backend = backend
+        self._cache_path = cache_path
+        self._max_age = max_age
+        self._threads = threads
+        self._bindings = bindings
+
+        self._estimates = {}
+        self._failures = {}
+        self._unknown = []
+        self._cached = 0
+        self._dry_runs = 0
+
+    def __repr__(self):
+        return 'Preflight(queries = {}, cache = {})'.format(len(self._queries),
+                                                           self._cache_path)
+
+    @classmethod
+    def from_options(cls, queries, options, backend):
+        return cls(queries=queries,
+                   options=options,
+                   backend=backend,
+                   cache_path=options.get('preflight_cache') or DEFAULT_CACHE)
+
+    def run(self):
+        """ Estimate the MB billed by a sample of every query, return
+        {query name: MB billed} """
+
+        tasks = [(query, binding) for query in self._queries
+                 for binding in self._query_bindings(query)]
+        keys = [self._key(query, binding) for query, binding in tasks]
+
+        cache = self._load()
+        now = time.time()
+        stale = [position for position, key in enumerate(keys)
+                 if key not in cache or now - cache[key]['time'] > self._max_age]
+        self._cached = len(tasks) - len(stale)
+
+        if stale:
+            client = self._backend.client()
+            with ThreadPoolExecutor(max_workers=min(self._threads, len(stale))) as executor:
+                outcomes = list(executor.map(
+                    lambda position: self._dry_run(client, *tasks[position]),
+                    stale))
+
+            for position, (total_bytes, error) in zip(stale, outcomes):
+                if error is not None:
+                    self._failures[tasks[position][0].name] = error
+                else:
+                    cache[keys[position]] = {'bytes': total_bytes, 'time': now}
+
+            self._dry_runs = len(stale)
+            self._save(cache)
+
+        mbytes = {}
+        for (query, _), key in zip(tasks, keys):
+            if query.name not in self._failures and key in cache:
+                mbytes.setdefault(query.name, []).append(_billed(cache[key]['bytes']))
+
+        self._estimates = {query_name: sum(values) / len(values)
+                           for query_name, values in mbytes.items()}
+        return self._estimates
+
+    def _query_bindings(self, query):
+        if query.template is None:
+            return [None]
+
+        return query.template.bindings[:self._bindings]
+
+    def _key(self, query, binding):
+        text = json.dumps([self._options.get('backend'),
+                           query.sql if binding is None else binding.sql,
+                           [] if binding is None else binding.parameters],
+                          default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _dry_run(client, query, binding):
+        """ Return (bytes processed, None) or (None, error) """
+        try:
+            query_job = query.execute(client, binding, dry_run=True)
+            return query_job.total_bytes_processed or 0, None
+        except Exception as e:
+            return None, repr(e)
+
+    def _load(self):
+        try:
+            with open(self._cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, cache):
+        # Written to a temporary file first, so that concurrent experiments
+        # never read a partial cache
+        directory = os.path.dirname(self._cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        temporary_path = '{}.{}.tmp'.format(self._cache_path, os.getpid())
+        with open(temporary_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temporary_path, self._cache_path)
+
+    def project(self, values, samples):
+        """ Return ({query name: projected samples}, projected cost) of the
+        scenarios of values, or (None, None) if they can not be projected.
+        The cost is None if a query to run has no estimate (see unknown) """
+
+        if self._options['load'] == 'replay':
+            return self._project_replay(values)
+
+        if self._options['load'] != 'open' and self._options.get('duration'):
+            return None, None
+
+        scheduler = MixScheduler(queries=self._queries,
+                                 seed=self._options['seed'])
+        counts = {query.name: 0 for query in self._queries}
+
+        for value in values:
+            if self._options['load'] == 'open':
+                expected = value * self._options['duration']
+                for query_name, share in scheduler.intended_mix().items():
+                    counts[query_name] += expected * share
+            else:
+                for query in scheduler.allocate(value, mode=self._options['mix']):
+                    counts[query.name] += samples
+
+        return counts, self._cost(counts)
+
+    def _project_replay(self, speeds):
+        """ Project the replays of the history at every speed, and estimate
+        every fingerprint by the mean MB billed by its jobs """
+
+        history = JobHistory.from_options(self._options,
+                                          known={query.name: query.sql
+                                                 for query in self._queries})
+        duration = self._options.get('duration')
+
+        counts = {}
+        mbytes = {}
+        for job in history:
+            replays = sum(1 for speed in speeds
+                          if not duration or job.offset / speed <= duration)
+            counts[job.fingerprint] = counts.get(job.fingerprint, 0) + replays
+
+            if job.bytes is not None:
+                total, jobs = mbytes.get(job.fingerprint, (0.0, 0))
+                mbytes[job.fingerprint] = (total + _billed(job.bytes), jobs + 1)
+
+        self._estimates = {fingerprint: total / jobs
+                           for fingerprint, (total, jobs) in mbytes.items()}
+
+        return counts, self._cost(counts)
+
+    def _cost(self, counts):
+        """ Projected cost of counts samples of every query, or None if any of
+        them has no estimate """
+        self._unknown = [query_name for query_name, count in counts.items()
+                         if count and query_name not in self._estimates]
+        if self._unknown:
+            return None
+
+        return sum(count * self._estimates[query_name] * COST_PER_MB
+                   for query_name, count in counts.items() if count)
+
+    def report(self, counts=None, cost=None):
+        print('- Pre-flight: {} dry runs, {} cached estimates'.format(self._dry_runs,
+                                                                     self._cached))
+
+        for query in self._queries:
+            if query.name not in self._estimates and query.name not in self._failures:
+                continue
+
+            if query.name in self._failures:
+                print('-- Query "{}": dry run failed: {}'.format(
+                    query.name,
+                    self._failures[query.name]))
+                continue
+
+            mbytes = self._estimates.get(query.name, 0.0)
+            line = '-- Query "{}": {:,.1f} MB billed per sample (${:0.5f})'.format(
+                query.name,
+                mbytes,
+                mbytes * COST_PER_MB)
+
+            if counts is not None:
+                line += ', {:,.0f} samples projected'.format(counts.get(query.name, 0))
+
+            print(line)
+
+        if self._options['load'] == 'replay' and counts is not None:
+            print('-- {:,} replayed jobs of {:,} fingerprints projected from the history'
+                  .format(sum(counts.values()), len(counts)))
+
+        if self._unknown:
+            print('- Projected cost: unknown, no estimate of {:,} of {:,} queries'
+                  .format(len(self._unknown), len(counts)))
+        elif cost is None:
+            print('- Projected cost: unknown for duration-based scenarios')
+        else:
+            print('- Projected cost: ${:,.4f}'.format(cost))
+
+    def costs(self):
+        """ Estimated cost of a sample of every query, for the CostMeter """
+        return {query_name: mbytes * COST_PER_MB
+                for query_name, mbytes in self._estimates.items()}
+
+    @property
+    def unknown(self):
+        """ Names of the queries of the last projection without an estimate """
+        return self._unknown
+
+    @property
+    def failures(self):
+        """ Queries whose dry run failed, and their error """
+        return self._failures
+
+def _billed(total_bytes):
+    """ MB billed for a query processing total_bytes """
+    if not total_bytes:
+        return 0.0
+
+    return float(max(math.ceil(total_bytes / 1024 / 1024), MIN_MBYTES_BILLED))
@@ -0,0 +1,22 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" On-demand BigQuery pricing, shared by the Trials metering their samples,
+the pre-flight projection and the simulated backend """
+
+# Cost of a MB billed, at $5 per TB
+COST_PER_MB = 5 / (1024**2)
+
+# BigQuery bills at least 10 MB per query
+MIN_MBYTES_BILLED = 10
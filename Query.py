@@ -14,32 +14,69 @@
 
 """ Query wrapper class """
 
-from google.cloud import bigquery
+from Backend import get_backend
+from ResultFetcher import ResultFetcher
+from QueryTemplate import QueryTemplate, normalize
 
 class Query(object):
     def __init__(self,
                  name,
                  options,
-                 sql):
+                 sql,
+                 weight=1,
+                 template=None):
 
         self._name = name
         self._options = options
         self._sql = sql
+        self._weight = weight
+        self._backend = get_backend(options)
+
+        # Templated queries are bound to a different set of parameter values
+        # by every sample (see QueryTemplate)
+        self._template_spec = None
+        self._template = None
+        if template:
+            self._template_spec = normalize(template)
+            self._template = QueryTemplate.from_spec(sql, self._template_spec,
+                                                     seed=options.get('seed'))
+
+        # How results are read once the job completes (see ResultFetcher)
+        self._fetcher = ResultFetcher(mode=options.get('fetch', 'first_page'),
+                                      page_size=options.get('page_size', 10000),
+                                      streams=options.get('streams', 4))
 
     def __repr__(self):
-        return 'Query(name = {}, options = {}, sql = {})'.format(self._name,
-                                                                 self._options,
-                                                                 self._sql)
+        return 'Query(name = {}, weight = {}, options = {}, sql = {})'.format(self._name,
+                                                                             self._weight,
+                                                                             self._options,
+                                                                             self._sql)
+
+    def bind(self):
+        """ Return the Binding of the next sample, or None if the query is not
+        templated """
+        if self._template is None:
+            return None
 
-    def execute(self, bq_client):
-        # BQ client behavior now dictates a unique QueryJobConfig() per query
-        job_config = bigquery.QueryJobConfig()
+        return self._template.next()
 
-        job_config.use_query_cache = self._options['use_cache']
+    def execute(self, bq_client, binding=None, dry_run=False):
+        job_config = self._backend.job_config(self, binding)
 
-        query_job = bq_client.query(self._sql, job_config)
+        # Dry runs validate the query and estimate the bytes it processes,
+        # which the result cache would hide
+        if dry_run:
+            job_config.dry_run = True
+            job_config.use_query_cache = False
+
+        sql = self._sql if binding is None else binding.sql
+        query_job = bq_client.query(sql, job_config)
         return query_job
 
+    def fetch(self, query_job, bq_client):
+        """ Read the results of a completed job, return (rows, bytes) """
+        return self._fetcher.fetch(query_job, bq_client)
+
     @property
     def options(self):
         return self._options
@@ -47,3 +84,31 @@ class Query(object):
     @property
     def name(self):
         return self._name
+
+    @property
+    def sql(self):
+        return self._sql
+
+    @property
+    def weight(self):
+        return self._weight
+
+    @property
+    def template(self):
+        return self._template
+
+    @property
+    def template_spec(self):
+        return self._template_spec
+
+    @property
+    def split_by(self):
+        """ Parameter the statistics of the query are split by, or None """
+        if self._template is None:
+            return None
+
+        return self._template.split_by
+
+    @property
+    def fetcher(self):
+        return self._fetcher
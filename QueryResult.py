@@ -0,0 +1,172 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Samples collected for a single query during a Scenario, held as one merged
+Histogram per named series (response_time, dispatch_delay etc.) """
+
+from Histogram import Histogram
+
+def result_name(query_name, bucket=None, shard=None):
+    """ Name of the results of a query, or of one parameter bucket of a query
+    split_by a parameter (see QueryTemplate), and of one shard (see Shards) """
+    tags = [tag for tag in (bucket, None if shard is None else 'shard=' + shard)
+            if tag is not None]
+    if not tags:
+        return query_name
+
+    return '{} [{}]'.format(query_name, ', '.join(tags))
+
+class QueryResult(object):
+    def __init__(self,
+                 name):
+
+        self._name = name
+        self._series = {}
+        self._trials = 0
+        self._concurrency = None
+        self._query = None
+        self._shard = None
+        self._errors = {}
+        self._retries = {}
+
+    def __repr__(self):
+        return 'QueryResult(name = {}, trials = {}, samples = {})'.format(self._name,
+                                                                         self._trials,
+                                                                         self.num_samples)
+
+    def add_trial(self, series, errors=None, retries=None):
+        """ Merge the series of one Trial, as a dict of series name ->
+        Histogram, and its failed samples and retries by error class """
+        self._trials += 1
+
+        for error_class, count in (errors or {}).items():
+            self._errors[error_class] = self._errors.get(error_class, 0) + count
+
+        for error_class, count in (retries or {}).items():
+            self._retries[error_class] = self._retries.get(error_class, 0) + count
+
+        for series_name, histogram in series.items():
+            if series_name not in self._series:
+                self._series[series_name] = Histogram(
+                    relative_accuracy=histogram.relative_accuracy)
+
+            self._series[series_name].merge(histogram)
+
+    def merge(self, other):
+        """ Add the results of the same query from another process, whose
+        trials ran concurrently with the trials of this one """
+
+        concurrency = self.concurrency + other.concurrency
+        trials = self._trials + other.trials
+
+        self.add_trial(other._series, other.errors, other.retries)
+
+        self._trials = trials
+        self._concurrency = concurrency
+        return self
+
+    def to_dict(self):
+        """ Serializable form, for merging results across processes """
+        return {'name': self._name,
+                'trials': self._trials,
+                'concurrency': self.concurrency,
+                'query': self._query,
+                'shard': self._shard,
+                'errors': self._errors,
+                'retries': self._retries,
+                'series': {series_name: histogram.to_dict()
+                           for series_name, histogram in self._series.items()}}
+
+    @classmethod
+    def from_dict(cls, state):
+        result = cls(name=state['name'])
+        result.add_trial({series_name: Histogram.from_dict(histogram)
+                          for series_name, histogram in state['series'].items()},
+                         errors=state.get('errors'),
+                         retries=state.get('retries'))
+        result.trials = state['trials']
+        result.concurrency = state['concurrency']
+        result.query = state.get('query')
+        result.shard = state.get('shard')
+
+        return result
+
+    def series(self, series_name):
+        """ Return the Histogram of a series, or None """
+        return self._series.get(series_name)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def trials(self):
+        return self._trials
+
+    @trials.setter
+    def trials(self, value):
+        self._trials = value
+
+    @property
+    def num_samples(self):
+        if 'response_time' not in self._series:
+            return 0
+
+        return self._series['response_time'].count
+
+    @property
+    def errors(self):
+        """ Samples that failed after their last attempt, by error class """
+        return self._errors
+
+    @property
+    def retries(self):
+        """ Failed attempts that were retried, by error class """
+        return self._retries
+
+    @property
+    def num_errors(self):
+        return sum(self._errors.values())
+
+    @property
+    def concurrency(self):
+        """ Concurrency reported for this query: the number of Trials (i.e.
+        threads) unless the Scenario has set it explicitly """
+        if self._concurrency is None:
+            return self._trials
+
+        return self._concurrency
+
+    @concurrency.setter
+    def concurrency(self, value):
+        self._concurrency = value
+
+    @property
+    def query(self):
+        """ Name of the query of a result of one of its parameter buckets
+        (see QueryTemplate), or None """
+        return self._query
+
+    @query.setter
+    def query(self, value):
+        self._query = value
+
+    @property
+    def shard(self):
+        """ Shard of a result of a parameter bucket, if any """
+        return self._shard
+
+    @shard.setter
+    def shard(self, value):
+        self._shard = value
@@ -23,11 +23,16 @@ class QuerySet(object):
     def __init__(self,
                  name,
                  queries,
-                 options):
+                 options,
+                 shards=None):
 
         self._queries = []
         self._name = name
 
+        # Projects to spread the load across, unless given on the command line
+        # (see Shards)
+        self._shards = shards
+
         for query in queries:
             # Handle case where options is either not set, or is empty
             query_options = query.get('options', {})
@@ -36,7 +41,9 @@ class QuerySet(object):
 
             self._queries.append(Query(name=query['name'],
                                        options={**query_options, **options},
-                                       sql=query['sql']))
+                                       sql=query['sql'],
+                                       weight=query.get('weight', 1),
+                                       template=query.get('template')))
 
     def __repr__(self):
         return 'QuerySet(name = {}, num. queries = {})'.format(self._name,
@@ -47,6 +54,10 @@ class QuerySet(object):
     def __getitem__(self, position):
         return self._queries[position]
 
+    @property
+    def shards(self):
+        return self._shards
+
     @classmethod
     def from_file(self,
                   query_file,
@@ -59,7 +70,7 @@ class QuerySet(object):
                 if extension == '.json':
                     query_cfg = json.load(f)
                 elif extension in ['.yaml', '.yml']:
-                    query_cfg = yaml.load(f)
+                    query_cfg = yaml.safe_load(f)
                     print(query_cfg)
         except Exception as e:
             print('Unable to open query file {}: {}'
@@ -70,5 +81,6 @@ class QuerySet(object):
 
             return self(name=query_cfg['name'],
                         queries=queries,
-                        options=options)
+                        options=options,
+                        shards=query_cfg.get('shards'))
 
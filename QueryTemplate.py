@@ -0,0 +1,505 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Templated query, bound to a different set of parameter values by every
+sample, so that repeated samples are not answered from the result cache and
+scan different ranges of data, as dashboard traffic does.
+
+The template of a query in the query file names its parameters and the
+generator of the values of each:
+
+    template:
+      bindings: 10000          # size of the pool of bindings (default)
+      order: shuffle           # or sequential
+      split_by: state          # optional, see below
+      parameters:
+        state: {values: [TX, CA, NY]}
+        year: {range: {start: 1910, stop: 2014}}
+        day: {date_window: {start: 2018-01-01, end: 2018-12-31, days: 7}}
+        name: {csv: {file: names.csv, column: name}}
+        limit: {random: {distribution: integers, low: 10, high: 1000}}
+
+A parameter referenced as @name in the SQL is passed as a named query
+parameter; one referenced as ${name} is substituted into the SQL text (i.e.
+table names, which can not be parameters). Any other $, as in a string
+literal or a regular expression, is left as it is. A date_window parameter binds
+name_start and name_end, the first and last day of the window.
+
+Every binding is generated once, vectorially, when the query is loaded: the
+combinations of the finite parameters (values, range, dates, date_window and
+csv) are enumerated in a shuffled (or sequential) order, drawn without shuffling
+the whole space of combinations, so that bindings
+are distinct until the combinations are exhausted, and random parameters are
+drawn with the seed of the experiment. Samples then take the next binding of
+the pool, which wraps around once exhausted.
+
+With split_by, the statistics of the query are split by the value of a
+parameter, or by ranges of it:
+
+      split_by: {parameter: limit, edges: [100, 500]}
+"""
+
+import re
+import csv
+import json
+import string
+import datetime
+import itertools
+from collections import namedtuple
+import numpy as np
+
+# One binding of a template: the SQL to run, its query parameters as
+# (name, type, value) tuples, its parameter bucket (or None), and its values
+# as JSON, for the raw sample records
+Binding = namedtuple('Binding', ['sql', 'parameters', 'bucket', 'values'])
+
+# Largest number of combinations shuffled as a whole. Beyond it, every finite
+# parameter is drawn independently, which gives distinct bindings with a high
+# probability anyway.
+MAX_PERMUTATION = 10**7
+
+PARAMETER_TYPES = {'i': 'INT64',
+                   'u': 'INT64',
+                   'f': 'FLOAT64',
+                   'b': 'BOOL',
+                   'M': 'DATE',
+                   'U': 'STRING',
+                   'S': 'STRING',
+                   'O': 'STRING'}
+
+class Substitution(string.Template):
+    """ string.Template of ${name} substitutions only: unlike $name, a $
+    that is not followed by a braced name is never a placeholder """
+    pattern = r'''
+    \$(?:
+      (?P<escaped>(?!))|
+      (?P<named>(?!))|
+      \{(?P<braced>[_a-z][_a-z0-9]*)\}|
+      (?P<invalid>(?!))
+    )
+    '''
+
+class QueryTemplate(object):
+    def __init__(self,
+                 sql,
+                 parameters,
+                 bindings=10000,
+                 order='shuffle',
+                 split_by=None,
+                 seed=None):
+
+        if order not in ('shuffle', 'sequential'):
+            raise ValueError('Unknown template order: {}'.format(order))
+
+        self._sql = sql
+        self._parameters = [_parameter(name, spec)
+                            for name, spec in parameters.items()]
+        self._order = order
+        self._split_by = _split(split_by)
+
+        bound = [name for parameter in self._parameters
+                 for name in parameter.bound_names]
+
+        # Substitutions must all be bound, while a parameter of the SQL that
+        # is not bound here is left to BigQuery to report
+        substituted = set(match.group('braced')
+                          for match in Substitution.pattern.finditer(sql))
+        missing = substituted - set(bound)
+        if missing:
+            raise ValueError('Unbound substitutions in template: {}'
+                             .format(', '.join(sorted(missing))))
+
+        self._substituted = [name for name in bound if name in substituted]
+        self._query_parameters = [name for name in bound
+                                  if re.search(r'@{}\b'.format(name), sql)]
+
+        if (self._split_by is not None
+                and self._split_by[0] not in [parameter.name
+                                              for parameter in self._parameters]):
+            raise ValueError('Unknown split_by parameter: {}'
+                             .format(self._split_by[0]))
+
+        self._combinations = int(np.prod([parameter.size
+                                          for parameter in self._parameters
+                                          if parameter.size is not None],
+                                         dtype=object))
+        self._bindings = self._prepare(bindings, np.random.RandomState(seed))
+
+        self._counter = itertools.count()
+        self._offset = 0
+        self._stride = 1
+
+    def __repr__(self):
+        return 'QueryTemplate(parameters = {}, bindings = {}, order = {})'.format(
+            [parameter.name for parameter in self._parameters],
+            len(self._bindings),
+            self._order)
+
+    @classmethod
+    def from_spec(cls, sql, spec, seed=None):
+        spec = normalize(spec)
+
+        return cls(sql=sql,
+                   parameters=spec.get('parameters') or {},
+                   bindings=spec.get('bindings', 10000),
+                   order=spec.get('order', 'shuffle'),
+                   split_by=spec.get('split_by'),
+                   seed=spec.get('seed', seed))
+
+    def next(self):
+        """ Return the Binding of the next sample. next() of itertools.count
+        is atomic, so threads never get the same binding. """
+        position = self._offset + self._stride * next(self._counter)
+        return self._bindings[position % len(self._bindings)]
+
+    def partition(self, part, parts):
+        """ Take every parts-th binding from the part-th one, so that the
+        Workers of a Coordinator, which all generate the same pool, do not
+        use the same bindings """
+        self._offset = part
+        self._stride = parts
+        self._counter = itertools.count()
+
+    def _prepare(self, count, random_state):
+        """ Generate count bindings """
+
+        columns = {}
+        primary = {}
+
+        finite = [parameter for parameter in self._parameters
+                  if parameter.size is not None]
+        for parameter, digits in zip(finite,
+                                     self._digits(finite, count, random_state)):
+            values = parameter.domain[digits]
+            primary[parameter.name] = values
+            columns.update(parameter.bind(values))
+
+        for parameter in self._parameters:
+            if parameter.size is None:
+                values = parameter.draw(count, random_state)
+                primary[parameter.name] = values
+                columns.update(parameter.bind(values))
+
+        buckets = [None] * count
+        if self._split_by is not None:
+            buckets = _buckets(primary[self._split_by[0]], *self._split_by)
+
+        # The arrays are only converted to Python values and rendered into
+        # bindings once, here
+        names = [name for parameter in self._parameters
+                 for name in parameter.bound_names]
+        types = {name: _type(columns[name]) for name in names}
+        values = {name: columns[name].tolist() for name in names}
+
+        template = Substitution(self._sql)
+
+        bindings = []
+        for position in range(count):
+            binding_values = {name: values[name][position] for name in names}
+
+            sql = self._sql
+            if self._substituted:
+                sql = template.substitute({name: binding_values[name]
+                                           for name in self._substituted})
+
+            bindings.append(Binding(
+                sql=sql,
+                parameters=tuple((name, types[name], binding_values[name])
+                                 for name in self._query_parameters),
+                bucket=buckets[position],
+                values=json.dumps(binding_values, default=str, sort_keys=True)))
+
+        return bindings
+
+    def _digits(self, finite, count, random_state):
+        """ Index into the domain of every finite parameter, for count
+        bindings """
+        sizes = [parameter.size for parameter in finite]
+        if not sizes:
+            return []
+
+        if self._order == 'shuffle' and self._combinations > MAX_PERMUTATION:
+            return [random_state.randint(size, size=count) for size in sizes]
+
+        if self._order == 'sequential':
+            combinations = np.arange(count, dtype=np.int64)
+            if self._combinations <= np.iinfo(np.int64).max:
+                combinations %= self._combinations
+        else:
+            # A new permutation of every combination each time they are
+            # exhausted, and distinct combinations for the remainder
+            rounds, remainder = divmod(count, self._combinations)
+            combinations = np.concatenate(
+                [random_state.permutation(self._combinations)
+                 for _ in range(rounds)]
+                + [_distinct(self._combinations, remainder, random_state)])
+
+        # Mixed radix decomposition, the last parameter varying fastest
+        digits = []
+        stride = 1
+        for size in reversed(sizes):
+            if stride > combinations.max(initial=0):
+                digits.append(np.zeros(count, dtype=np.int64))
+            else:
+                digits.append((combinations // stride) % size)
+            stride *= size
+
+        return list(reversed(digits))
+
+    def describe(self):
+        """ One line summary of the template, for the start of an experiment """
+        repeats = ''
+        if self._combinations < len(self._bindings) and all(
+                parameter.size is not None for parameter in self._parameters):
+            repeats = ', repeating after {}'.format(self._combinations)
+
+        return '{} bindings of {} ({} query parameters, {} substitutions{})'.format(
+            len(self._bindings),
+            ', '.join(parameter.name for parameter in self._parameters),
+            len(self._query_parameters),
+            len(self._substituted),
+            repeats)
+
+    @property
+    def split_by(self):
+        return self._split_by[0] if self._split_by else None
+
+    @property
+    def bindings(self):
+        return self._bindings
+
+class Parameter(object):
+    """ A named parameter with either a finite domain of values, or a random
+    distribution to draw from """
+
+    def __init__(self,
+                 name,
+                 domain=None,
+                 distribution=None,
+                 parameter_type=None):
+
+        self.name = name
+        self.domain = domain
+        self._distribution = distribution
+        self._type = parameter_type
+
+        if domain is not None and not len(domain):
+            raise ValueError('Parameter {} has no values'.format(name))
+
+    def __repr__(self):
+        return 'Parameter(name = {}, size = {})'.format(self.name, self.size)
+
+    @property
+    def size(self):
+        return None if self.domain is None else len(self.domain)
+
+    @property
+    def bound_names(self):
+        return [self.name]
+
+    def draw(self, count, random_state):
+        distribution = dict(self._distribution)
+        kind = distribution.pop('distribution', 'uniform')
+        digits = distribution.pop('round', None)
+
+        if kind == 'integers':
+            values = random_state.randint(distribution['low'],
+                                          distribution['high'],
+                                          size=count)
+        elif kind == 'uniform':
+            values = random_state.uniform(distribution['low'],
+                                          distribution['high'],
+                                          size=count)
+        elif kind == 'normal':
+            values = random_state.normal(distribution['mean'],
+                                         distribution['std'],
+                                         size=count)
+        elif kind == 'lognormal':
+            values = random_state.lognormal(np.log(distribution['median']),
+                                            distribution['sigma'],
+                                            size=count)
+        elif kind == 'exponential':
+            values = random_state.exponential(distribution['mean'], size=count)
+        else:
+            raise ValueError('Unknown distribution for parameter {}: {}'
+                             .format(self.name, kind))
+
+        if digits is not None:
+            values = np.round(values, digits)
+
+        return values
+
+    def bind(self, values):
+        """ Arrays of the values of the bound names, given the values of the
+        parameter """
+        return {self.name: _cast(values, self._type)}
+
+class DateWindowParameter(Parameter):
+    """ Windows of days days, binding name_start and name_end """
+
+    def __init__(self,
+                 name,
+                 domain,
+                 days):
+
+        super().__init__(name=name, domain=domain)
+        self._days = days
+
+    @property
+    def bound_names(self):
+        return [self.name + '_start', self.name + '_end']
+
+    def bind(self, values):
+        return {self.name + '_start': values,
+                self.name + '_end': values + np.timedelta64(self._days - 1, 'D')}
+
+def _distinct(high, count, random_state):
+    """ count distinct integers of range(high) in a random order, without
+    permuting all of them: integers are drawn until count of them are
+    distinct, which takes few draws unless count is close to high """
+    if 2 * count >= high:
+        return random_state.permutation(high)[:count]
+
+    drawn = np.zeros(0, dtype=np.int64)
+    while len(drawn) < count:
+        draws = random_state.randint(high, size=2 * (count - len(drawn)), dtype=np.int64)
+        candidates = np.concatenate([drawn, draws])
+
+        # Repeated integers only count where they were first drawn
+        _, first = np.unique(candidates, return_index=True)
+        drawn = candidates[np.sort(first)]
+
+    return drawn[:count]
+
+def _parameter(name, spec):
+    """ Build the Parameter of a spec, i.e. {values: [...]} """
+
+    if not isinstance(spec, dict) or not spec:
+        raise ValueError('Invalid spec for parameter {}: {}'.format(name, spec))
+
+    parameter_type = spec.get('type')
+
+    if 'values' in spec:
+        return Parameter(name=name,
+                         domain=_cast(np.array(spec['values']), parameter_type),
+                         parameter_type=parameter_type)
+
+    if 'range' in spec:
+        bounds = spec['range']
+        return Parameter(name=name,
+                         domain=np.arange(bounds['start'],
+                                          bounds['stop'],
+                                          bounds.get('step', 1)),
+                         parameter_type=parameter_type)
+
+    if 'dates' in spec:
+        bounds = spec['dates']
+        return Parameter(name=name,
+                         domain=_days(bounds['start'],
+                                      bounds['end'],
+                                      bounds.get('step', 1)))
+
+    if 'date_window' in spec:
+        bounds = spec['date_window']
+        days = bounds['days']
+        last = np.datetime64(bounds['end'], 'D') - np.timedelta64(days - 1, 'D')
+        return DateWindowParameter(name=name,
+                                   domain=_days(bounds['start'],
+                                                last,
+                                                bounds.get('step', 1)),
+                                   days=days)
+
+    if 'csv' in spec:
+        source = spec['csv']
+        with open(source['file'], newline='') as f:
+            column = [row[source['column']] for row in csv.DictReader(f)]
+
+        # Repeated values would repeat bindings
+        return Parameter(name=name,
+                         domain=_cast(np.unique(np.array(column)), parameter_type),
+                         parameter_type=parameter_type)
+
+    if 'random' in spec:
+        return Parameter(name=name,
+                         distribution=spec['random'],
+                         parameter_type=parameter_type)
+
+    raise ValueError('Unknown generator for parameter {}: {}'.format(name, spec))
+
+def _split(split_by):
+    """ (parameter name, bucket edges or None) of a split_by spec """
+    if split_by is None:
+        return None
+
+    if isinstance(split_by, dict):
+        return (split_by['parameter'], split_by.get('edges'))
+
+    return (split_by, None)
+
+def _buckets(values, name, edges=None):
+    """ Label of the bucket of every value: the value itself, or the range of
+    edges it falls in """
+
+    if edges is None:
+        unique, inverse = np.unique(values, return_inverse=True)
+        labels = ['{}={}'.format(name, value) for value in unique.tolist()]
+    else:
+        inverse = np.digitize(values, edges)
+        labels = (['{}<{}'.format(name, edges[0])]
+                  + ['{}<={}<{}'.format(low, name, high)
+                     for low, high in zip(edges[:-1], edges[1:])]
+                  + ['{}>={}'.format(name, edges[-1])])
+
+    return [labels[position] for position in inverse.tolist()]
+
+def _days(start, end, step=1):
+    """ Every step-th day from start to end, included """
+    return np.arange(np.datetime64(start, 'D'),
+                     np.datetime64(end, 'D') + np.timedelta64(1, 'D'),
+                     np.timedelta64(step, 'D'))
+
+def _cast(values, parameter_type):
+    if parameter_type == 'DATE':
+        return values.astype('datetime64[D]')
+    elif parameter_type == 'INT64':
+        return values.astype(np.int64)
+    elif parameter_type == 'FLOAT64':
+        return values.astype(np.float64)
+    elif parameter_type == 'STRING':
+        return values.astype(str)
+
+    return values
+
+def _type(values):
+    return PARAMETER_TYPES.get(values.dtype.kind, 'STRING')
+
+def normalize(spec):
+    """ The template spec with dates as ISO strings, so that it can be sent to
+    Workers as JSON. YAML parses dates, so a list of them is typed DATE. """
+
+    def convert(value):
+        if isinstance(value, dict):
+            converted = {key: convert(item) for key, item in value.items()}
+            if (isinstance(value.get('values'), list)
+                    and any(isinstance(item, datetime.date) for item in value['values'])):
+                converted.setdefault('type', 'DATE')
+            return converted
+        elif isinstance(value, list):
+            return [convert(item) for item in value]
+        elif isinstance(value, datetime.date):
+            return value.isoformat()
+
+        return value
+
+    return convert(spec)
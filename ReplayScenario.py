@@ -0,0 +1,240 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Open-loop Scenario replaying the jobs of an exported job history (see
+JobHistory) with their original relative timing, compressed or stretched by
+a speed factor, and reporting them by query fingerprint """
+
+import time
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from AsyncScenario import AsyncScenario
+from OpenLoopScenario import OpenLoopScenario
+from JobHistory import JobHistory
+from Query import Query
+from Shards import rotation
+from QueryTemplate import Binding
+from Trial import Trial
+
+# Jobs read ahead of the dispatcher at a time, by a thread of its own
+READ_AHEAD = 1000
+
+class ReplayScenario(OpenLoopScenario):
+    COLUMNS = AsyncScenario.COLUMNS + ('target_rate', 'achieved_rate', 'replay_speed')
+
+    def __init__(self,
+                 speed,
+                 queries,
+                 options,
+                 client_pool,
+                 sink=None,
+                 index=0,
+                 meter=None,
+                 metrics=None,
+                 store=None):
+
+        # An optional duration stops the replay that many (scaled) seconds
+        # into the history
+        super().__init__(rate=None,
+                         duration=options.get('duration'),
+                         queries=queries,
+                         options=options,
+                         client_pool=client_pool,
+                         sink=sink,
+                         index=index,
+                         meter=meter,
+                         metrics=metrics,
+                         store=store)
+
+        self._speed = speed
+        self._span = 0.0
+        self._elapsed = 0.0
+        self._history = None
+
+    def __repr__(self):
+        return 'ReplayScenario(file = {}, speed = {}x)'.format(self._options['replay_file'],
+                                                              self._speed)
+
+    def _announce(self):
+        print(('--- Starting replay of {} at speed = {}x, use_query_cache = {}')
+              .format(self._options['replay_file'],
+                      self._speed,
+                      self._options['use_cache']))
+
+    def column_values(self):
+        values = super(OpenLoopScenario, self).column_values()
+        values.update({'target_rate': (self._dispatched / self._span
+                                       if self._span > 0 else ''),
+                       'achieved_rate': (self._dispatched / self._elapsed
+                                         if self._elapsed > 0 else ''),
+                       'replay_speed': self._speed})
+        return values
+
+    def _build_trials(self):
+        # Trials are added by the dispatcher as fingerprints are first seen,
+        # since the history is never read as a whole
+        return []
+
+    def _trial(self, trials, by_fingerprint, job, shard):
+        """ Trial of the fingerprint of a job (and of its shard), created on
+        first use """
+        trial = by_fingerprint.get((job.fingerprint, shard))
+        if trial is not None:
+            return trial
+
+        query = self._known.get(job.fingerprint)
+        if query is None:
+            query = Query(name=job.fingerprint,
+                          options=self._options,
+                          sql=job.sql)
+
+        trial = Trial(query=query,
+                      options=self._options,
+                      samples=0,
+                      bq_client=self._get_client(shard),
+                      sink=self._sink,
+                      tags={'scenario': self._index},
+                      poller=self._poller,
+                      meter=self._meter,
+                      metrics=self._metrics,
+                      shard=shard,
+                      store=self._store,
+                      thread=len(trials))
+
+        by_fingerprint[(job.fingerprint, shard)] = trial
+        trials.append(trial)
+        return trial
+
+    async def _dispatch(self, trials, executor):
+        """ Launch every job of the history at its original offset divided by
+        the speed, reading the history as the replay goes """
+
+        loop = asyncio.get_event_loop()
+        pending = set()
+        by_fingerprint = {}
+
+        # Jobs are spread across shards as they are read
+        shards = rotation(self._shards) if self._shards else itertools.repeat(None)
+
+        self._known = {query.name: query for query in self._queries}
+        self._history = JobHistory.from_options(self._options,
+                                                known={query.name: query.sql
+                                                       for query in self._queries})
+
+        self._in_flight = 0
+        self._dispatched = 0
+        self._span = 0.0
+
+        # The history is read by a thread of its own, a batch of jobs ahead
+        # of the dispatcher, so that reading the file never delays a job
+        jobs = iter(self._history)
+        reader = ThreadPoolExecutor(max_workers=1)
+
+        def read_ahead():
+            return list(itertools.islice(jobs, READ_AHEAD))
+
+        try:
+            # The replay starts once the first batch is read
+            ready = await loop.run_in_executor(reader, read_ahead)
+            start = time.perf_counter()
+
+            while ready:
+                batch = loop.run_in_executor(reader, read_ahead)
+                if not await self._dispatch_batch(ready, trials, by_fingerprint, shards,
+                                                  executor, start, pending):
+                    break
+
+                ready = await batch
+        finally:
+            reader.shutdown(wait=True)
+
+        self._elapsed = time.perf_counter() - start
+
+        if pending:
+            await asyncio.wait(pending)
+
+        if not self._options['quiet']:
+            print(('--- Replayed {} of {} jobs read, {} fingerprints, '
+                   '{} skipped (no query text or filtered out), {} late')
+                  .format(self._dispatched,
+                          self._history.read,
+                          len({fingerprint for fingerprint, _ in by_fingerprint}),
+                          self._history.skipped,
+                          self._history.late))
+
+        if self._history.excluded and not self._options['quiet']:
+            print('--- {} jobs not replayed for their job or statement type (see '
+                  '--replay-statements)'.format(self._history.excluded))
+
+        if self._history.untyped:
+            print('--- Warning: {} jobs without a statement_type were not replayed; '
+                  'export the statement_type column to replay them'
+                  .format(self._history.untyped))
+
+    async def _dispatch_batch(self, jobs, trials, by_fingerprint, shards,
+                              executor, start, pending):
+        """ Launch a batch of jobs on schedule, return False once the replay
+        is to stop """
+        loop = asyncio.get_event_loop()
+
+        for job in jobs:
+            if self._meter.exhausted:
+                return False
+
+            offset = job.offset / self._speed
+            if self._duration and offset > self._duration:
+                return False
+
+            self._span = offset
+            trial = self._trial(trials, by_fingerprint, job, next(shards))
+
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # Every job runs its own text, literals included, except those
+            # replayed by a query of the query file
+            binding = None
+            if job.fingerprint not in self._known:
+                binding = Binding(sql=job.sql, parameters=(), bucket=None, values=None)
+
+            task = loop.create_task(self._replay(trial, executor, scheduled, binding))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        return True
+
+    async def _replay(self, trial, executor, scheduled, binding):
+        self._dispatched += 1
+        self._in_flight += 1
+        try:
+            await trial.sample_async(executor=executor,
+                                     poll_interval=self._options['poll_interval'],
+                                     intended=scheduled,
+                                     in_flight=self._in_flight,
+                                     binding=binding)
+        except Exception as e:
+            print('Query "{}" generated exception: {}'
+                  .format(trial.query.name, repr(e)))
+        finally:
+            self._in_flight -= 1
+
+    @property
+    def label(self):
+        if self._duration:
+            return 'replay at {}x for {}s'.format(self._speed, self._duration)
+
+        return 'replay at {}x'.format(self._speed)
@@ -0,0 +1,139 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Fetch the results of a completed query job, according to the 'fetch'
+option of its query:
+
+    first_page   read the first page of rows only, as QueryJob.result() does
+                 (the default)
+    none         wait for the job to complete, without reading any row
+    stream       read every page of rows, one page ('page_size' rows) at a
+                 time, so memory use is capped whatever the size of the result
+    storage_api  read every row with the BigQuery Storage Read API, as
+                 'streams' parallel Arrow streams (requires
+                 google-cloud-bigquery-storage)
+
+Rows are counted and discarded as they are read. """
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
+FETCH_MODES = ('first_page', 'none', 'stream', 'storage_api')
+
+# The Storage Read API client is shared by every fetcher of the process
+_storage_client = None
+_storage_lock = threading.Lock()
+
+class ResultFetcher(object):
+    def __init__(self,
+                 mode='first_page',
+                 page_size=10000,
+                 streams=4):
+
+        if mode not in FETCH_MODES:
+            raise ValueError('Unknown fetch mode: {}'.format(mode))
+
+        if mode == 'storage_api' and bigquery_storage is None:
+            raise ImportError('Fetch mode storage_api requires '
+                              'google-cloud-bigquery-storage')
+
+        self._mode = mode
+        self._page_size = page_size
+        self._streams = streams
+
+    def __repr__(self):
+        return 'ResultFetcher(mode = {}, page_size = {}, streams = {})'.format(self._mode,
+                                                                              self._page_size,
+                                                                              self._streams)
+
+    def fetch(self, query_job, bq_client):
+        """ Read the results of a completed job. Return (rows, bytes) read,
+        where bytes is None unless the mode reads them (stream and
+        storage_api): other modes make no API call beyond the job's own. """
+
+        if self._mode == 'first_page':
+            rows = query_job.result()
+            page = next(iter(rows.pages), None)
+            return (page.num_items if page else 0), None
+
+        # The job is already done, so this does not call the API again
+        exception = query_job.exception()
+        if exception is not None:
+            raise exception
+
+        if self._mode == 'none':
+            return 0, None
+
+        if self._mode == 'storage_api':
+            return self._fetch_storage_api(query_job)
+
+        # Rather than result(), which would read the first page once more,
+        # pages are listed from the destination table, whose schema list_rows
+        # needs, and requested one at a time and dropped once counted
+        table = bq_client.get_table(query_job.destination)
+        pages = bq_client.list_rows(table, page_size=self._page_size).pages
+        rows = sum(page.num_items for page in pages)
+
+        if not table.num_rows:
+            return rows, None
+
+        return rows, rows * table.num_bytes / table.num_rows
+
+    def _fetch_storage_api(self, query_job):
+        table = query_job.destination
+        client = _get_storage_client()
+
+        session = client.create_read_session(
+            parent='projects/{}'.format(table.project),
+            read_session=bigquery_storage.types.ReadSession(
+                table='projects/{}/datasets/{}/tables/{}'.format(table.project,
+                                                                 table.dataset_id,
+                                                                 table.table_id),
+                data_format=bigquery_storage.types.DataFormat.ARROW),
+            max_stream_count=self._streams)
+
+        def read_stream(stream):
+            # Serialized Arrow record batches are counted without decoding
+            rows, size = 0, 0
+            for response in client.read_rows(stream.name):
+                rows += response.row_count
+                size += len(response.arrow_record_batch.serialized_record_batch)
+
+            return rows, size
+
+        if not session.streams:
+            return 0, 0
+
+        with ThreadPoolExecutor(max_workers=len(session.streams)) as executor:
+            counts = list(executor.map(read_stream, session.streams))
+
+        return sum(rows for rows, _ in counts), sum(size for _, size in counts)
+
+    @property
+    def mode(self):
+        return self._mode
+
+def _get_storage_client():
+    global _storage_client
+
+    with _storage_lock:
+        if _storage_client is None:
+            _storage_client = bigquery_storage.BigQueryReadClient()
+
+    return _storage_client
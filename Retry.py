@@ -0,0 +1,117 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Classification and retry of failed samples. Errors fall into one of
+ERROR_CLASSES:
+
+    quota      rateLimitExceeded, jobRateLimitExceeded, quotaExceeded or HTTP
+               429: the project is sending too much load (retried)
+    backend    backendError, internalError or HTTP 5xx (retried)
+    timeout    client side timeouts and dropped connections (retried)
+    query      any other API error, i.e. invalidQuery, notFound, accessDenied
+    other      anything else
+
+Retried samples wait for an exponential backoff with full jitter (a uniform
+draw between zero and the capped exponential delay), so that threads failing
+together do not retry together. """
+
+import numpy as np
+
+ERROR_CLASSES = ('quota', 'backend', 'timeout', 'query', 'other')
+
+RETRYABLE = ('quota', 'backend', 'timeout')
+
+QUOTA_REASONS = ('rateLimitExceeded', 'jobRateLimitExceeded', 'quotaExceeded')
+BACKEND_REASONS = ('backendError', 'internalError')
+
+def classify(error):
+    """ Return the class of error, one of ERROR_CLASSES """
+
+    reason = _reason(error)
+    code = getattr(error, 'code', None)
+    if not isinstance(code, int):
+        code = None
+
+    if reason in QUOTA_REASONS or code == 429:
+        return 'quota'
+
+    if reason in BACKEND_REASONS or (code is not None and code >= 500):
+        return 'backend'
+
+    # Timeouts of the standard library, requests and google.api_core alike
+    name = type(error).__name__
+    if (isinstance(error, (TimeoutError, ConnectionError))
+            or 'Timeout' in name
+            or 'ConnectionError' in name):
+        return 'timeout'
+
+    if reason is not None or code is not None:
+        return 'query'
+
+    return 'other'
+
+def format_counts(counts):
+    """ Describe {error class: count} as i.e. '3 (backend = 1, quota = 2)' """
+    if not counts:
+        return '0'
+
+    return '{} ({})'.format(sum(counts.values()),
+                            ', '.join('{} = {}'.format(error_class, count)
+                                      for error_class, count in sorted(counts.items())))
+
+def _reason(error):
+    # API errors carry the reasons reported by BigQuery in their errors list
+    errors = getattr(error, 'errors', None)
+    if errors and isinstance(errors[0], dict):
+        return errors[0].get('reason')
+
+    return None
+
+class RetryPolicy(object):
+    def __init__(self,
+                 max_retries=3,
+                 initial=1.0,
+                 maximum=60.0,
+                 multiplier=2.0):
+
+        self._max_retries = max_retries
+        self._initial = initial
+        self._maximum = maximum
+        self._multiplier = multiplier
+
+    def __repr__(self):
+        return 'RetryPolicy(max_retries = {}, initial = {}s, maximum = {}s)'.format(
+            self._max_retries,
+            self._initial,
+            self._maximum)
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(max_retries=options.get('max_retries', 0),
+                   initial=options.get('retry_initial', 1.0),
+                   maximum=options.get('retry_max', 60.0))
+
+    def should_retry(self, error_class, attempt):
+        """ Whether to retry after attempt (counted from 0) failed with an
+        error of error_class """
+        return error_class in RETRYABLE and attempt < self._max_retries
+
+    def delay(self, attempt):
+        """ Seconds to wait before retrying after attempt failed """
+        ceiling = min(self._maximum, self._initial * self._multiplier ** attempt)
+        return np.random.uniform(0, ceiling)
+
+    @property
+    def max_retries(self):
+        return self._max_retries
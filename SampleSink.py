@@ -0,0 +1,295 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Append-only sink of raw per-sample records, written as samples complete.
+
+Records are buffered and appended either to a JSON lines file, or to a
+directory with one Parquet file per scenario (requires pyarrow). The end of
+every scenario is marked with a 'scenario_end' record holding its scenario
+level results, so an interrupted Experiment can be resumed: scenarios with an
+end marker are rebuilt from their raw samples instead of being run again.
+Samples of a scenario that never completed are ignored. """
+
+import os
+import json
+import uuid
+import glob
+import threading
+from QueryResult import QueryResult, result_name
+from Histogram import Histogram
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Name and type of every field of a record. Series values are stored under
+# their series name.
+FIELDS = [('event', 'string'),
+          ('run_id', 'string'),
+          ('scenario', 'int'),
+          ('query', 'string'),
+          ('thread', 'int'),
+          ('worker', 'int'),
+          ('shard', 'string'),
+          ('sample', 'int'),
+          ('job_id', 'string'),
+          ('start_time', 'float'),
+          ('end_time', 'float'),
+          ('response_time', 'float'),
+          ('corrected_response_time', 'float'),
+          ('dispatch_delay', 'float'),
+          ('in_flight', 'int'),
+          ('submit_rtt', 'float'),
+          ('queue_wait', 'float'),
+          ('execution', 'float'),
+          ('result_fetch', 'float'),
+          ('client_overhead', 'float'),
+          ('fetch_rows_per_second', 'float'),
+          ('fetch_mbytes_per_second', 'float'),
+          ('retry_wait', 'float'),
+          ('created_time', 'float'),
+          ('started_time', 'float'),
+          ('ended_time', 'float'),
+          ('mbytes_processed', 'float'),
+          ('mbytes_billed', 'float'),
+          ('slot_millis', 'float'),
+          ('rows_fetched', 'int'),
+          ('mbytes_fetched', 'float'),
+          ('stages', 'string'),
+          ('attempts', 'int'),
+          ('steady', 'int'),
+          ('bucket', 'string'),
+          ('parameters', 'string'),
+          ('error', 'string'),
+          ('error_message', 'string'),
+          ('info', 'string')]
+
+SERIES_FIELDS = ['response_time',
+                 'corrected_response_time',
+                 'dispatch_delay',
+                 'in_flight',
+                 'submit_rtt',
+                 'queue_wait',
+                 'execution',
+                 'result_fetch',
+                 'client_overhead',
+                 'fetch_rows_per_second',
+                 'fetch_mbytes_per_second',
+                 'retry_wait']
+
+class SampleSink(object):
+    def __init__(self,
+                 path,
+                 format='jsonl',
+                 buffer_size=1000):
+
+        self._path = path
+        self._format = format
+        self._buffer_size = buffer_size
+        self._run_id = uuid.uuid4().hex
+
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._file = None
+        self._writers = {}
+
+        if format == 'parquet':
+            if pa is None:
+                raise ImportError('Parquet sample output requires pyarrow')
+
+            os.makedirs(path, exist_ok=True)
+        elif format == 'jsonl':
+            self._file = open(path, 'a')
+
+            # Terminate a line left truncated by a crash, so that only that
+            # record is lost when resuming
+            if self._file.tell() > 0:
+                with open(path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self._file.write('\n')
+        else:
+            raise ValueError('Unknown sample sink format: {}'.format(format))
+
+    def __repr__(self):
+        return 'SampleSink(path = {}, format = {}, run_id = {})'.format(self._path,
+                                                                       self._format,
+                                                                       self._run_id)
+
+    def append(self, record):
+        """ Add a sample record, which is written once the buffer is full """
+        record['event'] = 'sample'
+        record['run_id'] = self._run_id
+
+        with self._lock:
+            self._buffer.append(record)
+            if len(self._buffer) >= self._buffer_size:
+                self._flush()
+
+    def end_scenario(self, index, scenario, response_results):
+        """ Mark a scenario as complete, recording what is needed to rebuild
+        its results and output rows from the raw samples """
+
+        info = {'label': scenario.label,
+                'columns': scenario.column_values(),
+                'series': list(scenario.series_names),
+                'queries': {query_name: {'trials': result.trials,
+                                         'concurrency': result.concurrency,
+                                         'query': result.query,
+                                         'shard': result.shard,
+                                         'errors': result.errors,
+                                         'retries': result.retries}
+                            for query_name, result in response_results.items()}}
+
+        with self._lock:
+            self._buffer.append({'event': 'scenario_end',
+                                 'run_id': self._run_id,
+                                 'scenario': index,
+                                 'info': json.dumps(info)})
+            self._flush(sync=True)
+
+            if self._format == 'parquet' and index in self._writers:
+                writer, temporary_path = self._writers.pop(index)
+                writer.close()
+                os.replace(temporary_path, self._scenario_path(index))
+
+    def close(self):
+        with self._lock:
+            self._flush(sync=True)
+            if self._file:
+                self._file.close()
+                self._file = None
+
+            # Parquet files of incomplete scenarios are left behind as .tmp
+            for writer, _ in self._writers.values():
+                writer.close()
+            self._writers = {}
+
+    def _flush(self, sync=False):
+        if self._buffer:
+            if self._format == 'jsonl':
+                self._file.write(''.join(json.dumps(record) + '\n'
+                                         for record in self._buffer))
+            else:
+                self._write_parquet(self._buffer)
+
+            self._buffer = []
+
+        if sync and self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _write_parquet(self, records):
+        by_scenario = {}
+        for record in records:
+            by_scenario.setdefault(record.get('scenario'), []).append(record)
+
+        for index, scenario_records in by_scenario.items():
+            if index not in self._writers:
+                temporary_path = self._scenario_path(index) + '.tmp'
+                self._writers[index] = (pq.ParquetWriter(temporary_path, _schema()),
+                                        temporary_path)
+
+            writer, _ = self._writers[index]
+            writer.write_table(pa.Table.from_pydict(
+                {name: [record.get(name) for record in scenario_records]
+                 for name, _ in FIELDS},
+                schema=_schema()))
+
+    def _scenario_path(self, index):
+        return os.path.join(self._path, 'scenario-{:05d}.parquet'.format(index))
+
+    @property
+    def run_id(self):
+        return self._run_id
+
+def _schema():
+    types = {'string': pa.string(), 'int': pa.int64(), 'float': pa.float64()}
+    return pa.schema([(name, types[field_type]) for name, field_type in FIELDS])
+
+def read_records(path):
+    """ Iterate over the records of a sink, one at a time """
+
+    if os.path.isdir(path):
+        for file_name in sorted(glob.glob(os.path.join(path, 'scenario-*.parquet'))):
+            parquet_file = pq.ParquetFile(file_name)
+            for batch_index in range(parquet_file.num_row_groups):
+                for record in parquet_file.read_row_group(batch_index).to_pylist():
+                    yield record
+    elif os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                # A crash can leave a truncated last line behind
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def completed_scenarios(path):
+    """ Return {scenario index: (run_id, info)} for every completed scenario,
+    keeping the most recent completion of each """
+
+    completed = {}
+    for record in read_records(path):
+        if record['event'] == 'scenario_end':
+            completed[record['scenario']] = (record['run_id'],
+                                             json.loads(record['info']))
+
+    return completed
+
+def rebuild_results(path, completed):
+    """ Rebuild the {query name: QueryResult} dict of completed scenarios from
+    their raw samples, in a single streaming pass over the sink """
+
+    histograms = {}
+    for record in read_records(path):
+        if record['event'] != 'sample':
+            continue
+
+        index = record['scenario']
+        if index not in completed or completed[index][0] != record['run_id']:
+            continue
+
+        # Samples outside the steady-state window of their scenario only
+        # count towards its effective concurrency, already in its columns
+        if record.get('steady') == 0:
+            continue
+
+        query_name = result_name(record['query'], record.get('bucket'), record.get('shard'))
+        series = histograms.setdefault(index, {}).setdefault(query_name, {})
+        for series_name in SERIES_FIELDS:
+            value = record.get(series_name)
+            if value is not None:
+                if series_name not in series:
+                    series[series_name] = Histogram()
+                series[series_name].record(value)
+
+    results = {}
+    for index, (_, info) in completed.items():
+        results[index] = {}
+        for query_name, query_info in info['queries'].items():
+            result = QueryResult(name=query_name)
+            result.add_trial(histograms.get(index, {}).get(query_name, {}),
+                             errors=query_info.get('errors'),
+                             retries=query_info.get('retries'))
+            result.trials = query_info['trials']
+            result.concurrency = query_info['concurrency']
+            result.query = query_info.get('query')
+            result.shard = query_info.get('shard')
+            results[index][query_name] = result
+
+    return results
@@ -0,0 +1,192 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Append-only columnar store of the samples of an Experiment.
+
+Every completed sample is a row: its scenario, query and thread ids, then its
+response time, slot time and MB processed and billed (SAMPLE_COLUMNS). Query
+names are mapped to small integer ids by the store. Every column is a typed
+NumPy buffer, preallocated and doubled whenever it fills up, so that appending
+a sample only writes its values in place: a value takes 4 or 8 bytes rather
+than a Python object and a pointer.
+
+Statistics read the columns as views of the rows appended so far, without
+copies: Histogram.from_values() summarises a column (or a group of its rows)
+in a single vectorized pass, and groups() sorts the rows of a scenario once by
+query and thread, for the summaries of every Trial.
+
+All columns share a single buffer, column after column. With a directory
+(--sample-store), that buffer is a single anonymous temporary file in the
+directory, mapped into memory, so that the operating system pages samples out
+to disk rather than the run running out of memory; the file grows in place
+and is gone once the store is. Views of the columns are only valid until the
+next append that grows the store. """
+
+import os
+import tempfile
+import threading
+import numpy as np
+
+# Ids of a sample, then its values
+KEY_COLUMNS = (('scenario', np.int32),
+               ('query', np.int32),
+               ('thread', np.int32))
+
+VALUE_COLUMNS = (('response_time', np.float64),
+                 ('slot_millis', np.float64),
+                 ('mbytes_processed', np.float64),
+                 ('mbytes_billed', np.float64))
+
+SAMPLE_COLUMNS = KEY_COLUMNS + VALUE_COLUMNS
+
+class SampleStore(object):
+    def __init__(self,
+                 columns=SAMPLE_COLUMNS,
+                 capacity=4096,
+                 path=None):
+
+        # Columns are laid out widest types first, so that all of them are
+        # aligned, in the order of their (name, dtype) pairs otherwise
+        self._names = [name for name, _ in columns]
+        self._layout = sorted(((name, np.dtype(dtype)) for name, dtype in columns),
+                              key=lambda column: -column[1].itemsize)
+        self._row_bytes = sum(dtype.itemsize for _, dtype in self._layout)
+
+        self._lock = threading.Lock()
+        self._size = 0
+        self._capacity = 0
+        self._buffer = None
+        self._columns = {}
+
+        self._ids = {}
+        self._id_names = []
+
+        self._file = None
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._file = tempfile.TemporaryFile(dir=path, prefix='samples-')
+
+        self._grow(max(1, capacity))
+
+    def __repr__(self):
+        return 'SampleStore(columns = {}, rows = {}, capacity = {}, mapped = {})'.format(
+            ', '.join(self._names),
+            self._size,
+            self._capacity,
+            self._file is not None)
+
+    def __len__(self):
+        return self._size
+
+    def id(self, name):
+        """ Integer id of a name (i.e. of a query) """
+        with self._lock:
+            if name not in self._ids:
+                self._ids[name] = len(self._id_names)
+                self._id_names.append(name)
+
+            return self._ids[name]
+
+    def name(self, name_id):
+        return self._id_names[name_id]
+
+    def append(self, *values):
+        """ Append a row, with a value for every column in order. Rows may be
+        appended from any thread. """
+        with self._lock:
+            if self._size == self._capacity:
+                self._grow(2 * self._capacity)
+
+            for name, value in zip(self._names, values):
+                self._columns[name][self._size] = value
+
+            self._size += 1
+
+    def column(self, name, start=0):
+        """ The values of a column from row start, as a read-only view of its
+        buffer """
+        view = self._columns[name][start:self._size]
+        view.flags.writeable = False
+        return view
+
+    def groups(self, keys, start=0):
+        """ Return (order, {key values: (first, last)}) of the rows from start
+        grouped by the values of the key columns: the rows of a group are
+        order[first:last] """
+        if self._size <= start:
+            return np.zeros(0, dtype=np.int64), {}
+
+        key_columns = [self.column(key, start) for key in keys]
+
+        # Rows sorted by their keys, the first key varying slowest
+        order = np.lexsort(key_columns[::-1])
+        sorted_keys = np.stack([column[order] for column in key_columns], axis=1)
+
+        changes = np.flatnonzero(np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)) + 1
+        bounds = np.concatenate([[0], changes, [len(order)]])
+
+        return order, {tuple(int(value) for value in sorted_keys[first]): (first, last)
+                       for first, last in zip(bounds[:-1], bounds[1:])}
+
+    def _grow(self, capacity):
+        """ Enlarge the buffer to capacity rows, keeping the rows so far. A
+        file is extended and its columns moved up in place, last first, as
+        every column starts further into the larger buffer. """
+        nbytes = self._row_bytes * capacity
+
+        if self._file is not None:
+            self._file.truncate(nbytes)
+            buffer = np.memmap(self._file, dtype=np.uint8, mode='r+', shape=nbytes)
+            previous = buffer
+        else:
+            buffer = np.empty(nbytes, dtype=np.uint8)
+            previous = self._buffer
+
+        offsets = []
+        offset = 0
+        for name, dtype in self._layout:
+            offsets.append((name, dtype, offset))
+            offset += dtype.itemsize
+
+        if self._size:
+            for name, dtype, row_offset in reversed(offsets):
+                used = self._size * dtype.itemsize
+                source = row_offset * self._capacity
+                target = row_offset * capacity
+                buffer[target:target + used] = previous[source:source + used]
+
+        self._columns = {name: buffer[row_offset * capacity:
+                                      (row_offset + dtype.itemsize) * capacity].view(dtype)
+                         for name, dtype, row_offset in offsets}
+        self._buffer = buffer
+        self._capacity = capacity
+
+    def close(self):
+        """ Release the buffer, and its file if it is mapped to one """
+        self._columns = {}
+        self._buffer = None
+        self._size = 0
+        self._capacity = 0
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def names(self):
+        return list(self._names)
@@ -15,23 +15,104 @@
 """ Configure and execute a Scenario, which consists of one or more concurrent
 Trials that are launched in parallel """
 
-import numpy as np
-import itertools
+import time
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from random import choice
-from Trial import Trial
+from Trial import Trial, PHASES, FETCH_SERIES, RETRY_SERIES
+from QueryResult import QueryResult, result_name
+from MixScheduler import MixScheduler
+from AimdController import AimdController
+from SteadyWindow import SteadyWindow
+from JobPoller import JobPoller
+from CostMeter import CostMeter
+from Shards import parse_shards, assign
+from Retry import format_counts
+from SampleStore import SampleStore
 
 class Scenario(object):
+    # Series of per-sample values reported for each query, and additional
+    # scenario level columns, that this type of Scenario produces
+    SERIES = ('response_time',) + PHASES
+    COLUMNS = ('throughput', 'cost')
+
+    # Additional series produced in intended-schedule mode (--interval)
+    PACED_SERIES = ('corrected_response_time', 'dispatch_delay')
+
+    # Additional column with an adaptive concurrency limit (--adaptive)
+    ADAPTIVE_COLUMNS = ('concurrency_limit',)
+
+    # Additional column of scenarios with a steady-state window
+    WINDOW_COLUMNS = ('effective_concurrency',)
+
+    # Additional columns of scenarios polled by a JobPoller (--polling=batch)
+    POLLER_COLUMNS = ('poll_api_calls_per_query',
+                      'poll_delay_mean',
+                      'poll_delay_p95')
+
+    # Columns that are means over the processes of a distributed scenario,
+    # rather than totals
+    MEAN_COLUMNS = POLLER_COLUMNS
+
     def __init__(self,
                  threads,
                  samples,
                  queries,
-                 options):
+                 options,
+                 client_pool,
+                 sink=None,
+                 index=0,
+                 allocation=None,
+                 meter=None,
+                 metrics=None,
+                 shard_assignment=None,
+                 store=None):
 
         self._threads = threads
         self._samples = samples
         self._queries = queries
         self._options = options
+        self._client_pool = client_pool
+        self._sink = sink
+        self._index = index
+        self._allocation = allocation
+        self._throughput = None
+        self._controller = None
+        self._concurrency_limit = None
+        self._effective_concurrency = None
+        self._poller = None
+        self._poller_stats = {}
+
+        # Cost of the samples of the scenario, metered by the CostMeter of the
+        # Experiment if there is one
+        self._meter = meter if meter is not None else CostMeter()
+        self._cost = None
+
+        # Optional LiveMetrics reporting on the scenario while it runs
+        self._metrics = metrics
+
+        # SampleStore of the samples of every Trial, shared by the scenarios
+        # of the Experiment, where the rows of the scenario start at
+        # _first_row
+        self._store = store if store is not None else SampleStore()
+        self._first_row = len(self._store)
+
+        # Shards of the client pool, if the load is spread across projects,
+        # and those of the threads of a given allocation (Coordinator)
+        self._shards = parse_shards(options['shards']) if options.get('shards') else None
+        self._shard_assignment = shard_assignment
+
+        if options.get('adaptive'):
+            self.COLUMNS = self.COLUMNS + self.ADAPTIVE_COLUMNS
+
+        if options.get('polling') == 'batch':
+            self.COLUMNS = self.COLUMNS + self.POLLER_COLUMNS
+
+        # Closed-loop scenarios given a duration run for that long rather than
+        # for a number of samples per thread
+        self._window = None
+        if options.get('load') not in ('open', 'replay') and options.get('duration'):
+            self._window = SteadyWindow.from_options(options)
+            self.COLUMNS = self.COLUMNS + self.WINDOW_COLUMNS
 
     def __repr__(self):
         return ' '.join(['Scenario(threads = {},',
@@ -40,62 +121,280 @@ class Scenario(object):
                                                   len(self._queries),
                                                   self._samples)
     def run(self):
+        if not self._options['quiet']:
+            self._announce()
+
+        # A single poller tracks the jobs of every Trial, of every shard
+        if self._options.get('polling') == 'batch':
+            self._poller = JobPoller.from_options(
+                self._options,
+                self._client_pool.get_client(),
+                other_clients=[self._get_client(shard.name)
+                               for shard in self._shards or []])
+            self._poller.start()
+
+        try:
+            trials = self._build_trials()
+
+            if self._window:
+                self._window.start()
+
+            self._first_row = len(self._store)
+            spent = self._meter.spent
+            start = time.perf_counter()
+            response_results = self._execute(trials)
+            elapsed = time.perf_counter() - start
+            self._set_buckets(response_results, trials)
+            self._cost = self._meter.spent - spent
+        finally:
+            if self._poller:
+                self._poller.stop()
+                self._poller_stats = self._poller.stats()
+
+        # Completed queries per second of wall clock time, over all queries
+        total_samples = sum(result.num_samples
+                            for result in response_results.values())
+        self._throughput = total_samples / elapsed if elapsed > 0 else 0.0
+
+        # ... or of the steady-state window, which holds every sample counted
+        if self._window:
+            self._throughput = total_samples / self._window.length
+            self._effective_concurrency = (sum(trial.busy for trial in trials)
+                                           / self._window.length)
+
+        if self._controller:
+            self._concurrency_limit = self._controller.mean_limit()
+
+        if not self._options['quiet']:
+            self._output_trials(trials)
+            self._report(response_results)
+
+        return response_results
+
+    def _announce(self):
+        if self._window:
+            print(('--- Starting scenario with threads = {}, '
+                   'duration = {}, use_query_cache = {}')
+                  .format(self._threads,
+                          self._window.label,
+                          self._options['use_cache']))
+            return
+
         print(('--- Starting scenario with threads = {}, '
                'samples = {}, use_query_cache = {}')
               .format(self._threads,
                       self._samples,
                       self._options['use_cache']))
 
-        # TODO (djrut): When multiple queries are passed, calculate weighting for
-        # each query compared to total, and divide number of threads by this ratio
-        # to allow complex splits of concurrent queries to be run
-        # weight_sum = sum([ query['weight'] for query in queries ])
+    def column_values(self):
+        """ Values of the scenario level COLUMNS """
+        values = {'throughput': self._throughput,
+                  'cost': self._cost}
+        if self._controller:
+            values['concurrency_limit'] = self._concurrency_limit
+        if self._window:
+            values['effective_concurrency'] = self._effective_concurrency
+        if self._poller:
+            values.update({'poll_api_calls_per_query': self._poller_stats['api_calls_per_query'],
+                           'poll_delay_mean': self._poller_stats['poll_delay_mean'],
+                           'poll_delay_p95': self._poller_stats['poll_delay_p95']})
 
-        response_results = {}
-        slot_results = {}
+        return values
 
-        with ThreadPoolExecutor(max_workers=self._threads) as executor:
-            future_to_query = {}
-            for _ in range(self._threads):
-                # Interim solution for multiple queries
-                # TODO (djrut): Implement query weighting
-                query = choice(self._queries)
+    def _report(self, response_results):
+        # TODO (djrut): Add support to export results as json/csv
+        if self._controller:
+            self._controller.report()
 
-                trial = Trial(query=query,
-                              options=self._options,
-                              samples=self._samples)
+        if self._poller:
+            self._poller.report()
 
-                # Construct a dict of Future -> query name
-                future_to_query[executor.submit(trial.run)] = query.name
+        if self._meter.budget is not None:
+            print('-- Cost: ${:0.5f}, ${:0.5f} of the ${:0.2f} budget spent{}'
+                  .format(self._cost,
+                          self._meter.spent,
+                          self._meter.budget,
+                          ', budget reached' if self._meter.exhausted else ''))
 
-            for future in as_completed(future_to_query):
-                query_name = future_to_query[future]
-                try:
-                    response_times, slot_millis = future.result()
-                except Exception as e:
-                    print('Query "{}" generated exception: {}'
-                              .format(query_name, repr(e)))
-                else:
-                    if query_name in response_results:
-                        response_results[query_name].append(response_times)
-                    else:
-                        response_results[query_name] = [response_times]
+        if self._window:
+            print(('-- Steady state: {:0.1f}s window, effective concurrency = '
+                   '{:0.2f}, throughput = {:0.2f}/s')
+                  .format(self._window.length,
+                          self._effective_concurrency,
+                          self._throughput))
+
+        for query_name, result in response_results.items():
+            if result.errors or result.retries:
+                print('--- Query "{}", failed samples = {}, retries = {}'
+                      .format(query_name,
+                              format_counts(result.errors),
+                              format_counts(result.retries)))
+
+            response_times = result.series('response_time')
+            if not response_times:
+                continue
 
-        # TODO (djrut): Add support to export results as json/csv
-        for query_name, response_times in response_results.items():
             print(('--- Query "{}", threads = {}, samples = {}, mean = {:0.2f}s, '
                    'min = {:0.2f}s, max = {:0.2f}s, '
                    'std. deviation = {:0.3f}')
                   .format(query_name,
-                          self._threads,
-                          len(list(itertools.chain.from_iterable(response_times))),
-                          np.average(response_times),
-                          np.min(response_times),
-                          np.max(response_times),
-                          np.std(response_times)))
+                          result.concurrency,
+                          result.num_samples,
+                          response_times.mean(),
+                          response_times.min(),
+                          response_times.max(),
+                          response_times.std()))
+
+    def _build_trials(self):
+        """ Construct one Trial per concurrent thread """
+
+        # Queries are allocated to threads according to their weights, unless
+        # the Scenario runs a given share of a larger allocation (Coordinator)
+        allocation = self._allocation
+        if allocation is None:
+            scheduler = MixScheduler(queries=self._queries,
+                                     seed=self._options['seed'])
+            allocation = scheduler.allocate(self._threads,
+                                            mode=self._options['mix'])
+
+        # With --adaptive, the threads share a limit on the queries in flight
+        if self._options.get('adaptive'):
+            self._controller = AimdController.from_options(self._options,
+                                                           maximum=len(allocation))
+
+        shards = self._assign_shards(len(allocation))
+
+        trials = []
+        for thread, (query, shard) in enumerate(zip(allocation, shards)):
+            trials.append(Trial(query=query,
+                                options=self._options,
+                                samples=self._samples,
+                                bq_client=self._get_client(shard),
+                                sink=self._sink,
+                                tags={'scenario': self._index,
+                                      'thread': thread},
+                                controller=self._controller,
+                                window=self._window,
+                                poller=self._poller,
+                                meter=self._meter,
+                                metrics=self._metrics,
+                                shard=shard,
+                                store=self._store,
+                                thread=thread))
+
+        return trials
+
+    def _set_buckets(self, response_results, trials):
+        """ Results of the parameter buckets of a query split_by a parameter
+        report their query, for its intended share of the mix, and with
+        threads, the threads allocated to the query rather than those that
+        happened to draw the bucket """
+        threads = Counter(result_name(trial.query.name, shard=trial.shard)
+                          for trial in trials)
+
+        for trial in trials:
+            if not trial.query.split_by:
+                continue
+
+            for name in trial.results():
+                result = response_results.get(name)
+                if result is None:
+                    continue
+
+                result.query = trial.query.name
+                result.shard = trial.shard
+                if self._threads is not None:
+                    result.concurrency = threads[result_name(trial.query.name,
+                                                             shard=trial.shard)]
+
+    def _output_trials(self, trials):
+        """ Print the results of every Trial, summarising the samples of the
+        scenario in the store grouped once by query and thread """
+        order, groups = self._store.groups(('query', 'thread'), self._first_row)
+
+        for trial in trials:
+            _, query, thread = trial.key
+            first, last = groups.get((query, thread), (0, 0))
+            trial.output(trial.summary(self._first_row + order[first:last]))
+
+    def _assign_shards(self, count):
+        """ Shard of each of count threads, or None without shards """
+        if not self._shards:
+            return [None] * count
+
+        if self._shard_assignment is not None:
+            return self._shard_assignment
+
+        return assign(self._shards, count)
+
+    def _get_client(self, shard=None):
+        if shard is None:
+            return self._client_pool.get_client()
+
+        return self._client_pool.get_client(shard)
+
+    def _execute(self, trials):
+        """ Run the trials on a pool of OS threads, one thread per trial """
+
+        response_results = {}
+
+        with ThreadPoolExecutor(max_workers=self._threads) as executor:
+            future_to_trial = {}
+            for trial in trials:
+                # Construct a dict of Future -> Trial
+                future_to_trial[executor.submit(trial.run)] = trial
+
+            for future in as_completed(future_to_trial):
+                trial = future_to_trial[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print('Query "{}" generated exception: {}'
+                              .format(trial.query.name, repr(e)))
+                else:
+                    self._add_result(response_results, trial)
 
         return response_results
 
+    def _add_result(self, response_results, trial):
+        for query_name, (series, errors, retries) in trial.results().items():
+            self._add_series(response_results, query_name, series, errors, retries)
+
+    @staticmethod
+    def _add_series(response_results, query_name, series, errors, retries):
+        if query_name not in response_results:
+            response_results[query_name] = QueryResult(name=query_name)
+
+        response_results[query_name].add_trial(series,
+                                               errors=errors,
+                                               retries=retries)
+
+    @property
+    def series_names(self):
+        series_names = self.SERIES
+        if self._options['interval']:
+            series_names += self.PACED_SERIES
+
+        if any(query.fetcher.mode != 'none' for query in self._queries):
+            series_names += FETCH_SERIES
+
+        if self._options.get('max_retries'):
+            series_names += RETRY_SERIES
+
+        return series_names
+
+    @property
+    def index(self):
+        return self._index
+
     @property
     def threads(self):
         return self._threads
+
+    @property
+    def label(self):
+        if self._window:
+            return '{} concurrent threads for {}'.format(self._threads,
+                                                        self._window.label)
+
+        return '{} concurrent threads'.format(self._threads)
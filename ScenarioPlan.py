@@ -0,0 +1,313 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Scenario plans: the sequence of concurrency levels (or arrival rates) that
+an Experiment steps through.
+
+A plan is a comma separated list of items, each one of:
+
+    N           a single value, i.e. 10
+    X..Y        every value from X to Y, i.e. 1..5
+    X..Y:Z      from X to Y in steps of Z, i.e. 10..100:10
+    X..Y*F      geometric steps from X to Y by a factor F, i.e. 1..64*2
+
+Alternatively, 'search:X..Y' (or 'search:X..Y*F') is an adaptive plan that
+looks for the throughput knee between X and Y concurrent threads: it ramps up
+geometrically (by a factor of 2 by default) until steps stop paying off, then
+bisects between the last productive step and the first unproductive one. A
+step from c1 to c2 threads is productive if throughput grows by at least
+efficiency * (c2 / c1 - 1), i.e. by at least that fraction of linear scaling,
+and its p95 response time stays within latency_factor times the p95 of the
+first step. As a single noisy step could end the ramp early, an unproductive
+step is only confirmed by the next one, which must not be productive either
+compared with the last productive step; otherwise the ramp goes on.
+
+Plans are consumed one value at a time with next(), and told the outcome of
+each scenario with record(), so that an adaptive plan can pick the next value
+from the measurements so far. """
+
+import math
+
+SEARCH_PREFIX = 'search:'
+
+class ScenarioPlan(object):
+    """ A fixed sequence of values """
+
+    def __init__(self,
+                 values):
+
+        if not values:
+            raise ValueError('Scenario plan is empty')
+
+        self._values = list(values)
+        self._position = 0
+
+    def __repr__(self):
+        return 'ScenarioPlan(values = {})'.format(self._values)
+
+    def next(self):
+        """ Return the value of the next scenario, or None when done """
+        if self._position >= len(self._values):
+            return None
+
+        value = self._values[self._position]
+        self._position += 1
+        return value
+
+    def record(self, value, throughput, p95):
+        """ Outcome of the scenario run for value. Fixed plans ignore it. """
+        pass
+
+    def report(self):
+        pass
+
+    @property
+    def first(self):
+        return self._values[0]
+
+    @property
+    def values(self):
+        """ Values of the scenarios of the plan, as far as they are known in
+        advance """
+        return list(self._values)
+
+    @property
+    def max(self):
+        return max(self._values)
+
+class SaturationSearch(ScenarioPlan):
+    """ Adaptive plan that stops once the throughput knee is located """
+
+    def __init__(self,
+                 low,
+                 high,
+                 factor=2,
+                 efficiency=0.25,
+                 latency_factor=2.0,
+                 resolution=0.1):
+
+        if low < 1 or high < low:
+            raise ValueError('Invalid search range {}..{}'.format(low, high))
+        if factor <= 1:
+            raise ValueError('Search ramp factor must be greater than 1')
+
+        self._low = low
+        self._high = high
+        self._factor = factor
+        self._efficiency = efficiency
+        self._latency_factor = latency_factor
+        self._resolution = resolution
+
+        # threads -> (throughput, p95), in the order the steps were run
+        self._points = {}
+        self._baseline_p95 = None
+        self._good = None
+        self._bad = None
+        self._unconfirmed = None
+        self._pending = low
+
+    def __repr__(self):
+        return ('SaturationSearch(range = {}..{}, factor = {}, efficiency = {}, '
+                'latency_factor = {})').format(self._low,
+                                               self._high,
+                                               self._factor,
+                                               self._efficiency,
+                                               self._latency_factor)
+
+    def next(self):
+        value = self._pending
+        self._pending = None
+        return value
+
+    def record(self, value, throughput, p95):
+        self._points[value] = (throughput, p95)
+
+        if self._good is None:
+            # First step: the baseline every later p95 is compared with
+            self._baseline_p95 = p95
+            self._good = value
+            productive = True
+        else:
+            productive = self._productive(self._good, value)
+            if productive:
+                self._good = value
+                self._unconfirmed = None
+            elif (self._bad is None and self._unconfirmed is None
+                  and self._ramp(value) is not None):
+                # The first unproductive step of the ramp is confirmed (or
+                # not) by the next one
+                self._unconfirmed = value
+            else:
+                self._bad = self._unconfirmed or value
+                self._unconfirmed = None
+
+        if productive:
+            outcome = 'productive'
+        elif self._unconfirmed is not None:
+            outcome = 'unproductive, confirming'
+        else:
+            outcome = 'saturated'
+
+        print(('-- Search step: threads = {}, throughput = {:0.2f} queries/s, '
+               'p95 = {:0.2f}s, {}')
+              .format(value,
+                      throughput,
+                      p95,
+                      outcome))
+
+        if self._bad is None:
+            self._pending = self._ramp(value)
+        else:
+            self._pending = self._bisect()
+
+    def report(self):
+        if not self._points:
+            return
+
+        peak_threads = max(self._points, key=lambda value: self._points[value][0])
+        print(('- Saturation search: knee = {} concurrent threads, '
+               'peak throughput = {:0.2f} queries/s at {} threads, '
+               '{} scenarios run')
+              .format(self.knee,
+                      self._points[peak_threads][0],
+                      peak_threads,
+                      len(self._points)))
+
+        if self._bad is None:
+            print(('- Warning: throughput was still growing at {} threads, '
+                   'the knee lies beyond the search range').format(self._high))
+
+    def _productive(self, lower, upper):
+        lower_throughput, _ = self._points[lower]
+        upper_throughput, upper_p95 = self._points[upper]
+
+        # NaN (a step without samples) is never productive
+        if not upper_p95 <= self._latency_factor * self._baseline_p95:
+            return False
+
+        if lower_throughput <= 0:
+            return upper_throughput > 0
+
+        gain = upper_throughput / lower_throughput - 1
+        return gain >= self._efficiency * (upper / lower - 1)
+
+    def _ramp(self, value):
+        if value >= self._high:
+            return None
+
+        return min(max(int(math.ceil(value * self._factor)), value + 1),
+                   self._high)
+
+    def _bisect(self):
+        if self._bad - self._good <= max(1, self._resolution * self._good):
+            return None
+
+        return (self._good + self._bad) // 2
+
+    @property
+    def knee(self):
+        return self._good
+
+    @property
+    def first(self):
+        return self._low
+
+    @property
+    def values(self):
+        # Only the ramp is known in advance; bisection steps depend on the
+        # measurements
+        values = [self._low]
+        while self._ramp(values[-1]) is not None:
+            values.append(self._ramp(values[-1]))
+
+        return values
+
+    @property
+    def max(self):
+        return self._high
+
+def parse(text,
+          number=int,
+          efficiency=0.25,
+          latency_factor=2.0):
+    """ Build the ScenarioPlan described by text. number converts each value,
+    int for concurrency levels or float for arrival rates. """
+
+    text = text.strip()
+
+    if text.startswith(SEARCH_PREFIX):
+        if number is not int:
+            raise ValueError('Search plans are only supported for concurrency')
+
+        low, high, step_type, step = _parse_range(text[len(SEARCH_PREFIX):], int)
+        if step_type == ':':
+            raise ValueError('Search plans take a geometric factor (*F), '
+                             'not a step')
+
+        return SaturationSearch(low=low,
+                                high=high,
+                                factor=step or 2,
+                                efficiency=efficiency,
+                                latency_factor=latency_factor)
+
+    values = []
+    for item in text.split(','):
+        for value in _expand(item.strip(), number):
+            if value not in values:
+                values.append(value)
+
+    return ScenarioPlan(values)
+
+def _parse_range(item, number):
+    """ Split 'X..Y', 'X..Y:Z' or 'X..Y*F' into (X, Y, step type, step) """
+
+    if '..' not in item:
+        raise ValueError('Invalid range: {}'.format(item))
+
+    low, high = item.split('..', 1)
+    step_type, step = None, None
+    for separator in (':', '*'):
+        if separator in high:
+            high, step = high.split(separator, 1)
+            step_type = separator
+            step = float(step) if separator == '*' else number(step)
+
+    return number(low), number(high), step_type, step
+
+def _expand(item, number):
+    if '..' not in item:
+        return [number(item)]
+
+    low, high, step_type, step = _parse_range(item, number)
+    if high < low:
+        raise ValueError('Invalid range: {}'.format(item))
+
+    if step_type == '*':
+        if step <= 1 or low <= 0:
+            raise ValueError('Invalid geometric range: {}'.format(item))
+
+        values = []
+        value = low
+        while value <= high * (1 + 1e-9):
+            values.append(number(round(value)) if number is int else value)
+            value *= step
+
+        return values
+
+    step = step or 1
+    if step <= 0:
+        raise ValueError('Invalid range step: {}'.format(item))
+
+    count = int(math.floor((high - low) / step + 1e-9)) + 1
+    return [number(low + i * step) for i in range(count)]
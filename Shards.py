@@ -0,0 +1,174 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Shards spread the load of an Experiment across several projects and
+identities, so that per-project and per-user API quotas (jobs.insert,
+concurrent interactive queries) do not cap the load long before a shared
+reservation is busy.
+
+A shard is a project, optionally with the service account key file to
+authenticate as and the location of its jobs, and a weight. Shards are given
+as a JSON list (--shards, or 'shards' in the query file) or as a list of
+projects (--projects):
+
+    [{"project": "load-1", "credentials": "load-1.json", "weight": 2},
+     {"project": "load-2", "credentials": "load-2.json", "location": "EU"}]
+
+Every shard has a client pool of its own, holding its share of the pool size
+in proportion to its weight (and at least one connection). Threads of closed-loop scenarios,
+and arrivals of open-loop ones, are assigned to shards by smooth weighted
+round-robin: in proportion to their weights, interleaved, and the same way on
+every run; with equal weights, this is plain round-robin. Results are tagged
+with their shard (i.e. 'Query [shard=load-1]'), and so are raw samples. """
+
+import json
+from collections import namedtuple, OrderedDict
+
+Shard = namedtuple('Shard', ['name', 'project', 'credentials', 'location', 'weight'])
+
+def parse_shards(specs):
+    """ Return the Shards of a list of shard dicts """
+    shards = []
+    for position, spec in enumerate(specs):
+        if isinstance(spec, str):
+            spec = {'project': spec}
+
+        if not spec.get('project') and not spec.get('credentials'):
+            raise ValueError('Shard {} needs a project or credentials'.format(position))
+
+        weight = spec.get('weight', 1)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)):
+            raise ValueError('Shard weights must be numbers: {!r}'.format(weight))
+        if weight <= 0:
+            raise ValueError('Shard weights must be positive: {}'.format(weight))
+
+        shards.append(Shard(name=spec.get('name') or spec.get('project')
+                            or 'shard-{}'.format(position),
+                            project=spec.get('project'),
+                            credentials=spec.get('credentials'),
+                            location=spec.get('location'),
+                            weight=weight))
+
+    if len({shard.name for shard in shards}) < len(shards):
+        raise ValueError('Shard names must be unique')
+
+    return shards
+
+def load_shards(value):
+    """ Shard dicts of --shards: a JSON file, holding a list or a dict with
+    a 'shards' list """
+    with open(value) as f:
+        specs = json.load(f)
+
+    if isinstance(specs, dict):
+        specs = specs['shards']
+
+    # Validated here, so that a bad file fails before the experiment starts
+    parse_shards(specs)
+    return specs
+
+def rotation(shards):
+    """ Yield the names of shards forever, by smooth weighted round-robin """
+    current = [0.0] * len(shards)
+    total = sum(shard.weight for shard in shards)
+
+    while True:
+        for position, shard in enumerate(shards):
+            current[position] += shard.weight
+
+        chosen = max(range(len(shards)), key=lambda position: current[position])
+        current[chosen] -= total
+        yield shards[chosen].name
+
+def assign(shards, count):
+    """ Names of the shards of count threads or arrivals """
+    names = rotation(shards)
+    return [next(names) for _ in range(count)]
+
+def split(shards, size):
+    """ {shard name: pool size} of shards sharing size connections, in
+    proportion to their weights, as threads are assigned to them, and at
+    least one each. Connections left over by rounding go to the shards with
+    the largest remainders. """
+    total = sum(shard.weight for shard in shards)
+    shares = [size * shard.weight / total for shard in shards]
+    sizes = [max(1, int(share)) for share in shares]
+
+    left = size - sum(sizes)
+    by_remainder = sorted(range(len(shards)),
+                          key=lambda position: shares[position] - int(shares[position]),
+                          reverse=True)
+    for position in by_remainder[:max(0, left)]:
+        sizes[position] += 1
+
+    return OrderedDict((shard.name, pool_size)
+                       for shard, pool_size in zip(shards, sizes))
+
+def client_pool(backend, options, size):
+    """ Client pool of an Experiment or Worker: a ShardedClientPool if the
+    options have shards, or the single pool of the backend """
+    if not options.get('shards'):
+        return backend.client_pool(size=size)
+
+    shards = parse_shards(options['shards'])
+    return ShardedClientPool(shards=shards,
+                             pools=backend.client_pools(split(shards, size), shards))
+
+class ShardedClientPool(object):
+    """ Stands in for a ClientPool: one pool per shard, as created by the
+    backend (simulated backends share a single pool of slots between all
+    shards, as projects share a reservation) """
+
+    def __init__(self,
+                 shards,
+                 pools):
+
+        self._shards = shards
+        self._pools = OrderedDict((shard.name, pools[shard.name]) for shard in shards)
+
+    def __repr__(self):
+        return 'ShardedClientPool(shards = {})'.format(', '.join(self._pools))
+
+    def get_client(self, shard=None):
+        """ The client of a shard, by default of the first one """
+        if shard is None:
+            shard = self._shards[0].name
+
+        return self._pools[shard].get_client()
+
+    def stats(self):
+        return {name: pool.stats() for name, pool in self._pools.items()}
+
+    def report(self, since=None):
+        reported = set()
+        distinct = len({id(pool) for pool in self._pools.values()})
+
+        for name, pool in self._pools.items():
+            if id(pool) in reported:
+                continue
+            reported.add(id(pool))
+
+            if distinct > 1:
+                print('-- Shard "{}":'.format(name))
+            pool.report(since=since.get(name) if since else None)
+
+    @property
+    def shards(self):
+        return self._shards
+
+    @property
+    def size(self):
+        """ Connections of all the distinct pools of the shards """
+        pools = {id(pool): pool for pool in self._pools.values()}
+        return sum(pool.size for pool in pools.values())
@@ -0,0 +1,726 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Local, offline stand-in for the BigQuery client, used by the 'simulated'
+backend to rehearse experiments without spending slots or money.
+
+Jobs run in real (wall clock) time against a finite pool of slots shared by
+every job in flight. Running jobs share the slots fairly (processor sharing),
+each one using at most its 'max_slots', so response times stretch as
+concurrency grows past the point where the slots are saturated. Beyond
+'max_concurrent_jobs', jobs wait in a FIFO queue before they start.
+
+A job goes through:
+
+    submit_latency    API call creating the job (the job is created half way)
+    startup_latency   planning, before the job competes for slots
+    queue             waiting for one of max_concurrent_jobs
+    work              slot-seconds of work, at its share of the slots
+    page_latency      per page of rows read from the results
+
+Latencies and work are either a number of seconds, or a distribution:
+{'distribution': 'lognormal', 'median': m, 'sigma': s},
+{'distribution': 'exponential', 'mean': m},
+{'distribution': 'normal', 'mean': m, 'std': s} (clipped at zero) or
+{'distribution': 'uniform', 'low': a, 'high': b}.
+
+Errors are injected with a probability per job, either when the job is
+submitted or when it completes, as the same google.api_core exceptions (with
+an HTTP code and an errors[0]['reason']) the real client raises, or as a
+SimulatedError with the same attributes without google-cloud-bigquery. An
+error with 'above_jobs' is only injected while at least that many jobs are in
+the system, i.e. to model quota errors under load. """
+
+import math
+import time
+import heapq
+import itertools
+import threading
+import datetime
+from collections import deque, Counter
+import numpy as np
+from Pricing import MIN_MBYTES_BILLED
+
+try:
+    from google.api_core import exceptions
+except ImportError:
+    exceptions = None
+
+DEFAULT_CONFIG = {'slots': 2000,
+                  'max_concurrent_jobs': 100,
+                  'seed': None,
+                  'submit_latency': {'distribution': 'lognormal',
+                                     'median': 0.1,
+                                     'sigma': 0.3},
+                  'startup_latency': {'distribution': 'lognormal',
+                                      'median': 0.3,
+                                      'sigma': 0.5},
+                  'api_latency': {'distribution': 'lognormal',
+                                  'median': 0.05,
+                                  'sigma': 0.3},
+                  'page_latency': 0.05,
+                  'page_rows': 10000,
+                  'errors': [],
+                  # Default profile of every query, overridden by the
+                  # 'simulation' option of a query
+                  'query': {'work': {'distribution': 'lognormal',
+                                     'median': 20,
+                                     'sigma': 0.5},
+                            'max_slots': 500,
+                            'mbytes': 1000,
+                            'rows': 100,
+                            'row_bytes': 100}}
+
+def sample(spec, random_state):
+    """ Draw a value from a latency/work specification """
+
+    if not isinstance(spec, dict):
+        return float(spec)
+
+    distribution = spec['distribution']
+    if distribution == 'lognormal':
+        return random_state.lognormal(math.log(spec['median']), spec['sigma'])
+    elif distribution == 'exponential':
+        return random_state.exponential(spec['mean'])
+    elif distribution == 'normal':
+        return max(random_state.normal(spec['mean'], spec['std']), 0.0)
+    elif distribution == 'uniform':
+        return random_state.uniform(spec['low'], spec['high'])
+
+    raise ValueError('Unknown distribution: {}'.format(distribution))
+
+class SimulatedError(Exception):
+    """ API error of an HTTP code and errors, when google.api_core is not
+    installed """
+
+    def __init__(self,
+                 code,
+                 message,
+                 errors=()):
+
+        super().__init__('{} {}'.format(code, message))
+        self.code = code
+        self.message = message
+        self.errors = list(errors)
+
+class SimulatedJobConfig(object):
+    def __init__(self,
+                 use_query_cache=False,
+                 profile=None,
+                 query_parameters=()):
+
+        self.use_query_cache = use_query_cache
+        self.profile = profile or {}
+        self.query_parameters = query_parameters
+        self.dry_run = False
+
+class SimulatedTable(object):
+    """ Destination table of a job, also used as its reference """
+
+    def __init__(self,
+                 table_id,
+                 num_rows,
+                 row_bytes,
+                 project='simulated'):
+
+        self.project = project
+        self.dataset_id = '_simulated'
+        self.table_id = table_id
+        self.num_rows = num_rows
+        self.num_bytes = num_rows * row_bytes
+
+class SimulatedPage(object):
+    def __init__(self,
+                 num_items):
+
+        self.num_items = num_items
+
+class SimulatedRowIterator(object):
+    def __init__(self,
+                 client,
+                 table,
+                 page_size=None):
+
+        self._client = client
+        self._table = table
+        self._page_size = page_size or client.config['page_rows']
+        self.schema = []
+        self.total_rows = table.num_rows
+
+    @property
+    def pages(self):
+        remaining = self._table.num_rows
+        while remaining > 0:
+            time.sleep(self._client.sample('page_latency'))
+            self._client.count('api_calls')
+
+            num_items = min(remaining, self._page_size)
+            remaining -= num_items
+            yield SimulatedPage(num_items)
+
+class SimulatedJobIterator(object):
+    """ Jobs returned by list_jobs, in pages of page_size jobs. Every page,
+    even an empty one, is an API call. """
+
+    def __init__(self,
+                 client,
+                 jobs,
+                 page_size=1000):
+
+        self._client = client
+        self._jobs = jobs
+        self._page_size = page_size
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    @property
+    def pages(self):
+        offset = 0
+        while True:
+            self._client.api_call()
+            yield self._jobs[offset:offset + self._page_size]
+
+            offset += self._page_size
+            if offset >= len(self._jobs):
+                return
+
+class SimulatedJob(object):
+    def __init__(self,
+                 client,
+                 job_id,
+                 work,
+                 max_slots,
+                 mbytes,
+                 destination,
+                 error=None,
+                 cache_key=None):
+
+        self._client = client
+        self._cache_key = cache_key
+        self.job_id = job_id
+        self.destination = destination
+        self.query_plan = []
+
+        self.total_bytes_processed = int(mbytes * 1024 * 1024)
+        self.total_bytes_billed = (int(max(math.ceil(mbytes), MIN_MBYTES_BILLED)
+                                       * 1024 * 1024)
+                                   if mbytes else 0)
+
+        self.created = None
+        self.started = None
+        self.ended = None
+        self.state = 'PENDING'
+
+        # Maintained by the SlotPool
+        self.remaining = work
+        self.max_slots = max_slots
+        self.slot_seconds = 0.0
+
+        self._error = error
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return 'SimulatedJob(job_id = {}, state = {})'.format(self.job_id,
+                                                             self.state)
+
+    def done(self, retry=None, timeout=None):
+        # Like the real client, every status check is an API call
+        self._client.api_call()
+        return self._event.is_set()
+
+    def reload(self, retry=None):
+        self._client.api_call()
+
+    def exception(self, timeout=None):
+        self._event.wait(timeout)
+        return self._error
+
+    def result(self, timeout=None, retry=None):
+        self._event.wait(timeout)
+        if self._error is not None:
+            raise self._error
+
+        return SimulatedRowIterator(self._client, self.destination)
+
+    @property
+    def slot_millis(self):
+        return int(self.slot_seconds * 1000)
+
+    @property
+    def error_result(self):
+        if self._error is None:
+            return None
+
+        return self._error.errors[0]
+
+    def _start(self, when):
+        self.started = when
+        self.state = 'RUNNING'
+
+    def _finish(self, when):
+        self.ended = when
+        self.state = 'DONE'
+
+        # Only the results of jobs that succeed are cached, once they exist
+        if self._error is None and self._cache_key is not None:
+            self._client.cache(self._cache_key)
+
+        self._event.set()
+
+class SlotPool(object):
+    """ Processor sharing of a finite number of slots between running jobs,
+    driven by a background thread that wakes up at every job arrival and
+    completion """
+
+    def __init__(self,
+                 slots,
+                 max_concurrent_jobs=None):
+
+        self._slots = slots
+        self._max_concurrent_jobs = max_concurrent_jobs
+
+        self._condition = threading.Condition()
+        self._arrivals = []
+        self._sequence = itertools.count()
+        self._queued = deque()
+        self._running = []
+        self._rates = []
+        self._last = time.perf_counter()
+        self._slot_seconds = 0.0
+
+        # Timestamps of the jobs are wall clock datetimes, as with BigQuery
+        self._offset = time.time() - time.perf_counter()
+
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, job, delay=0.0):
+        """ Add a job, which starts competing for slots after delay seconds """
+
+        with self._condition:
+            now = time.perf_counter()
+            job.created = self._timestamp(now)
+            heapq.heappush(self._arrivals, (now + delay, next(self._sequence), job))
+            self._condition.notify()
+
+    def list_jobs(self, state):
+        """ Jobs in state 'pending' or 'running' """
+        with self._condition:
+            if state == 'pending':
+                return ([job for _, _, job in self._arrivals]
+                        + list(self._queued))
+            elif state == 'running':
+                return list(self._running)
+
+        return []
+
+    def jobs(self):
+        """ Jobs submitted and not yet done """
+        with self._condition:
+            return len(self._arrivals) + len(self._queued) + len(self._running)
+
+    def slot_seconds(self):
+        with self._condition:
+            self._advance(time.perf_counter())
+            return self._slot_seconds
+
+    def _loop(self):
+        with self._condition:
+            while True:
+                now = time.perf_counter()
+                self._advance(now)
+                self._condition.wait(self._next_event(now))
+
+    def _advance(self, now):
+        # Progress of the running jobs, at the rates set at the last event
+        elapsed = now - self._last
+        self._last = now
+        for job, rate in zip(self._running, self._rates):
+            job.remaining -= rate * elapsed
+            job.slot_seconds += rate * elapsed
+            self._slot_seconds += rate * elapsed
+
+        for job in [job for job in self._running if job.remaining <= 1e-9]:
+            self._running.remove(job)
+            job._finish(self._timestamp(now))
+
+        while self._arrivals and self._arrivals[0][0] <= now:
+            self._queued.append(heapq.heappop(self._arrivals)[2])
+
+        while self._queued and (self._max_concurrent_jobs is None
+                                or len(self._running) < self._max_concurrent_jobs):
+            job = self._queued.popleft()
+            job._start(self._timestamp(now))
+            self._running.append(job)
+
+        self._rates = self._share()
+
+    def _share(self):
+        """ Fair share of the slots, capped at the max_slots of each job; what
+        a capped job cannot use is shared by the others """
+
+        rates = [0.0] * len(self._running)
+        available = float(self._slots)
+        order = sorted(range(len(self._running)),
+                       key=lambda index: self._running[index].max_slots)
+
+        for position, index in enumerate(order):
+            share = available / (len(order) - position)
+            rates[index] = min(self._running[index].max_slots, share)
+            available -= rates[index]
+
+        return rates
+
+    def _next_event(self, now):
+        times = [job.remaining / rate
+                 for job, rate in zip(self._running, self._rates) if rate > 0]
+        if self._arrivals:
+            times.append(self._arrivals[0][0] - now)
+
+        return max(min(times), 0.0) if times else None
+
+    def _timestamp(self, when):
+        return datetime.datetime.fromtimestamp(when + self._offset,
+                                               tz=datetime.timezone.utc)
+
+    @property
+    def slots(self):
+        return self._slots
+
+class SimulatedClient(object):
+    """ Implements the parts of bigquery.Client used by the harness """
+
+    def __init__(self,
+                 config=None,
+                 project='simulated'):
+
+        # The query profile is merged rather than replaced, so that a model
+        # may only set some of its parameters
+        config = config or {}
+        self.config = {**DEFAULT_CONFIG,
+                       **config,
+                       'query': {**DEFAULT_CONFIG['query'], **config.get('query', {})}}
+        self.project = project
+
+        self._lock = threading.Lock()
+        self._random_state = np.random.RandomState(self.config['seed'])
+        self._job_ids = itertools.count()
+        self._counters = Counter()
+        self._cache = set()
+        self._start = time.perf_counter()
+
+        self._slot_pool = SlotPool(slots=self.config['slots'],
+                                   max_concurrent_jobs=self.config['max_concurrent_jobs'])
+
+    def __repr__(self):
+        return 'SimulatedClient(slots = {}, max_concurrent_jobs = {})'.format(
+            self.config['slots'],
+            self.config['max_concurrent_jobs'])
+
+    def query(self, sql, job_config=None, **kwargs):
+        job_config = job_config or SimulatedJobConfig()
+        profile = {**self.config['query'], **job_config.profile}
+
+        # Dry runs only report the bytes the query would process
+        if job_config.dry_run:
+            return SimulatedJob(client=self,
+                                job_id=None,
+                                work=0.0,
+                                max_slots=profile['max_slots'],
+                                mbytes=profile['mbytes'],
+                                destination=None)
+
+        # As in BigQuery, the values of query parameters are part of the key
+        # of the result cache
+        cache_key = (sql, tuple(job_config.query_parameters))
+        cached = job_config.use_query_cache and cache_key in self._cache
+
+        submit_latency = self.sample('submit_latency')
+        time.sleep(submit_latency / 2)
+
+        submit_error = self._inject_error('submit')
+        if submit_error is not None:
+            time.sleep(submit_latency / 2)
+            raise submit_error
+
+        with self._lock:
+            job_id = 'simulated_{}'.format(next(self._job_ids))
+            work = 0.0 if cached else sample(profile['work'], self._random_state)
+            rows = int(sample(profile['rows'], self._random_state))
+
+        execution_error = self._inject_error('execution')
+
+        job = SimulatedJob(client=self,
+                           job_id=job_id,
+                           work=work,
+                           max_slots=profile['max_slots'],
+                           mbytes=0 if cached else profile['mbytes'],
+                           destination=SimulatedTable(table_id='anon_' + job_id,
+                                                      num_rows=rows,
+                                                      row_bytes=profile['row_bytes'],
+                                                      project=self.project),
+                           error=execution_error,
+                           cache_key=cache_key)
+
+        self._slot_pool.submit(job,
+                               delay=0.0 if cached else self.sample('startup_latency'))
+        self.count('jobs')
+
+        time.sleep(submit_latency / 2)
+        return job
+
+    def list_rows(self, table, selected_fields=None, page_size=None, **kwargs):
+        return SimulatedRowIterator(self, table, page_size=page_size)
+
+    def list_jobs(self, state_filter=None, **kwargs):
+        # Completed jobs are not kept, so only jobs in flight are listed
+        states = [state_filter] if state_filter else ['pending', 'running']
+        return SimulatedJobIterator(self, [job
+                                           for state in states
+                                           for job in self._slot_pool.list_jobs(state)])
+
+    def get_table(self, table):
+        self.api_call()
+        return table
+
+    def cache(self, cache_key):
+        """ Cache the results of a completed job """
+        with self._lock:
+            self._cache.add(cache_key)
+
+    def api_call(self):
+        time.sleep(self.sample('api_latency'))
+        self.count('api_calls')
+
+    def sample(self, name):
+        with self._lock:
+            return sample(self.config[name], self._random_state)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+
+        return {'jobs': counters.get('jobs', 0),
+                'errors': counters.get('errors', 0),
+                'api_calls': counters.get('api_calls', 0),
+                'slot_seconds': self._slot_pool.slot_seconds(),
+                'time': time.perf_counter() - self._start}
+
+    def _inject_error(self, phase):
+        """ Return the exception to fail with in phase, if any """
+
+        for error in self.config['errors']:
+            if error.get('phase', 'execution') != phase:
+                continue
+
+            # Quota errors typically only occur above some level of load
+            if error.get('above_jobs') and self._slot_pool.jobs() < error['above_jobs']:
+                continue
+
+            with self._lock:
+                failed = self._random_state.uniform() < error['rate']
+
+            if failed:
+                self.count('errors')
+                message = 'Simulated {} error'.format(error['reason'])
+                errors = [{'reason': error['reason'], 'message': message}]
+
+                if exceptions is None:
+                    return SimulatedError(error.get('code', 500), message, errors)
+
+                return exceptions.from_http_status(error.get('code', 500),
+                                                   message,
+                                                   errors=errors)
+
+        return None
+
+class StubJob(object):
+    """ Job of a StubClient, done a fixed latency after its creation """
+
+    def __init__(self,
+                 client,
+                 job_id,
+                 latency,
+                 destination):
+
+        self._client = client
+        self.job_id = job_id
+        self.destination = destination
+        self.query_plan = []
+        self.total_bytes_processed = 0
+        self.total_bytes_billed = 0
+        self.slot_millis = 0
+        self.error_result = None
+
+        self._deadline = time.perf_counter() + latency
+        self.created = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.started = self.created
+        self.ended = self.created + datetime.timedelta(seconds=latency)
+
+    def __repr__(self):
+        return 'StubJob(job_id = {})'.format(self.job_id)
+
+    @property
+    def state(self):
+        return 'DONE' if time.perf_counter() >= self._deadline else 'RUNNING'
+
+    def done(self, retry=None, timeout=None):
+        return time.perf_counter() >= self._deadline
+
+    def reload(self, retry=None):
+        pass
+
+    def exception(self, timeout=None):
+        self._wait()
+        return None
+
+    def result(self, timeout=None, retry=None):
+        self._wait()
+        return SimulatedRowIterator(self._client, self.destination)
+
+    def _wait(self):
+        delay = self._deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+class StubClient(object):
+    """ Client whose jobs complete after a fixed latency, without any model,
+    randomness or background thread, so that what is measured is the harness
+    itself """
+
+    def __init__(self,
+                 latency=0.0,
+                 project='stub'):
+
+        self.config = {'slots': None, 'page_rows': 10000, 'page_latency': 0.0}
+        self.project = project
+
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._jobs = 0
+        self._running = deque()
+        self._start = time.perf_counter()
+
+    def __repr__(self):
+        return 'StubClient(latency = {})'.format(self._latency)
+
+    def query(self, sql, job_config=None, **kwargs):
+        if job_config is not None and job_config.dry_run:
+            return StubJob(client=self,
+                           job_id=None,
+                           latency=0.0,
+                           destination=None)
+
+        with self._lock:
+            job_id = 'stub_{}'.format(self._jobs)
+            self._jobs += 1
+
+        job = StubJob(client=self,
+                      job_id=job_id,
+                      latency=self._latency,
+                      destination=SimulatedTable(table_id='anon_' + job_id,
+                                                 num_rows=0,
+                                                 row_bytes=0,
+                                                 project=self.project))
+
+        with self._lock:
+            self._running.append(job)
+            self._expire()
+
+        return job
+
+    def list_jobs(self, state_filter=None, **kwargs):
+        # Stub jobs are running until their latency has elapsed
+        with self._lock:
+            self._expire()
+            jobs = list(self._running) if state_filter in (None, 'running') else []
+
+        return SimulatedJobIterator(self, jobs)
+
+    def api_call(self):
+        # Stub API calls take no time
+        pass
+
+    def _expire(self):
+        # Jobs share the same latency, so they are done in creation order
+        while self._running and self._running[0].done():
+            self._running.popleft()
+
+    def list_rows(self, table, selected_fields=None, page_size=None, **kwargs):
+        return SimulatedRowIterator(self, table, page_size=page_size)
+
+    def get_table(self, table):
+        return table
+
+    def sample(self, name):
+        return self.config[name]
+
+    def count(self, name, value=1):
+        pass
+
+    def stats(self):
+        return {'jobs': self._jobs,
+                'errors': 0,
+                'api_calls': 0,
+                'slot_seconds': 0.0,
+                'time': time.perf_counter() - self._start}
+
+class SimulatedClientPool(object):
+    """ Stands in for a ClientPool: every Trial shares a single simulated
+    client, and so a single pool of slots """
+
+    def __init__(self,
+                 size,
+                 client):
+
+        self._size = size
+        self._client = client
+
+    def __repr__(self):
+        return 'SimulatedClientPool(client = {})'.format(self._client)
+
+    def get_client(self):
+        return self._client
+
+    def stats(self):
+        return self._client.stats()
+
+    def report(self, since=None):
+        stats = self.stats()
+        if since:
+            stats = {field: stats[field] - since.get(field, 0)
+                     for field in stats}
+
+        slots = self._client.config['slots']
+        utilisation = 0.0
+        if slots and stats['time'] > 0:
+            utilisation = stats['slot_seconds'] / (stats['time'] * slots)
+
+        print(('-- Simulated backend: slots = {}, jobs = {}, errors = {}, '
+               'API calls = {}, slot utilisation = {:0.1%}')
+              .format(slots,
+                      stats['jobs'],
+                      stats['errors'],
+                      stats['api_calls'],
+                      utilisation))
+
+    @property
+    def size(self):
+        return self._size
@@ -12,8 +12,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-""" Wrapper class for a statistic function that is executed over a list of
-values """
+""" Wrapper class for a statistic function that is executed over a Histogram
+summary of values """
 
 class Statistic(object):
     def __init__(self,
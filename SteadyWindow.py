@@ -0,0 +1,94 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Steady-state window of a duration-based Scenario. Queries are issued for
+duration seconds from the start of the scenario; the first warmup seconds
+(connection setup, authentication, cold caches) and the last cooldown seconds
+(threads finishing at different times) are excluded, and only the samples
+whose whole lifetime falls inside the remaining window feed the statistics:
+
+    start        begin                        end          deadline
+      |  warmup  |         steady state        |  cooldown  |
+
+The time every sample spends in flight inside the window, summed over all
+samples and divided by the length of the window, is the effective
+concurrency of the scenario. """
+
+import time
+
+class SteadyWindow(object):
+    def __init__(self,
+                 duration,
+                 warmup=0.0,
+                 cooldown=0.0):
+
+        if warmup < 0 or cooldown < 0 or warmup + cooldown >= duration:
+            raise ValueError(('Warm-up ({}s) and cool-down ({}s) must leave a '
+                              'steady-state window in a duration of {}s')
+                             .format(warmup, cooldown, duration))
+
+        self._duration = duration
+        self._warmup = warmup
+        self._cooldown = cooldown
+        self._start = None
+
+    def __repr__(self):
+        return 'SteadyWindow(duration = {}s, warmup = {}s, cooldown = {}s)'.format(
+            self._duration,
+            self._warmup,
+            self._cooldown)
+
+    def start(self, now=None):
+        """ Start the window at now (time.perf_counter() by default) """
+        self._start = time.perf_counter() if now is None else now
+
+    def expired(self):
+        """ Whether queries should no longer be issued """
+        return time.perf_counter() >= self.deadline
+
+    def contains(self, start, end):
+        """ Whether a sample from start to end is entirely in the window """
+        return self.begin <= start and end <= self.end
+
+    def overlap(self, start, end):
+        """ Seconds of start to end inside the window """
+        return max(0.0, min(end, self.end) - max(start, self.begin))
+
+    @property
+    def begin(self):
+        return self._start + self._warmup
+
+    @property
+    def end(self):
+        return self._start + self._duration - self._cooldown
+
+    @property
+    def deadline(self):
+        return self._start + self._duration
+
+    @property
+    def label(self):
+        return '{}s ({}s warm-up, {}s cool-down)'.format(self._duration,
+                                                         self._warmup,
+                                                         self._cooldown)
+
+    @property
+    def length(self):
+        return self._duration - self._warmup - self._cooldown
+
+    @classmethod
+    def from_options(cls, options):
+        return cls(duration=options['duration'],
+                   warmup=options.get('warmup') or 0.0,
+                   cooldown=options.get('cooldown') or 0.0)
@@ -0,0 +1,237 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Timeline of a scenario reconstructed from the intervals of its raw
+samples: the queries actually in flight, the slots in use and the
+completions over time, rather than the configured number of threads.
+
+Every sample is an interval: from its submission to its end on the client
+(start_time to end_time), and from the start to the end of its job on the
+server (started_time to ended_time). A sweep line over the interval
+boundaries, sorted once, gives the number of intervals open between every
+pair of consecutive boundaries as a cumulative sum; slots in use are the same
+sweep with every job weighing its slot_millis spread evenly over its
+execution. All of it is vectorized with NumPy, so millions of samples take
+seconds.
+
+Time-weighted statistics weigh every level of a step function by how long
+it lasted: the effective concurrency is the time-weighted mean of the queries
+in flight (Little's law: the total time in flight divided by the span of the
+scenario), and the percentiles are those of the level over time. """
+
+from array import array
+import numpy as np
+from SampleSink import read_records, completed_scenarios
+
+class Timeline(object):
+    def __init__(self,
+                 starts,
+                 ends,
+                 run_starts=None,
+                 run_ends=None,
+                 slot_millis=None,
+                 response_times=None):
+
+        self._starts = np.asarray(starts, dtype=float)
+        self._ends = np.asarray(ends, dtype=float)
+
+        # Server side intervals and slot usage are only known for completed
+        # jobs; missing values are NaN
+        missing = np.full(len(self._starts), np.nan)
+        self._run_starts = missing if run_starts is None else np.asarray(run_starts, dtype=float)
+        self._run_ends = missing if run_ends is None else np.asarray(run_ends, dtype=float)
+        self._slot_millis = missing if slot_millis is None else np.asarray(slot_millis, dtype=float)
+        self._response_times = (self._ends - self._starts if response_times is None
+                                else np.asarray(response_times, dtype=float))
+
+        self._origin = self._starts.min() if len(self._starts) else 0.0
+        self._span = (self._ends.max() - self._origin) if len(self._starts) else 0.0
+
+    def __repr__(self):
+        return 'Timeline(samples = {}, span = {:0.1f}s)'.format(len(self._starts),
+                                                               self._span)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def in_flight(self):
+        """ Step function (boundaries, levels) of the queries in flight on
+        the client """
+        return _sweep(self._starts, self._ends)
+
+    def running(self):
+        """ Step function of the jobs running on the server """
+        known = ~(np.isnan(self._run_starts) | np.isnan(self._run_ends))
+        return _sweep(self._run_starts[known], self._run_ends[known])
+
+    def slots(self):
+        """ Step function of the slots in use, every job using its slot_millis
+        evenly over its execution """
+        known = ~(np.isnan(self._run_starts) | np.isnan(self._run_ends)
+                  | np.isnan(self._slot_millis))
+        starts = self._run_starts[known]
+        ends = self._run_ends[known]
+
+        # Jobs too short to have a measurable execution are spread over 1ms
+        durations = np.maximum(ends - starts, 1e-3)
+        return _sweep(starts, starts + durations, self._slot_millis[known] / 1000 / durations)
+
+    def series(self, resolution=1.0):
+        """ Return {column: array} of the time series of the timeline, one row
+        per resolution seconds from its first sample: mean queries in flight,
+        jobs running and slots in use, and completions per second """
+
+        bins = max(1, int(np.ceil(self._span / resolution)))
+        edges = self._origin + np.arange(bins + 1) * resolution
+
+        completions, _ = np.histogram(self._ends, bins=edges)
+
+        return {'time': edges[:-1] - self._origin,
+                'in_flight': _average(*self.in_flight(), edges),
+                'running': _average(*self.running(), edges),
+                'slots': _average(*self.slots(), edges),
+                'completions_per_second': completions / resolution}
+
+    def effective_concurrency(self):
+        """ Time-weighted mean of the queries in flight """
+        if self._span <= 0:
+            return 0.0
+
+        return float(np.sum(self._ends - self._starts) / self._span)
+
+    def percentiles(self, step_function, qs):
+        """ Time-weighted percentiles of a step function over the span of the
+        timeline """
+        return _weighted_percentiles(*step_function, qs)
+
+    def latency_by_concurrency(self, bands=10):
+        """ Return [(low, high, samples, mean, p95)] of the response times of
+        the samples by the number of queries in flight when they were
+        submitted (including themselves), in up to bands bands of equal
+        numbers of samples """
+
+        sorted_starts = np.sort(self._starts)
+        sorted_ends = np.sort(self._ends)
+        concurrency = (np.searchsorted(sorted_starts, self._starts, side='right')
+                       - np.searchsorted(sorted_ends, self._starts, side='right'))
+
+        levels = np.unique(concurrency)
+        if len(levels) <= bands:
+            edges = np.append(levels, levels[-1] + 1)
+        else:
+            ranked = np.sort(concurrency)
+            positions = (np.linspace(0, 1, bands + 1) * (len(ranked) - 1)).astype(int)
+            edges = np.unique(ranked[positions])
+            edges[-1] = ranked[-1] + 1
+
+        rows = []
+        band_indexes = np.searchsorted(edges, concurrency, side='right') - 1
+        for band in range(len(edges) - 1):
+            response_times = self._response_times[band_indexes == band]
+            response_times = response_times[~np.isnan(response_times)]
+            if not len(response_times):
+                continue
+
+            rows.append((int(edges[band]),
+                         int(edges[band + 1] - 1),
+                         len(response_times),
+                         float(response_times.mean()),
+                         float(np.percentile(response_times, 95))))
+
+        return rows
+
+    @property
+    def span(self):
+        return self._span
+
+def _sweep(starts, ends, weights=None):
+    """ Step function (boundaries, levels) of the sum of the weights of the
+    intervals open between consecutive boundaries: levels[i] holds from
+    boundaries[i] to boundaries[i + 1] """
+
+    if not len(starts):
+        return np.zeros(0), np.zeros(0)
+
+    if weights is None:
+        weights = np.ones(len(starts))
+
+    times = np.concatenate([starts, ends])
+    deltas = np.concatenate([weights, -weights])
+
+    # Ends sort before starts at the same time, so that back to back queries
+    # do not count as overlapping
+    # Weights are never negative, nor is their sum but for rounding errors
+    order = np.lexsort((deltas, times))
+    return times[order], np.maximum(np.cumsum(deltas[order]), 0.0)
+
+def _average(boundaries, levels, edges):
+    """ Mean level of a step function over every bin between edges """
+    if not len(boundaries):
+        return np.zeros(len(edges) - 1)
+
+    # The integral of the step function is piecewise linear between its
+    # boundaries, so it is interpolated at the edges of the bins
+    area = np.concatenate([[0.0], np.cumsum(levels[:-1] * np.diff(boundaries))])
+    at_edges = np.interp(edges, boundaries, area)
+    return np.diff(at_edges) / np.diff(edges)
+
+def _weighted_percentiles(boundaries, levels, qs):
+    if len(boundaries) < 2:
+        return [0.0 for _ in qs]
+
+    durations = np.diff(boundaries)
+    levels = levels[:-1]
+
+    order = np.argsort(levels, kind='stable')
+    cumulative = np.cumsum(durations[order])
+    if cumulative[-1] <= 0:
+        return [float(levels.max()) for _ in qs]
+
+    positions = np.searchsorted(cumulative, np.asarray(qs) / 100 * cumulative[-1])
+    return [float(levels[order][min(position, len(order) - 1)])
+            for position in positions]
+
+def load_timelines(path):
+    """ Return {scenario index: (label, Timeline)} of the completed scenarios
+    of a raw output, in a single streaming pass over its samples """
+
+    completed = completed_scenarios(path)
+
+    columns = {}
+    for record in read_records(path):
+        if record['event'] != 'sample':
+            continue
+
+        index = record['scenario']
+        if index not in completed or completed[index][0] != record['run_id']:
+            continue
+
+        if index not in columns:
+            columns[index] = tuple(array('d') for _ in range(6))
+
+        starts, ends, run_starts, run_ends, slot_millis, response_times = columns[index]
+        starts.append(record['start_time'])
+        ends.append(record['end_time'])
+        run_starts.append(_value(record.get('started_time')))
+        run_ends.append(_value(record.get('ended_time')))
+        slot_millis.append(_value(record.get('slot_millis')))
+        response_times.append(_value(record.get('response_time')))
+
+    return {index: (completed[index][1]['label'],
+                    Timeline(*(np.frombuffer(column, dtype=float)
+                               for column in columns[index])))
+            for index in sorted(columns)}
+
+def _value(value):
+    return np.nan if value is None else value
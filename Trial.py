@@ -16,55 +16,659 @@
 a number (samples) of times """
 
 import time
+import json
+import asyncio
+import itertools
 import numpy as np
-from google.cloud import bigquery
+from collections import Counter
+from Backend import get_backend
+from Histogram import Histogram
+from SampleStore import SampleStore, VALUE_COLUMNS
+from QueryResult import result_name
+from Retry import RetryPolicy, classify, format_counts
+from Pricing import COST_PER_MB
 
-COST_PER_MB = 5 / (1024**2)
+# Phases every response time is broken down into. submit_rtt is the time taken
+# by the API call creating the job, queue_wait (from the end of that call) and
+# execution come from the job's started/ended timestamps, result_fetch is the
+# time taken to fetch results once the job was seen to be done, and
+# client_overhead is the remainder (mostly the delay before the client notices
+# the job is done), so that the phases of a sample (with its retry_wait, if it
+# was retried) add up to its response time.
+PHASES = ('submit_rtt',
+          'queue_wait',
+          'execution',
+          'result_fetch',
+          'client_overhead')
+
+# Result delivery throughput, for queries that fetch rows (see ResultFetcher)
+FETCH_SERIES = ('fetch_rows_per_second',
+                'fetch_mbytes_per_second')
+
+# Time spent on failed attempts and backoff before the successful attempt of a
+# retried sample, which the PHASES of that attempt do not include
+RETRY_SERIES = ('retry_wait',)
 
 class Trial(object):
     def __init__(self,
                  query,
                  options,
                  samples=3,
-                 reducer=lambda x:np.average(x)):
+                 bq_client=None,
+                 sink=None,
+                 tags=None,
+                 retry=None,
+                 controller=None,
+                 window=None,
+                 poller=None,
+                 meter=None,
+                 metrics=None,
+                 shard=None,
+                 store=None,
+                 thread=0):
 
         self._query = query
         self._options = options
         self._samples = samples
-        self._reducer = reducer
+        self._sink = sink
+        self._tags = tags or {}
+
+        # Samples of sharded experiments are tagged with the shard whose
+        # client runs them (see Shards)
+        self._shard = shard
+        if shard is not None:
+            self._tags = {**self._tags, 'shard': shard}
+        self._retry = retry or RetryPolicy.from_options(options)
+
+        # Optional AimdController limiting the queries in flight
+        self._controller = controller
+
+        # Duration-based scenarios run until the deadline of their
+        # SteadyWindow, and only keep the statistics of steady-state samples
+        self._window = window
+
+        # With --polling=batch, the JobPoller of the Scenario tells when jobs
+        # are done, rather than every Trial polling its own job
+        self._poller = poller
+
+        # The CostMeter of the Experiment, which stops samples once the
+        # --max-cost budget is reached
+        self._meter = meter
+
+        # Optional LiveMetrics of the Experiment, told about every sample as
+        # it starts and ends
+        self._metrics = metrics
+
+        # The values of every sample go to the SampleStore of the Experiment,
+        # keyed by scenario, query and thread (the position of the Trial in
+        # its Scenario), or to a store of the Trial's own
+        self._store = store if store is not None else SampleStore(capacity=samples or 1)
+        self._key = (self._tags.get('scenario', 0), self._store.id(query.name), thread)
         self.reset()
 
-        # Create an instance of BQ client for each experiment to avoid the 10
-        # thread request lib limit
-        self._bq_client = bigquery.Client()
+        # Scenarios share a client from the Experiment's ClientPool. A Trial
+        # used on its own creates a private client of the configured backend.
+        if bq_client is None:
+            bq_client = get_backend(options).client()
+
+        self._bq_client = bq_client
 
     def reset(self):
-        self._response_times = []
-        self._mbytes_processed = []
-        self._mbytes_billed = []
-        self._slot_millis = []
+        self._series = {'response_time': Histogram()}
+
+        # Rows of the store from which the samples are the Trial's
+        self._first_row = len(self._store)
+
+        self._errors = Counter()
+        self._retries = Counter()
+        self._busy = 0.0
+
+        # Series, errors and retries by parameter bucket, for templated
+        # queries split_by a parameter
+        self._buckets = {}
+        self._sample_index = 0
 
     def run(self):
-        for sample in range(self._samples):
-            start = time.time()
+        interval = self._options['interval']
+        trial_start = time.perf_counter()
+
+        for sample in self._schedule():
+            intended = None
+            if interval:
+                intended = self._intended(trial_start, sample, interval)
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            self.sample(intended=intended)
+
+        return self.series()
+
+    def sample(self, intended=None, binding=None):
+        """ Take a single sample. Failed attempts are retried according to the
+        RetryPolicy; a sample that still fails is counted by error class
+        rather than failing the whole Trial. The binding of the sample is the
+        next one of the query unless given, i.e. by a replay. """
+
+        start = None
+
+        reservation = self._reserve()
+        if reservation is None:
+            return
+
+        if self._metrics is not None:
+            self._metrics.started()
+
+        # LiveMetrics are told how every started sample ended, even if
+        # recording it fails, so that their count in flight can not drift
+        completion = None
+        failure = 'other'
+        try:
+            # Retries of a sample keep its binding
+            if binding is None:
+                binding = self._query.bind()
+
+            for attempt in itertools.count():
+                slot = self._controller.acquire() if self._controller else None
+
+                # Waiting for a slot of the controller is not part of the
+                # response time, but retries and their backoff are
+                attempt_start = time.perf_counter()
+                if start is None:
+                    start = attempt_start
+
+                try:
+                    query_job = self._query.execute(self._bq_client, binding)
+                    submitted = time.perf_counter()
+
+                    # Wait for the job to complete before fetching its results,
+                    # so that the two can be timed separately
+                    if self._poller:
+                        self._poller.wait(query_job)
+                    else:
+                        _ = query_job.exception()
+                    completed = time.perf_counter()
+
+                    rows, size = self._query.fetch(query_job, self._bq_client)
+                    end = time.perf_counter()
+                except Exception as e:
+                    error_class = classify(e)
+                    if self._controller:
+                        self._controller.release(slot, error_class=error_class)
+
+                    if not self._retry.should_retry(error_class, attempt):
+                        failure = error_class
+                        self._settle(reservation)
+                        self._record_failure(e, error_class, start, attempt + 1,
+                                             binding=binding)
+                        return
+
+                    self._count(self._retries, error_class, binding, 2)
+                    time.sleep(self._retry.delay(attempt))
+                    continue
+
+                if self._controller:
+                    self._controller.release(slot,
+                                             response_time=end - attempt_start)
+                break
+
+            completion = (end - start,
+                          query_job.slot_millis,
+                          query_job.total_bytes_processed)
+            self._settle(reservation, query_job)
+
+            self._record(query_job, start, end,
+                         intended=intended,
+                         attempt_start=attempt_start,
+                         submitted=submitted,
+                         completed=completed,
+                         fetched=(rows, size),
+                         attempts=attempt + 1,
+                         binding=binding)
+        finally:
+            if self._metrics is not None:
+                if completion is not None:
+                    self._metrics.completed(*completion)
+                else:
+                    self._metrics.failed(failure)
+
+    async def run_async(self,
+                        executor,
+                        poll_interval=0.5):
+
+        """ Coroutine equivalent of run(). Blocking API calls are handed to a
+        small shared executor, and the job is polled from the event loop rather
+        than blocking a thread for its whole lifetime in result() """
+
+        interval = self._options['interval']
+        trial_start = time.perf_counter()
+
+        for sample in self._schedule():
+            intended = None
+            if interval:
+                intended = self._intended(trial_start, sample, interval)
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            await self.sample_async(executor=executor,
+                                    poll_interval=poll_interval,
+                                    intended=intended)
+
+        return self.series()
+
+    async def sample_async(self,
+                           executor,
+                           poll_interval=0.5,
+                           intended=None,
+                           in_flight=None,
+                           binding=None):
+
+        """ Take a single sample on the event loop, as sample() does. Open-loop
+        scenarios pass the time the sample was scheduled for and the number of
+        jobs in flight when it was dispatched, which are recorded alongside
+        it """
+
+        loop = asyncio.get_event_loop()
+
+        start = None
+
+        reservation = self._reserve()
+        if reservation is None:
+            return
+
+        if self._metrics is not None:
+            self._metrics.started()
+
+        # LiveMetrics are told how every started sample ended, even if
+        # recording it fails, so that their count in flight can not drift
+        completion = None
+        failure = 'other'
+        try:
+            if binding is None:
+                binding = self._query.bind()
+
+            for attempt in itertools.count():
+                slot = None
+                if self._controller:
+                    slot = await self._controller.acquire_async()
+
+                attempt_start = time.perf_counter()
+                if start is None:
+                    start = attempt_start
+
+                try:
+                    query_job = await loop.run_in_executor(executor,
+                                                           self._query.execute,
+                                                           self._bq_client,
+                                                           binding)
+                    submitted = time.perf_counter()
+
+                    if self._poller:
+                        await self._poller.wait_async(query_job)
+                    else:
+                        while not await loop.run_in_executor(executor,
+                                                             query_job.done):
+                            await asyncio.sleep(poll_interval)
+                    completed = time.perf_counter()
+
+                    rows, size = await loop.run_in_executor(executor,
+                                                            self._query.fetch,
+                                                            query_job,
+                                                            self._bq_client)
+                    end = time.perf_counter()
+                except Exception as e:
+                    error_class = classify(e)
+                    if self._controller:
+                        self._controller.release(slot, error_class=error_class)
+
+                    if not self._retry.should_retry(error_class, attempt):
+                        failure = error_class
+                        self._settle(reservation)
+                        self._record_failure(e, error_class, start, attempt + 1,
+                                             binding=binding)
+                        return
+
+                    self._count(self._retries, error_class, binding, 2)
+                    await asyncio.sleep(self._retry.delay(attempt))
+                    continue
+
+                if self._controller:
+                    self._controller.release(slot,
+                                             response_time=end - attempt_start)
+                break
+
+            completion = (end - start,
+                          query_job.slot_millis,
+                          query_job.total_bytes_processed)
+            self._settle(reservation, query_job)
+
+            self._record(query_job, start, end,
+                         intended=intended,
+                         in_flight=in_flight,
+                         attempt_start=attempt_start,
+                         submitted=submitted,
+                         completed=completed,
+                         fetched=(rows, size),
+                         attempts=attempt + 1,
+                         binding=binding)
+        finally:
+            if self._metrics is not None:
+                if completion is not None:
+                    self._metrics.completed(*completion)
+                else:
+                    self._metrics.failed(failure)
+
+    def _schedule(self):
+        """ Indexes of the samples to take: samples of them, or as many as
+        are started before the deadline of a duration-based scenario """
+        if self._window is None:
+            samples = range(self._samples)
+        else:
+            samples = itertools.takewhile(lambda _: not self._window.expired(),
+                                          itertools.count())
+
+        for sample in samples:
+            if self._meter is not None and self._meter.exhausted:
+                return
+
+            yield sample
 
-            query_job = self._query.execute(self._bq_client)
+    def _reserve(self):
+        """ Reserve the estimated cost of a sample, return the reservation,
+        or None if the budget does not allow for another sample """
+        if self._meter is None:
+            return 0.0
 
-            _ = query_job.result()
-            end = time.time()
+        return self._meter.reserve(self._query.name)
 
-            # Generate stats
-            self._response_times.append(end - start)
-            self._mbytes_processed.append(query_job.total_bytes_processed / 1024 / 1024)
-            self._mbytes_billed.append(query_job.total_bytes_billed /1024 / 1024)
-            self._slot_millis.append(query_job.slot_millis)
+    def _settle(self, reservation, query_job=None):
+        if self._meter is None:
+            return
 
-        self._output()
+        mbytes_billed = 0.0
+        if query_job is not None:
+            mbytes_billed = (query_job.total_bytes_billed or 0) / 1024 / 1024
 
-        return self._response_times, self._slot_millis
+        self._meter.settle(reservation, mbytes_billed)
 
+    @staticmethod
+    def _intended(trial_start, sample, interval):
+        """ Intended send time of a sample in intended-schedule mode. Samples
+        are paced on a fixed schedule from the start of the Trial; when a slow
+        query pushes the Trial behind schedule, the following samples are sent
+        immediately but their latency is still measured from the time they
+        should have been sent, so that a stall is charged to every request it
+        delayed rather than to a single sample (coordinated omission) """
+        return trial_start + sample * interval
+
+    def series(self):
+        """ Return the samples taken so far, as a dict of series name ->
+        Histogram """
+        return self._series
+
+    def results(self):
+        """ Return {result name: (series, errors, retries)} of the samples
+        taken so far: those of the query, or those of every parameter bucket
+        of a query split_by a parameter """
+        if not self._query.split_by:
+            return {result_name(self._query.name, shard=self._shard): (self._series,
+                                                                       self.errors,
+                                                                       self.retries)}
+
+        return {result_name(self._query.name, bucket, self._shard): (series,
+                                                                     dict(errors),
+                                                                     dict(retries))
+                for bucket, (series, errors, retries) in sorted(self._buckets.items())}
+
+    def _record(self, query_job, start, end, intended=None, in_flight=None,
+                attempt_start=None, submitted=None, completed=None, fetched=None,
+                attempts=1, binding=None):
+        # Generate stats
+        values = {'response_time': end - start}
+
+        if attempt_start is None:
+            attempt_start = start
+        elif attempts > 1:
+            values['retry_wait'] = attempt_start - start
+
+        if submitted is not None and completed is not None:
+            values.update(self._phases(query_job, attempt_start, submitted,
+                                       completed, end))
+
+        rows, size = fetched or (None, None)
+        if rows is not None and self._query.fetcher.mode != 'none':
+            fetch_time = end - completed
+            if fetch_time > 0:
+                values['fetch_rows_per_second'] = rows / fetch_time
+                if size is not None:
+                    values['fetch_mbytes_per_second'] = size / 1024 / 1024 / fetch_time
+
+        if intended is not None:
+            values['corrected_response_time'] = end - intended
+            values['dispatch_delay'] = start - intended
+
+        if in_flight is not None:
+            values['in_flight'] = in_flight
+
+        steady = self._in_window(start, end)
+        if steady:
+            for series_name, value in values.items():
+                self._record_series(series_name, value, binding)
+
+        mbytes_processed = query_job.total_bytes_processed / 1024 / 1024
+        mbytes_billed = query_job.total_bytes_billed /1024 / 1024
+
+        # Cached results have no slot time, which is unknown (NaN) rather
+        # than zero in the store
+        slot_millis = query_job.slot_millis
+        if slot_millis is None:
+            slot_millis = np.nan
+
+        self._store.append(*self._key,
+                           end - start,
+                           slot_millis,
+                           mbytes_processed,
+                           mbytes_billed)
+
+        if self._sink is not None:
+            # Convert the monotonic timings to wall clock time for the record
+            offset = time.time() - time.perf_counter()
+
+            self._sink.append({**self._tags,
+                               **values,
+                               'query': self._query.name,
+                               'sample': self._sample_index,
+                               'job_id': query_job.job_id,
+                               'start_time': start + offset,
+                               'end_time': end + offset,
+                               'created_time': _timestamp(query_job.created),
+                               'started_time': _timestamp(query_job.started),
+                               'ended_time': _timestamp(query_job.ended),
+                               'mbytes_processed': mbytes_processed,
+                               'mbytes_billed': mbytes_billed,
+                               'slot_millis': query_job.slot_millis,
+                               'rows_fetched': rows,
+                               'mbytes_fetched': (size / 1024 / 1024
+                                                  if size is not None else None),
+                               'stages': _stages(query_job),
+                               'attempts': attempts,
+                               'steady': self._steady_field(steady),
+                               **self._binding_fields(binding)})
+
+        self._sample_index += 1
+
+    def _record_failure(self, error, error_class, start, attempts, binding=None):
+        """ Count a sample that failed after its last attempt """
+        end = time.perf_counter()
+
+        self._count(self._errors, error_class, binding, 1)
+        steady = self._in_window(start, end)
+
+        if self._sink is not None:
+            offset = time.time() - time.perf_counter()
+
+            self._sink.append({**self._tags,
+                               'query': self._query.name,
+                               'sample': self._sample_index,
+                               'start_time': start + offset,
+                               'end_time': end + offset,
+                               'attempts': attempts,
+                               'error': error_class,
+                               'error_message': repr(error),
+                               'steady': self._steady_field(steady),
+                               **self._binding_fields(binding)})
+
+        self._sample_index += 1
+
+    @staticmethod
+    def _phases(query_job, start, submitted, completed, end):
+        """ Break the response time of a sample down into PHASES. Jobs without
+        server side timestamps only get the client side phases. """
+
+        phases = {'submit_rtt': submitted - start,
+                  'result_fetch': end - completed}
+
+        created, started, ended = (query_job.created,
+                                   query_job.started,
+                                   query_job.ended)
+
+        if created and started and ended:
+            # Map the job's timestamps onto the monotonic clock of the sample.
+            # The job is created during the submit round trip, so it queues
+            # from the end of that round trip on, and each phase starts where
+            # the previous one ended so that none overlap.
+            offset = time.time() - time.perf_counter()
+            running = max(started.timestamp() - offset, submitted)
+            done = max(ended.timestamp() - offset, running)
+            phases['queue_wait'] = running - submitted
+            phases['execution'] = done - running
+            phases['client_overhead'] = completed - done
+
+        return phases
+
+    def _in_window(self, start, end):
+        """ Whether a sample is in the steady-state window, adding the time
+        it spent in flight inside the window to the busy time of the Trial """
+        if self._window is None:
+            return True
+
+        self._busy += self._window.overlap(start, end)
+        return self._window.contains(start, end)
+
+    def _steady_field(self, steady):
+        # Samples of scenarios without a window are not flagged either way
+        if self._window is None:
+            return None
+
+        return int(steady)
+
+    def _record_series(self, series_name, value, binding=None):
+        targets = [self._series]
+
+        bucket = self._bucket(binding)
+        if bucket is not None:
+            targets.append(bucket[0])
+
+        for series in targets:
+            if series_name not in series:
+                series[series_name] = Histogram()
+
+            series[series_name].record(value)
+
+    def _count(self, counter, error_class, binding, position):
+        """ Count an error or a retry, and in the parameter bucket of the
+        sample, where position is that of its counter in the bucket """
+        counter[error_class] += 1
+
+        bucket = self._bucket(binding)
+        if bucket is not None:
+            bucket[position][error_class] += 1
+
+    def _bucket(self, binding):
+        """ (series, errors, retries) of the parameter bucket of a binding, or
+        None """
+        if binding is None or binding.bucket is None:
+            return None
+
+        if binding.bucket not in self._buckets:
+            self._buckets[binding.bucket] = ({'response_time': Histogram()},
+                                             Counter(),
+                                             Counter())
+
+        return self._buckets[binding.bucket]
+
+    @staticmethod
+    def _binding_fields(binding):
+        if binding is None:
+            return {}
+
+        return {'bucket': binding.bucket,
+                'parameters': binding.values}
+
+    @property
+    def query(self):
+        return self._query
+
+    @property
+    def shard(self):
+        """ Name of the shard of the Trial, or None """
+        return self._shard
+
+    @property
+    def errors(self):
+        """ Failed samples, by error class """
+        return dict(self._errors)
+
+    @property
+    def retries(self):
+        """ Retried attempts, by error class """
+        return dict(self._retries)
+
+    @property
+    def key(self):
+        """ (scenario, query id, thread) of the samples of the Trial in its
+        SampleStore """
+        return self._key
+
+    @property
+    def busy(self):
+        """ Seconds spent with a sample in flight inside the steady-state
+        window """
+        return self._busy
+
+    def summary(self, rows=None):
+        """ Return {column: Histogram} of the values of the samples of the
+        Trial in its SampleStore (see VALUE_COLUMNS). Scenarios give the rows
+        of the Trial, from SampleStore.groups(); otherwise they are found by
+        their key. """
+        if rows is None:
+            keys = [self._store.column(name, self._first_row)
+                    for name in ('scenario', 'query', 'thread')]
+            selected = np.ones(len(keys[0]), dtype=bool)
+            for column, value in zip(keys, self._key):
+                selected &= column == value
+            rows = self._first_row + np.flatnonzero(selected)
+
+        return {name: Histogram.from_values(self._store.column(name)[rows])
+                for name, _ in VALUE_COLUMNS}
+
+    def output(self, summary=None):
+        """ Print the results of the Trial, from its summary() unless
+        given """
+        if self._errors or self._retries:
+            print('---- Query: "{}", failed samples = {}, retries = {}'
+                  .format(self._query.name,
+                          format_counts(self._errors),
+                          format_counts(self._retries)))
+
+        response_times = self._series['response_time']
+        if not response_times.count:
+            return
+
+        if summary is None:
+            summary = self.summary()
 
-    def _output(self):
         print(('---- Query: "{}", mean = {:0.2f}s, min/max = {:0.2f}/{:0.2f}s, '
                'std = {:0.3f}, '
                'slot time = {:,.2f}ms, '
@@ -72,11 +676,33 @@ class Trial(object):
                'MB billed = {:,.2f}, '
                'cost = ${:0.5f}')
               .format(self._query.name,
-                      self._reducer(self._response_times),
-                      np.min(self._response_times),
-                      np.max(self._response_times),
-                      np.std(self._response_times),
-                      self._reducer(self._slot_millis),
-                      self._reducer(self._mbytes_processed),
-                      self._reducer(self._mbytes_billed),
-                      self._reducer(self._mbytes_billed) * COST_PER_MB))
+                      response_times.mean(),
+                      response_times.min(),
+                      response_times.max(),
+                      response_times.std(),
+                      summary['slot_millis'].mean(),
+                      summary['mbytes_processed'].mean(),
+                      summary['mbytes_billed'].mean(),
+                      summary['mbytes_billed'].mean() * COST_PER_MB))
+
+def _timestamp(value):
+    return value.timestamp() if value else None
+
+def _stages(query_job):
+    """ Timings of the stages of the query plan, as a JSON string """
+
+    stages = []
+    for entry in query_job.query_plan or []:
+        stages.append({'name': entry.name,
+                       'status': entry.status,
+                       'start_time': _timestamp(entry.start),
+                       'end_time': _timestamp(entry.end),
+                       'wait_ms_avg': entry.wait_ms_avg,
+                       'read_ms_avg': entry.read_ms_avg,
+                       'compute_ms_avg': entry.compute_ms_avg,
+                       'write_ms_avg': entry.write_ms_avg,
+                       'records_read': entry.records_read,
+                       'records_written': entry.records_written})
+
+    return json.dumps(stages) if stages else None
+
@@ -0,0 +1,344 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Load generation worker, running shares of scenarios for a Coordinator.
+
+Workers listen on a TCP port, of 127.0.0.1 unless --host says otherwise. Every
+request is a single line of JSON, answered by a single line of JSON on the
+same connection:
+
+    {"command": "ping"}       -> {"status": "ok", "pid": ...}
+    {"command": "run", ...}   -> {"status": "ok", "results": ..., "columns": ...,
+                                  "samples": [...]}
+    {"command": "shutdown"}   -> {"status": "ok"}
+
+A run request holds the experiment options, the queries, and the share of a
+scenario to run: threads and their queries (closed loop) or an arrival rate
+(open loop). The worker waits until the synchronized start time of the
+request, runs the scenario and returns its results as mergeable summaries
+(QueryResult.to_dict()), plus its raw sample records if asked to.
+
+Workers run queries with their own credentials, so every request must carry
+the shared secret the worker was started with (--secret, or the
+BQ_PARALLEL_SECRET environment variable); others are refused. Only the
+options of WORKER_OPTIONS are taken from a request, and queries may only set
+those of QUERY_OPTIONS for themselves (requests with any other are refused):
+options naming local files (raw output, simulation and cache files, key files
+of shards) are never accepted, and the credentials of shards come from the
+--shards file of the worker itself.
+
+Usage: BQ_PARALLEL_SECRET=... python Worker.py --host 0.0.0.0 --port 8765 """
+
+import os
+import hmac
+import json
+import time
+import socket
+import argparse
+import threading
+import socketserver
+from Backend import get_backend
+from Query import Query
+from Scenario import Scenario
+from AsyncScenario import AsyncScenario
+from OpenLoopScenario import OpenLoopScenario
+from CostMeter import CostMeter
+from Shards import client_pool, load_shards, parse_shards
+
+# Environment variable holding the shared secret of workers and coordinators
+SECRET_ENV = 'BQ_PARALLEL_SECRET'
+
+# Experiment options a worker accepts from a request; any other is dropped
+WORKER_OPTIONS = ('use_cache', 'format', 'engine', 'io_threads', 'poll_interval',
+                  'poll_min_interval', 'polling', 'pool_size', 'load', 'duration',
+                  'warmup', 'cooldown', 'arrivals', 'seed', 'mix', 'interval',
+                  'raw_format', 'knee_efficiency', 'knee_latency', 'backend',
+                  'simulation_model', 'stub_latency', 'quiet', 'max_retries',
+                  'retry_initial', 'retry_max', 'adaptive', 'adaptive_initial',
+                  'adaptive_latency', 'shards')
+
+# Options a query of a query file may set for itself (see QuerySet), the only
+# ones a worker accepts in the queries of a request
+QUERY_OPTIONS = ('simulation', 'max_concurrency', 'fetch', 'page_size', 'streams')
+
+# Options naming local files, and the values workers run with instead
+FILE_OPTIONS = {'raw_output': None,
+                'sample_store': None,
+                'simulation_file': None,
+                'preflight_cache': None,
+                'metrics_log': None,
+                'replay_file': None}
+
+class RecordList(list):
+    """ Sink keeping the raw sample records in memory, to be returned to the
+    Coordinator """
+    pass
+
+class Worker(object):
+    def __init__(self,
+                 credentials=None):
+
+        # Key file of every shard known to the worker, by shard name
+        self._credentials = credentials or {}
+        self._client_pools = {}
+        self._queries = {}
+
+    def __repr__(self):
+        return 'Worker(pid = {})'.format(os.getpid())
+
+    def handle(self, request):
+        command = request.get('command')
+
+        if command == 'ping':
+            return {'status': 'ok', 'pid': os.getpid()}
+        elif command == 'run':
+            return self.run(request)
+
+        raise ValueError('Unknown command: {}'.format(command))
+
+    def run(self, request):
+        options = self._options(request['options'])
+
+        queries = [self._query(spec, request, options) for spec in request['queries']]
+
+        sink = RecordList() if request['raw'] else None
+
+        # Each worker enforces its share of the budget left
+        meter = CostMeter(budget=request.get('budget'),
+                          estimates=request.get('estimates'))
+
+        scenario = self._build_scenario(request, options, queries, sink, meter)
+
+        # Every worker starts its share of the scenario at the same time
+        delay = request['start_at'] - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        start = time.time()
+        response_results = scenario.run()
+        end = time.time()
+
+        return {'status': 'ok',
+                'results': {query_name: result.to_dict()
+                            for query_name, result in response_results.items()},
+                'columns': scenario.column_values(),
+                'start_time': start,
+                'end_time': end,
+                'budget_reached': meter.exhausted,
+                'samples': sink or []}
+
+    def _build_scenario(self, request, options, queries, sink, meter):
+        if options['load'] == 'open':
+            return OpenLoopScenario(rate=request['rate'],
+                                    duration=options['duration'],
+                                    arrivals=options['arrivals'],
+                                    seed=request['seed'],
+                                    queries=queries,
+                                    options=options,
+                                    client_pool=self._client_pool(options, None),
+                                    sink=sink,
+                                    index=request['index'],
+                                    meter=meter)
+
+        by_name = {query.name: query for query in queries}
+        allocation = [by_name[query_name] for query_name in request['allocation']]
+
+        if options['engine'] == 'asyncio':
+            scenario_class = AsyncScenario
+        else:
+            scenario_class = Scenario
+
+        return scenario_class(threads=len(allocation),
+                              samples=request['samples'],
+                              queries=queries,
+                              options=options,
+                              client_pool=self._client_pool(options, len(allocation)),
+                              sink=sink,
+                              index=request['index'],
+                              allocation=allocation,
+                              meter=meter,
+                              shard_assignment=request.get('shards'))
+
+    def _options(self, requested):
+        """ Options of a run request: the accepted ones only, and none of
+        those features of the coordinator itself """
+        options = {name: requested.get(name) for name in WORKER_OPTIONS}
+        options.update(FILE_OPTIONS)
+        options.update({'resume': False,
+                        'live': False,
+                        'metrics_port': None,
+                        'processes': None,
+                        'workers': None,
+                        'max_cost': None,
+                        'preflight': False})
+
+        # Shards run with the key files of this worker, never of the request
+        if options['shards']:
+            options['shards'] = [{'name': shard.name,
+                                  'project': shard.project,
+                                  'credentials': self._credentials.get(shard.name),
+                                  'location': shard.location,
+                                  'weight': shard.weight}
+                                 for shard in parse_shards(options['shards'])]
+
+        return options
+
+    def _query(self, spec, request, options):
+        """ Return the Query of a spec. Queries are kept across scenarios, so
+        that templated queries carry on through their bindings rather than
+        starting over at every scenario. """
+        unknown = sorted(set(spec['options']) - set(QUERY_OPTIONS))
+        if unknown:
+            raise ValueError('Unknown options of query {}: {}'.format(spec['name'],
+                                                                      ', '.join(unknown)))
+
+        key = (json.dumps(spec, sort_keys=True),
+               json.dumps(options, sort_keys=True),
+               request.get('worker', 0),
+               request.get('workers', 1))
+
+        if key not in self._queries:
+            query = Query(name=spec['name'],
+                          options={**spec['options'], **options},
+                          sql=spec['sql'],
+                          weight=spec['weight'],
+                          template=spec.get('template'))
+
+            if query.template is not None:
+                query.template.partition(request.get('worker', 0),
+                                         request.get('workers', 1))
+
+            self._queries[key] = query
+
+        return self._queries[key]
+
+    def _client_pool(self, options, threads):
+        # Sized as by the Experiment: one connection per concurrent API caller
+        size = options['pool_size']
+        if not size:
+            if options['load'] == 'open' or options['engine'] == 'asyncio':
+                size = options['io_threads']
+            else:
+                size = threads
+
+        # Pools are kept for the lifetime of the worker, like the single pool
+        # of an Experiment
+        if size not in self._client_pools:
+            self._client_pools[size] = client_pool(get_backend(options), options, size)
+
+        return self._client_pools[size]
+
+class WorkerServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, address, worker, secret):
+        if not secret:
+            raise ValueError('Workers require a shared secret')
+
+        self.worker = worker
+        self.secret = secret
+        super().__init__(address, WorkerHandler)
+
+    def authorized(self, request):
+        return hmac.compare_digest(str(request.get('secret', '')).encode('utf-8'),
+                                   self.secret.encode('utf-8'))
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        try:
+            request = json.loads(line.decode('utf-8'))
+
+            if not self.server.authorized(request):
+                response = {'status': 'error', 'error': 'Unauthorized request'}
+            elif request.get('command') == 'shutdown':
+                response = {'status': 'ok'}
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                response = self.server.worker.handle(request)
+        except Exception as e:
+            response = {'status': 'error', 'error': repr(e)}
+
+        self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+def send(address, request, secret, timeout=None):
+    """ Send a request to the worker at (host, port), with the shared secret,
+    return its response """
+
+    with socket.create_connection(address, timeout=timeout) as connection:
+        connection.sendall((json.dumps({**request, 'secret': secret}) + '\n')
+                           .encode('utf-8'))
+
+        with connection.makefile('rb') as f:
+            line = f.readline()
+
+    if not line:
+        raise ConnectionError('No response from worker {}:{}'.format(*address))
+
+    response = json.loads(line.decode('utf-8'))
+    if response.get('status') != 'ok':
+        raise RuntimeError('Worker {}:{} failed: {}'.format(address[0],
+                                                            address[1],
+                                                            response.get('error')))
+
+    return response
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Load generation worker, '
+                                                  'controlled by a Coordinator'))
+    parser.add_argument(
+        '--host',
+        type=str,
+        default='127.0.0.1',
+        help='Address to listen on')
+
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8765,
+        help='Port to listen on (0 picks a free port)')
+
+    parser.add_argument(
+        '--secret',
+        type=str,
+        default=os.environ.get(SECRET_ENV),
+        help=('Shared secret of every request, by default that of the {} '
+              'environment variable'.format(SECRET_ENV)))
+
+    parser.add_argument(
+        '--shards',
+        type=str,
+        default=None,
+        help='JSON file of shards, for the key files of their credentials')
+
+    args = parser.parse_args()
+
+    if not args.secret:
+        parser.error('A shared secret is required: --secret or {}'.format(SECRET_ENV))
+
+    credentials = {}
+    if args.shards:
+        credentials = {shard.name: shard.credentials
+                       for shard in parse_shards(load_shards(args.shards))}
+
+    server = WorkerServer((args.host, args.port), Worker(credentials), args.secret)
+
+    # The Coordinator reads the address of the local workers it starts from
+    # this line
+    print('Worker listening on {}:{}'.format(*server.server_address), flush=True)
+
+    server.serve_forever()
@@ -0,0 +1,365 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Benchmark of the harness itself, run against the stub backend so that
+everything measured is overhead of Trial, Scenario and Experiment:
+
+    qps_ceiling      samples per second with zero latency jobs
+    added_latency    response time minus the stub latency, per sample, at
+                     each concurrency (p95 is within 1% of the response time)
+    memory           peak Python heap (tracemalloc) per in-flight query, at
+                     each concurrency; OS thread stacks are not included
+    csv              end-to-end Experiment.run time, including the CSV output
+
+Results are written as JSON. With --baseline, they are compared with an
+earlier results file, and the exit code is 1 if any metric regressed by more
+than --tolerance. """
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import datetime
+import tracemalloc
+from bq_parallel import build_parser, build_options
+from Backend import get_backend
+from QuerySet import QuerySet
+from Scenario import Scenario
+from AsyncScenario import AsyncScenario
+from Experiment import Experiment
+
+ENGINES = ('threads', 'asyncio')
+
+def harness_options(**overrides):
+    """ Default bq_parallel options on the quiet stub backend """
+
+    args = build_parser().parse_args(['--threads', '1',
+                                      '--output-file', os.devnull,
+                                      '--backend', 'stub',
+                                      '--no-preflight',
+                                      '--quiet']).__dict__
+    options = build_options(args)
+    options.update(overrides)
+    return options
+
+def stub_queries(options, count=1):
+    return QuerySet(name='Benchmark',
+                    queries=[{'name': 'Query {}'.format(index),
+                              'sql': 'SELECT {}'.format(index)}
+                             for index in range(count)],
+                    options=options)
+
+def run_scenario(engine, threads, samples, latency, poll_interval, io_threads):
+    """ Run a single Scenario on the stub backend, return (results, elapsed) """
+
+    options = harness_options(engine=engine,
+                              stub_latency=latency,
+                              poll_interval=poll_interval,
+                              poll_min_interval=poll_interval,
+                              io_threads=io_threads)
+
+    client_pool = get_backend(options).client_pool(size=threads)
+    scenario_class = AsyncScenario if engine == 'asyncio' else Scenario
+    scenario = scenario_class(threads=threads,
+                              samples=samples,
+                              queries=stub_queries(options),
+                              options=options,
+                              client_pool=client_pool)
+
+    start = time.perf_counter()
+    results = scenario.run()
+    elapsed = time.perf_counter() - start
+
+    return results, elapsed
+
+def response_times(results):
+    return results['Query 0'].series('response_time')
+
+def bench_qps_ceiling(settings):
+    ceilings = {}
+    for engine in ENGINES:
+        results, elapsed = run_scenario(engine=engine,
+                                        threads=settings.threads,
+                                        samples=settings.samples,
+                                        latency=0.0,
+                                        poll_interval=settings.poll_interval,
+                                        io_threads=settings.io_threads)
+
+        samples = response_times(results).count
+        ceilings[engine] = {'threads': settings.threads,
+                            'samples': samples,
+                            'elapsed': elapsed,
+                            'qps': samples / elapsed}
+
+    return ceilings
+
+def bench_added_latency(settings):
+    added = []
+    for engine in ENGINES:
+        for threads in settings.concurrency:
+            results, _ = run_scenario(engine=engine,
+                                      threads=threads,
+                                      samples=settings.latency_samples,
+                                      latency=settings.latency,
+                                      poll_interval=settings.poll_interval,
+                                      io_threads=settings.io_threads)
+
+            histogram = response_times(results)
+            added.append({'engine': engine,
+                          'threads': threads,
+                          'samples': histogram.count,
+                          'mean': histogram.mean() - settings.latency,
+                          'p95': histogram.percentile(95) - settings.latency,
+                          'max': histogram.max() - settings.latency})
+
+    return added
+
+def bench_memory(settings):
+    memory = []
+    for engine in ENGINES:
+        for threads in settings.concurrency:
+            # Every query stays in flight long enough for all of them to
+            # overlap, so the peak is reached with threads queries in flight
+            tracemalloc.start()
+            baseline, _ = tracemalloc.get_traced_memory()
+
+            run_scenario(engine=engine,
+                         threads=threads,
+                         samples=1,
+                         latency=settings.memory_latency,
+                         poll_interval=settings.poll_interval,
+                         io_threads=settings.io_threads)
+
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            memory.append({'engine': engine,
+                           'threads': threads,
+                           'peak_bytes': peak - baseline,
+                           'bytes_per_query': (peak - baseline) / threads})
+
+    return memory
+
+def bench_csv(settings):
+    options = harness_options()
+    queries = stub_queries(options, count=settings.csv_queries)
+
+    # Every scenario has at least one thread per query, so that every query
+    # has a row in every scenario
+    plan = '{0}..{1}:{0}'.format(settings.csv_queries,
+                                 settings.csv_queries * settings.csv_scenarios)
+
+    with tempfile.TemporaryDirectory() as directory:
+        output_file = os.path.join(directory, 'output.csv')
+
+        start = time.perf_counter()
+        Experiment(queries=queries,
+                   options=options,
+                   scenario_plan=plan,
+                   samples=settings.csv_samples).run(output_file=output_file)
+        elapsed = time.perf_counter() - start
+
+        size = os.path.getsize(output_file)
+        with open(output_file) as f:
+            rows = sum(1 for _ in f) - 1
+
+    return {'queries': settings.csv_queries,
+            'scenarios': settings.csv_scenarios,
+            'rows': rows,
+            'bytes': size,
+            'elapsed': elapsed,
+            'seconds_per_row': elapsed / rows}
+
+def metrics(results):
+    """ Flatten results into {metric: (value, higher is better, noise)}, where
+    changes smaller than noise are never counted as regressions """
+
+    flat = {}
+    for engine, ceiling in results['qps_ceiling'].items():
+        flat['qps_ceiling.{}'.format(engine)] = (ceiling['qps'], True, 0.0)
+    for entry in results['added_latency']:
+        flat['added_latency.{}.{}'.format(entry['engine'], entry['threads'])] = (
+            entry['mean'], False, 0.001)
+    for entry in results['memory']:
+        flat['memory.{}.{}'.format(entry['engine'], entry['threads'])] = (
+            entry['bytes_per_query'], False, 1024)
+    flat['csv.seconds_per_row'] = (results['csv']['seconds_per_row'], False, 0.0005)
+
+    return flat
+
+def regressions(results, baseline, tolerance):
+    """ Return a description of every metric worse than the baseline by more
+    than tolerance (relative) """
+
+    found = []
+    current = metrics(results)
+    for name, (previous, higher_is_better, noise) in metrics(baseline).items():
+        if name not in current or not previous:
+            continue
+
+        value = current[name][0]
+        worse = previous - value if higher_is_better else value - previous
+        if worse > max(tolerance * abs(previous), noise):
+            found.append('{}: {:0.6g} -> {:0.6g} ({:+0.1%})'.format(
+                name,
+                previous,
+                value,
+                (value - previous) / abs(previous)))
+
+    return found
+
+def concurrency_list(value):
+    return [int(threads) for threads in value.split(',')]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Benchmark the overhead of the '
+                                                  'harness against a stub backend'))
+    parser.add_argument(
+        '--output',
+        '-O',
+        type=str,
+        default='bench_results.json',
+        help='JSON file to write the results to')
+
+    parser.add_argument(
+        '--concurrency',
+        type=concurrency_list,
+        default=[10, 100, 1000],
+        help='Concurrency levels of the latency and memory benchmarks')
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=10,
+        help='Concurrency of the QPS ceiling benchmark')
+
+    parser.add_argument(
+        '--samples',
+        type=int,
+        default=500,
+        help='Samples per thread of the QPS ceiling benchmark')
+
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.1,
+        help='Stub latency of the added latency benchmark, in seconds')
+
+    parser.add_argument(
+        '--latency-samples',
+        type=int,
+        default=5,
+        help='Samples per thread of the added latency benchmark')
+
+    parser.add_argument(
+        '--memory-latency',
+        type=float,
+        default=1.0,
+        help='Stub latency of the memory benchmark, in seconds')
+
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=0.01,
+        help='Job status poll interval')
+
+    parser.add_argument(
+        '--io-threads',
+        type=int,
+        default=10,
+        help='I/O threads of the asyncio engine')
+
+    parser.add_argument(
+        '--csv-queries',
+        type=int,
+        default=20,
+        help='Queries of the CSV benchmark experiment')
+
+    parser.add_argument(
+        '--csv-scenarios',
+        type=int,
+        default=10,
+        help='Scenarios of the CSV benchmark experiment')
+
+    parser.add_argument(
+        '--csv-samples',
+        type=int,
+        default=5,
+        help='Samples per thread of the CSV benchmark experiment')
+
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default=None,
+        help='Earlier results file to check for regressions')
+
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Relative change of a metric counted as a regression')
+
+    settings = parser.parse_args()
+
+    results = {'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpu_count': os.cpu_count(),
+               'settings': vars(settings)}
+
+    print('- QPS ceiling, {} threads'.format(settings.threads))
+    results['qps_ceiling'] = bench_qps_ceiling(settings)
+    for engine, ceiling in results['qps_ceiling'].items():
+        print('-- {}: {:,.0f} samples/s'.format(engine, ceiling['qps']))
+
+    print('- Added latency per sample, stub latency = {}s'.format(settings.latency))
+    results['added_latency'] = bench_added_latency(settings)
+    for entry in results['added_latency']:
+        print('-- {}, {} threads: mean = {:0.2f}ms, p95 = {:0.2f}ms, max = {:0.2f}ms'
+              .format(entry['engine'],
+                      entry['threads'],
+                      entry['mean'] * 1000,
+                      entry['p95'] * 1000,
+                      entry['max'] * 1000))
+
+    print('- Memory per in-flight query')
+    results['memory'] = bench_memory(settings)
+    for entry in results['memory']:
+        print('-- {}, {} threads: {:,.0f} bytes/query'.format(entry['engine'],
+                                                              entry['threads'],
+                                                              entry['bytes_per_query']))
+
+    print('- CSV output, {} queries x {} scenarios'.format(settings.csv_queries,
+                                                          settings.csv_scenarios))
+    results['csv'] = bench_csv(settings)
+    print('-- {:0.2f}s ({:0.2f}ms per row)'.format(results['csv']['elapsed'],
+                                                   results['csv']['seconds_per_row'] * 1000))
+
+    with open(settings.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print('- Results written to {}'.format(settings.output))
+
+    if settings.baseline:
+        with open(settings.baseline) as f:
+            found = regressions(results, json.load(f), settings.tolerance)
+
+        for regression in found:
+            print('-- Regression: {}'.format(regression))
+
+        if found:
+            sys.exit(1)
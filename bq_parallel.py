@@ -12,10 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import argparse
 import warnings
+import re
 from QuerySet import QuerySet
-from Experiment import Experiment
+from Experiment import Experiment, parse_plan
+from Coordinator import parse_workers
+from Worker import SECRET_ENV
+from Preflight import BudgetExceeded
+from Shards import load_shards, parse_shards
 
 QUERIES = [{"name": "Default",
             "weight": 1,
@@ -23,13 +29,23 @@ QUERIES = [{"name": "Default",
                     'WHERE state = "TX" '
                     'LIMIT 100')}]
 
-if __name__ == '__main__':
-    # Disable the super annoying warnings that are unnecessarily generated when
-    # using user credentials rather than a service account.
-    # Reference: https://github.com/GoogleCloudPlatform/google-auth-library-python/issues/271
+def duration(value):
+    """ Parse a duration such as '300', '300s', '5m' or '1h' into seconds """
+    match = re.match(r'^(\d+(?:\.\d+)?)([smh]?)$', value.strip())
+    if not match:
+        raise argparse.ArgumentTypeError('invalid duration: {}'.format(value))
 
-    warnings.filterwarnings("ignore", "Your application has authenticated using end user credentials")
+    number, unit = match.groups()
+    return float(number) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[unit]
+
+def shards_file(value):
+    """ Parse the JSON file of --shards (see Shards.py) """
+    try:
+        return load_shards(value)
+    except (OSError, ValueError, KeyError) as e:
+        raise argparse.ArgumentTypeError('invalid shards file {}: {}'.format(value, e))
 
+def build_parser():
     parser = argparse.ArgumentParser(description=('Utility to launch parallel BQ queries '
                                                   'and return average response time'))
     parser.add_argument(
@@ -45,8 +61,9 @@ if __name__ == '__main__':
         '--scenarios',
         type=str,
         default=argparse.SUPPRESS,
-        help=('Comma separated list of concurrency scenarios to run '
-              'i.e. 10,20,30,40'))
+        help=('Concurrency scenarios to run: a comma separated list and/or '
+              'ranges i.e. 10,20,30,40 or 10..100:10 or 1..64*2, or an '
+              'adaptive search for the throughput knee i.e. search:1..256'))
 
     group.add_argument(
         '--threads',
@@ -54,6 +71,54 @@ if __name__ == '__main__':
         default=argparse.SUPPRESS,
         help='Number of concurrent threads/queries (ad-hoc usage)')
 
+    group.add_argument(
+        '--rate',
+        type=str,
+        default=argparse.SUPPRESS,
+        help=('Comma separated list of open-loop arrival rates in queries '
+              'per second, each run for --duration i.e. 5,10,20/s or '
+              '5..50:5/s'))
+
+    group.add_argument(
+        '--replay',
+        type=str,
+        default=argparse.SUPPRESS,
+        help=('Replay the jobs of an export of INFORMATION_SCHEMA.JOBS '
+              '(.csv, .jsonl or .parquet) with their original timing'))
+
+    parser.add_argument(
+        '--replay-speed',
+        type=str,
+        default='1',
+        help=('Comma separated list of replay speeds, each replaying the '
+              'whole history i.e. 1,2,4 (2 replays it twice as fast)'))
+
+    parser.add_argument(
+        '--replay-sample',
+        type=float,
+        default=1.0,
+        help='Fraction of the jobs of the history to replay, i.e. 0.1')
+
+    parser.add_argument(
+        '--replay-users',
+        type=lambda value: [user.strip() for user in value.split(',')],
+        default=None,
+        help='Comma separated list of users whose jobs to replay')
+
+    parser.add_argument(
+        '--replay-statements',
+        type=lambda value: [statement.strip().upper() for statement in value.split(',')],
+        default=['SELECT'],
+        help=('Comma separated list of the statement types of the jobs to '
+              'replay, i.e. SELECT,INSERT (SELECT only by default: other '
+              'statements modify data or tables of the live project)'))
+
+    parser.add_argument(
+        '--replay-limit',
+        type=int,
+        default=None,
+        help='Maximum number of jobs to replay per scenario')
+
     parser.add_argument(
         '--samples',
         type=int,
@@ -61,6 +126,16 @@ if __name__ == '__main__':
         action='store',
         help='Number of samples to take for each thread')
 
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=None,
+        action='store',
+        help=('Intended seconds between the samples of each thread. Samples '
+              'are paced on this schedule and a coordinated-omission '
+              'corrected response time, measured from the intended send '
+              'time, is reported alongside the raw one'))
+
     parser.add_argument(
         '--output-file',
         '-O',
@@ -69,6 +144,39 @@ if __name__ == '__main__':
         action='store',
         help='Filename to output results to')
 
+    parser.add_argument(
+        '--raw-output',
+        type=str,
+        default=None,
+        action='store',
+        help=('File (jsonl) or directory (parquet) to stream every raw sample '
+              'to as it completes'))
+
+    parser.add_argument(
+        '--raw-format',
+        type=str,
+        choices=['jsonl', 'parquet'],
+        default='jsonl',
+        action='store',
+        help='Raw sample format (parquet requires pyarrow)')
+
+    parser.add_argument(
+        '--sample-store',
+        type=str,
+        default=None,
+        action='store',
+        help=('Directory to map the per-sample values of the experiment to '
+              '(a single file), for runs with more samples than fit in '
+              'memory'))
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help=('Resume an interrupted experiment from --raw-output: completed '
+              'scenarios are rebuilt from their raw samples rather than run '
+              'again'))
+
     parser.add_argument(
         '--format',
         type=str,
@@ -84,13 +192,408 @@ if __name__ == '__main__':
         default=False,
         help='Enable query caching')
 
-    args = parser.parse_args().__dict__
+    parser.add_argument(
+        '--engine',
+        type=str,
+        choices=['threads', 'asyncio'],
+        default='threads',
+        action='store',
+        help=('Load engine: one OS thread per concurrent query (threads), or '
+              'coroutines on a single event loop (asyncio)'))
+
+    parser.add_argument(
+        '--io-threads',
+        type=int,
+        default=10,
+        action='store',
+        help=('Number of I/O threads used by the asyncio engine to issue '
+              'blocking BigQuery API calls'))
+
+    parser.add_argument(
+        '--poll-interval',
+        type=float,
+        default=0.5,
+        action='store',
+        help=('Seconds between job status polls: the maximum interval of the '
+              'batch poller, or the interval of every job with the asyncio '
+              'engine and --polling=per_job'))
+
+    parser.add_argument(
+        '--poll-min-interval',
+        type=float,
+        default=0.1,
+        action='store',
+        help='Minimum seconds between the job status polls of the batch poller')
+
+    parser.add_argument(
+        '--polling',
+        type=str,
+        choices=['batch', 'per_job'],
+        default='per_job',
+        action='store',
+        help=('Wait for jobs with a polling loop per job (per_job, the '
+              'default), or with a single poller per scenario, listing the '
+              'jobs in flight in batches (batch)'))
+
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=None,
+        action='store',
+        help=('Maximum number of HTTP connections shared by all BigQuery '
+              'API calls (default: one per concurrent thread of the largest '
+              'scenario, or --io-threads with the asyncio engine)'))
+
+    parser.add_argument(
+        '--duration',
+        type=duration,
+        default=None,
+        action='store',
+        help=('Duration of each scenario i.e. 300s, 5m. Open-loop scenarios '
+              'dispatch arrivals for this long (default: 60s); closed-loop '
+              'threads keep issuing queries until it has elapsed, rather than '
+              'taking --samples each'))
+
+    parser.add_argument(
+        '--warmup',
+        type=duration,
+        default=0.0,
+        action='store',
+        help=('Time at the start of each scenario whose samples are excluded '
+              'from the statistics i.e. 30s (requires --duration with '
+              'closed-loop scenarios)'))
+
+    parser.add_argument(
+        '--cooldown',
+        type=duration,
+        default=0.0,
+        action='store',
+        help=('Time at the end of each scenario whose samples are excluded '
+              'from the statistics i.e. 30s (requires --duration with '
+              'closed-loop scenarios)'))
+
+    parser.add_argument(
+        '--arrivals',
+        type=str,
+        choices=['constant', 'poisson'],
+        default='poisson',
+        action='store',
+        help='Arrival process of open-loop scenarios')
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        action='store',
+        help='Random seed for reproducible arrival schedules and query mixes')
+
+    parser.add_argument(
+        '--mix',
+        type=str,
+        choices=['split', 'draw'],
+        default='split',
+        action='store',
+        help=('How threads are allocated to queries according to their '
+              'weights: largest remainder split, or weighted random draws '
+              'from --seed'))
+
+    parser.add_argument(
+        '--backend',
+        type=str,
+        choices=['bigquery', 'simulated', 'stub'],
+        default='bigquery',
+        action='store',
+        help=('Run queries against BigQuery, against a local simulation of '
+              'BigQuery that spends no slots or money, or against a stub '
+              'whose jobs complete after --stub-latency (to measure the '
+              'overhead of the harness itself)'))
+
+    parser.add_argument(
+        '--stub-latency',
+        type=float,
+        default=0.0,
+        action='store',
+        help='Seconds taken by every job of the stub backend')
+
+    parser.add_argument(
+        '--quiet',
+        '-q',
+        action='store_true',
+        help='Do not print the results of every trial and scenario')
+
+    parser.add_argument(
+        '--simulation',
+        type=str,
+        default=None,
+        action='store',
+        help=('JSON/YAML file describing the simulated backend: slots, '
+              'latency distributions, error injection (default: built-in '
+              'model)'))
+
+    parser.add_argument(
+        '--knee-efficiency',
+        type=float,
+        default=0.25,
+        action='store',
+        help=('Search plans: a step up in concurrency is productive if '
+              'throughput grows by at least this fraction of linear scaling'))
+
+    parser.add_argument(
+        '--knee-latency',
+        type=float,
+        default=2.0,
+        action='store',
+        help=('Search plans: a step is saturated once its p95 response time '
+              'exceeds this factor times the p95 of the first step'))
+
+    parser.add_argument(
+        '--max-retries',
+        type=int,
+        default=3,
+        action='store',
+        help=('Times a sample is retried after a quota, backend or timeout '
+              'error, with jittered exponential backoff, before it is counted '
+              'as failed'))
+
+    parser.add_argument(
+        '--retry-initial',
+        type=float,
+        default=1.0,
+        action='store',
+        help='Backoff ceiling of the first retry of a sample, in seconds')
+
+    parser.add_argument(
+        '--retry-max',
+        type=float,
+        default=60.0,
+        action='store',
+        help='Maximum backoff ceiling of a retry, in seconds')
+
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help=('Adapt the number of queries in flight of closed-loop scenarios '
+              '(additive increase, multiplicative decrease) to quota errors '
+              'and --adaptive-latency, up to the threads of the scenario'))
+
+    parser.add_argument(
+        '--adaptive-initial',
+        type=int,
+        default=None,
+        action='store',
+        help='Initial limit on the queries in flight (default: the threads)')
+
+    parser.add_argument(
+        '--adaptive-latency',
+        type=float,
+        default=None,
+        action='store',
+        help=('Response time in seconds above which the limit on the queries '
+              'in flight is decreased (default: only on quota errors)'))
+
+    parser.add_argument(
+        '--max-cost',
+        type=float,
+        default=None,
+        action='store',
+        help=('Budget of the experiment in USD: refuse to start if its '
+              'projected cost is higher, and stop dispatching samples once it '
+              'is spent'))
+
+    parser.add_argument(
+        '--no-preflight',
+        dest='preflight',
+        default=True,
+        action='store_false',
+        help='Skip the dry runs estimating the cost of the experiment')
+
+    parser.add_argument(
+        '--preflight-cache',
+        default=None,
+        action='store',
+        help=('File caching the bytes estimated by dry runs '
+              '(default: ~/.cache/bq_parallel/dry_run_cache.json)'))
+
+    parser.add_argument(
+        '--live',
+        action='store_true',
+        default=False,
+        help=('Print a line of live metrics (in flight, completions, errors, '
+              'p50/p95, slot-ms and bytes per second) every --live-interval'))
+
+    parser.add_argument(
+        '--live-interval',
+        type=duration,
+        default=5.0,
+        help='Interval between live metrics i.e. 5s')
+
+    parser.add_argument(
+        '--live-window',
+        type=duration,
+        default=60.0,
+        help='Sliding window of the live rates and percentiles i.e. 60s')
+
+    parser.add_argument(
+        '--metrics-log',
+        type=str,
+        default=None,
+        help='JSONL file to append the live metrics of every interval to')
+
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=None,
+        help=('Serve the live metrics on http://localhost:PORT/metrics, in '
+              'the Prometheus text format'))
+
+    shard_group = parser.add_mutually_exclusive_group()
+    shard_group.add_argument(
+        '--shards',
+        type=shards_file,
+        default=None,
+        help=('JSON file listing the projects, credentials, locations and '
+              'weights to spread the load across (see Shards.py)'))
+
+    shard_group.add_argument(
+        '--projects',
+        type=lambda value: [{'project': project.strip()}
+                            for project in value.split(',')],
+        default=None,
+        help=('Comma separated list of projects to spread the load across, '
+              'with the default credentials'))
+
+    distributed_group = parser.add_mutually_exclusive_group()
+    distributed_group.add_argument(
+        '--processes',
+        type=int,
+        default=None,
+        action='store',
+        help=('Spread the load of every scenario across this many worker '
+              'processes on this host'))
+
+    distributed_group.add_argument(
+        '--workers',
+        type=parse_workers,
+        default=None,
+        action='store',
+        help=('Spread the load of every scenario across these workers '
+              '(host:port,host:port,...), each started with Worker.py and '
+              'the shared secret of the {} environment variable'.format(SECRET_ENV)))
+
+    return parser
+
+def build_options(args):
+    """ Experiment options from the parsed command line arguments """
 
     # TODO (djrut): Implement global options and query specific options, such
     # that query specific options overide global options
     options = {}
     options['use_cache'] = args['use_cache']
     options['format'] = args['format']
+    options['engine'] = args['engine']
+    options['io_threads'] = args['io_threads']
+    options['poll_interval'] = args['poll_interval']
+    options['poll_min_interval'] = args['poll_min_interval']
+    options['polling'] = args['polling']
+    options['pool_size'] = args['pool_size']
+    if args.get('replay', None):
+        options['load'] = 'replay'
+    elif args.get('rate', None):
+        options['load'] = 'open'
+    else:
+        options['load'] = 'closed'
+
+    # Open-loop scenarios always run for a duration, closed-loop ones only if
+    # one is given
+    options['duration'] = args['duration']
+    if options['load'] == 'open' and options['duration'] is None:
+        options['duration'] = 60.0
+
+    options['warmup'] = args['warmup']
+    options['cooldown'] = args['cooldown']
+    options['arrivals'] = args['arrivals']
+    options['seed'] = args['seed']
+    options['mix'] = args['mix']
+    options['interval'] = args['interval']
+    options['raw_output'] = args['raw_output']
+    options['raw_format'] = args['raw_format']
+    options['sample_store'] = args['sample_store']
+    options['resume'] = args['resume']
+    options['knee_efficiency'] = args['knee_efficiency']
+    options['knee_latency'] = args['knee_latency']
+    options['backend'] = args['backend']
+    options['simulation_file'] = args['simulation']
+    options['stub_latency'] = args['stub_latency']
+    options['quiet'] = args['quiet']
+    options['max_retries'] = args['max_retries']
+    options['retry_initial'] = args['retry_initial']
+    options['retry_max'] = args['retry_max']
+    options['adaptive'] = args['adaptive']
+    options['adaptive_initial'] = args['adaptive_initial']
+    options['adaptive_latency'] = args['adaptive_latency']
+    options['processes'] = args['processes']
+    options['workers'] = args['workers']
+    options['max_cost'] = args['max_cost']
+    options['preflight'] = args['preflight']
+    options['preflight_cache'] = args['preflight_cache']
+    options['shards'] = args['shards'] or args['projects']
+    options['live'] = args['live']
+    options['live_interval'] = args['live_interval']
+    options['live_window'] = args['live_window']
+    options['metrics_log'] = args['metrics_log']
+    options['metrics_port'] = args['metrics_port']
+    options['replay_file'] = args.get('replay', None)
+    options['replay_sample'] = args['replay_sample']
+    options['replay_users'] = args['replay_users']
+    options['replay_limit'] = args['replay_limit']
+    options['replay_statements'] = args['replay_statements']
+
+    return options
+
+if __name__ == '__main__':
+    # Disable the super annoying warnings that are unnecessarily generated when
+    # using user credentials rather than a service account.
+    # Reference: https://github.com/GoogleCloudPlatform/google-auth-library-python/issues/271
+
+    warnings.filterwarnings("ignore", "Your application has authenticated using end user credentials")
+
+    parser = build_parser()
+    args = parser.parse_args().__dict__
+    options = build_options(args)
+
+    if options['resume'] and not options['raw_output']:
+        parser.error('--resume requires --raw-output')
+
+    if options['simulation_file'] and options['backend'] != 'simulated':
+        parser.error('--simulation requires --backend=simulated')
+
+    if options['warmup'] or options['cooldown']:
+        if not options['duration']:
+            parser.error('--warmup and --cooldown require --duration')
+
+        if options['warmup'] + options['cooldown'] >= options['duration']:
+            parser.error('--warmup and --cooldown must be shorter than --duration')
+
+    if options['adaptive'] and options['load'] != 'closed':
+        parser.error('--adaptive applies to closed-loop scenarios only')
+
+    if options['workers'] and not os.environ.get(SECRET_ENV):
+        parser.error('--workers requires the shared secret of the workers in {}'
+                     .format(SECRET_ENV))
+
+    if ((options['live'] or options['metrics_log'] or options['metrics_port'])
+            and (options['processes'] or options['workers'])):
+        parser.error('Live metrics are only available without --processes or --workers')
+
+    if options['load'] == 'replay':
+        if options['processes'] or options['workers']:
+            parser.error('--replay runs in a single process')
+
+        if options['warmup'] or options['cooldown']:
+            parser.error('--warmup and --cooldown do not apply to --replay')
+
+        if not 0 < options['replay_sample'] <= 1:
+            parser.error('--replay-sample must be between 0 and 1')
 
     if args.get('query_file', None):
        queries = QuerySet.from_file(query_file=args['query_file'],
@@ -100,21 +603,49 @@ if __name__ == '__main__':
                           queries=QUERIES,
                           options=options)
 
+    # Shards of the command line take precedence over those of the query file
+    if not options['shards'] and queries.shards:
+        try:
+            parse_shards(queries.shards)
+        except ValueError as e:
+            parser.error('Invalid shards in {}: {}'.format(args['query_file'], e))
+
+        options['shards'] = queries.shards
+
     for query in queries:
         print(query)
 
-    # Configure the experiment depending on whether the '--threads' or
-    # '--scenarios' option is specified. The former is simply configured as an
-    # Experiment with a single Scenario.
+    # Configure the experiment depending on whether the '--threads',
+    # '--scenarios', '--rate' or '--replay' option is specified. The first is
+    # simply configured as an Experiment with a single Scenario.
     if args.get('scenarios', None):
+        scenario_plan = args['scenarios']
+    elif args.get('rate', None):
+        scenario_plan = args['rate']
+    elif args.get('replay', None):
+        scenario_plan = args['replay_speed']
+    else:
+        scenario_plan = str(args['threads'])
+
+    # Malformed scenario plans are reported as usage errors
+    try:
+        parse_plan(scenario_plan, options)
+    except ValueError as e:
+        parser.error('Invalid scenario plan: {}'.format(e))
+
+    # Open-loop scenarios and replays run for a duration rather than a number
+    # of samples
+    if options['load'] == 'closed':
         experiment = Experiment(queries=queries,
                                 options=options,
                                 samples=args['samples'],
-                                scenario_plan=args['scenarios'])
+                                scenario_plan=scenario_plan)
     else:
         experiment = Experiment(queries=queries,
                                 options=options,
-                                samples=args['samples'],
-                                scenario_plan=str(args['threads']))
+                                scenario_plan=scenario_plan)
 
-    results = experiment.run(output_file=args['output_file'])
+    try:
+        results = experiment.run(output_file=args['output_file'])
+    except BudgetExceeded as e:
+        parser.exit(1, '- Aborted: {}\n'.format(e))
@@ -0,0 +1,233 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Compare the raw samples (--raw-output) of two or more runs of the same
+experiment, i.e. before and after a reservation change.
+
+The first run is the baseline. For every scenario (matched by label, i.e.
+'50 concurrent threads'), query and statistic, the bootstrap confidence
+interval (see Bootstrap.py) of the statistic is computed for every run, and
+so is the interval of its difference from the baseline, from independent
+resamples of both runs. A change is significant when the interval of the
+difference excludes zero, and flagged when it is also larger than
+--threshold (relative): a regression if the statistic got worse, an
+improvement otherwise. Higher values are worse, except for the rates of
+series ending in _per_second.
+
+The exit code is 1 if any regression was flagged, so that the comparison can
+gate automated runs.
+
+Usage: python compare.py baseline.jsonl candidate.jsonl [...] """
+
+import sys
+import csv
+import argparse
+from Bootstrap import Bootstrap, STATISTICS
+from SampleSink import completed_scenarios, rebuild_results
+
+def load_run(path, series_name):
+    """ Return {(scenario label, query name): Histogram} of the completed
+    scenarios of a raw output """
+
+    completed = completed_scenarios(path)
+    results = rebuild_results(path, completed)
+
+    histograms = {}
+    for index in sorted(completed):
+        label = completed[index][1]['label']
+        for query_name, result in results[index].items():
+            histogram = result.series(series_name)
+            if histogram is not None and histogram.count:
+                histograms[(label, query_name)] = histogram
+
+    return histograms
+
+def compare(baseline, candidate, bootstrap, statistics, threshold,
+            higher_is_better=False):
+    """ Return one comparison dict per (scenario, query, statistic) present
+    in both runs """
+
+    comparisons = []
+    for key, baseline_histogram in baseline.items():
+        if key not in candidate:
+            continue
+
+        candidate_histogram = candidate[key]
+
+        # A single sample has no spread to resample
+        if baseline_histogram.count < 2 or candidate_histogram.count < 2:
+            continue
+
+        estimates = (bootstrap.estimate(baseline_histogram, statistics),
+                     bootstrap.estimate(candidate_histogram, statistics))
+        distributions = (bootstrap.distributions(baseline_histogram, statistics),
+                         bootstrap.distributions(candidate_histogram, statistics))
+
+        for name in statistics:
+            before, after = estimates[0][name], estimates[1][name]
+            low, high = bootstrap.interval(distributions[1][name]
+                                           - distributions[0][name])
+
+            change = (after - before) / abs(before) if before else 0.0
+            verdict = ''
+            if (low > 0 or high < 0) and abs(change) > threshold:
+                worse = (change < 0) if higher_is_better else (change > 0)
+                verdict = 'regression' if worse else 'improvement'
+
+            comparisons.append({'scenario': key[0],
+                                'query': key[1],
+                                'statistic': name,
+                                'baseline': before,
+                                'baseline_interval': bootstrap.interval(distributions[0][name]),
+                                'baseline_samples': baseline_histogram.count,
+                                'candidate': after,
+                                'candidate_interval': bootstrap.interval(distributions[1][name]),
+                                'candidate_samples': candidate_histogram.count,
+                                'change': change,
+                                'difference_interval': (low, high),
+                                'verdict': verdict})
+
+    return comparisons
+
+def statistics_list(value):
+    names = [name.strip() for name in value.split(',')]
+    for name in names:
+        if name not in STATISTICS:
+            raise argparse.ArgumentTypeError(
+                'Unknown statistic {} (one of {})'.format(name, ', '.join(STATISTICS)))
+
+    return names
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Compare the raw samples of runs '
+                                                  'of an experiment with bootstrap '
+                                                  'confidence intervals'))
+    parser.add_argument(
+        'runs',
+        nargs='+',
+        help='Raw outputs (--raw-output) of the runs, the baseline first')
+
+    parser.add_argument(
+        '--series',
+        type=str,
+        default='response_time',
+        help='Series to compare')
+
+    parser.add_argument(
+        '--stats',
+        type=statistics_list,
+        default=['mean', 'median', '95th_percentile'],
+        help='Comma separated statistics to compare (one of {})'.format(
+            ', '.join(STATISTICS)))
+
+    parser.add_argument(
+        '--resamples',
+        type=int,
+        default=10000,
+        help='Bootstrap resamples')
+
+    parser.add_argument(
+        '--confidence',
+        type=float,
+        default=0.95,
+        help='Confidence level of the intervals')
+
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.05,
+        help=('Relative change below which a significant difference is not '
+              'flagged'))
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='Random seed of the resampling')
+
+    parser.add_argument(
+        '--output',
+        '-O',
+        type=str,
+        default=None,
+        help='CSV file to write every comparison to')
+
+    settings = parser.parse_args()
+
+    if len(settings.runs) < 2:
+        parser.error('At least two runs are needed')
+
+    bootstrap = Bootstrap(resamples=settings.resamples,
+                          confidence=settings.confidence,
+                          seed=settings.seed)
+    higher_is_better = settings.series.endswith('_per_second')
+
+    baseline = load_run(settings.runs[0], settings.series)
+    print('- Baseline: {} ({} scenario/query pairs)'.format(settings.runs[0],
+                                                            len(baseline)))
+
+    rows = []
+    regressions = 0
+    for path in settings.runs[1:]:
+        candidate = load_run(path, settings.series)
+        print('- Candidate: {} ({} scenario/query pairs)'.format(path, len(candidate)))
+
+        missing = sorted(set(baseline) ^ set(candidate))
+        for label, query_name in missing:
+            print('-- Only in one run: scenario "{}", query "{}"'.format(label,
+                                                                       query_name))
+
+        for comparison in compare(baseline, candidate, bootstrap, settings.stats,
+                                  settings.threshold, higher_is_better):
+            print(('-- "{}", "{}", {}: {:0.4g} [{:0.4g}, {:0.4g}] -> '
+                   '{:0.4g} [{:0.4g}, {:0.4g}], {:+0.1%}{}')
+                  .format(comparison['scenario'],
+                          comparison['query'],
+                          comparison['statistic'],
+                          comparison['baseline'],
+                          *comparison['baseline_interval'],
+                          comparison['candidate'],
+                          *comparison['candidate_interval'],
+                          comparison['change'],
+                          ', ' + comparison['verdict'].upper()
+                          if comparison['verdict'] else ''))
+
+            regressions += comparison['verdict'] == 'regression'
+            rows.append((path, comparison))
+
+    if settings.output:
+        with open(settings.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['run', 'scenario', 'query', 'statistic',
+                             'baseline', 'baseline_low', 'baseline_high',
+                             'candidate', 'candidate_low', 'candidate_high',
+                             'change', 'difference_low', 'difference_high',
+                             'verdict'])
+            for path, comparison in rows:
+                writer.writerow([path,
+                                 comparison['scenario'],
+                                 comparison['query'],
+                                 comparison['statistic'],
+                                 comparison['baseline'],
+                                 *comparison['baseline_interval'],
+                                 comparison['candidate'],
+                                 *comparison['candidate_interval'],
+                                 comparison['change'],
+                                 *comparison['difference_interval'],
+                                 comparison['verdict']])
+
+    print('- {} regressions at {:0.0%} confidence'.format(regressions,
+                                                          settings.confidence))
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,123 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Report the concurrency BigQuery actually saw during every scenario of a
+run, from its raw samples (--raw-output), see Timeline.py.
+
+For every completed scenario: the effective concurrency (time-weighted mean
+of the queries in flight) and percentiles of the queries in flight, the jobs
+running and the slots in use over time, and the response times by the number
+of queries in flight when each sample was submitted. With --output, the time
+series of every scenario is written to a CSV file.
+
+Samples of distributed runs are timed by the clocks of their workers, so
+the timelines are only as consistent as those clocks.
+
+Usage: python concurrency.py raw.jsonl [-O timeline.csv] """
+
+import csv
+import argparse
+from Timeline import load_timelines
+
+PERCENTILES = (50, 95, 99, 100)
+
+def format_percentiles(values):
+    return ', '.join('p{} = {:,.1f}'.format(q, value) if q < 100
+                     else 'max = {:,.1f}'.format(value)
+                     for q, value in zip(PERCENTILES, values))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Reconstruct the concurrency and '
+                                                  'slot usage timeline of the '
+                                                  'scenarios of a run'))
+    parser.add_argument(
+        'run',
+        help='Raw output (--raw-output) of the run')
+
+    parser.add_argument(
+        '--resolution',
+        type=float,
+        default=1.0,
+        help='Seconds per row of the time series')
+
+    parser.add_argument(
+        '--bands',
+        type=int,
+        default=10,
+        help='Concurrency bands of the response times')
+
+    parser.add_argument(
+        '--slots',
+        type=float,
+        default=None,
+        help='Slots available to the run, to report the slot utilization')
+
+    parser.add_argument(
+        '--output',
+        '-O',
+        type=str,
+        default=None,
+        help='CSV file to write the time series of every scenario to')
+
+    settings = parser.parse_args()
+
+    timelines = load_timelines(settings.run)
+    print('- Run: {} ({} scenarios)'.format(settings.run, len(timelines)))
+
+    writer = None
+    output_file = None
+    if settings.output:
+        output_file = open(settings.output, 'w', newline='')
+        writer = csv.writer(output_file)
+        writer.writerow(['scenario', 'label', 'time', 'in_flight', 'running',
+                         'slots', 'completions_per_second'])
+
+    try:
+        for index, (label, timeline) in timelines.items():
+            print('-- Scenario = {}: {:,} samples over {:0.1f}s'.format(label,
+                                                                       len(timeline),
+                                                                       timeline.span))
+
+            print('--- Effective concurrency = {:0.2f}'.format(timeline.effective_concurrency()))
+            print('--- Queries in flight: {}'.format(format_percentiles(
+                timeline.percentiles(timeline.in_flight(), PERCENTILES))))
+            print('--- Jobs running: {}'.format(format_percentiles(
+                timeline.percentiles(timeline.running(), PERCENTILES))))
+
+            slots = timeline.percentiles(timeline.slots(), PERCENTILES)
+            line = '--- Slots in use: {}'.format(format_percentiles(slots))
+            if settings.slots:
+                line += ' (utilization p50 = {:0.1%}, p95 = {:0.1%})'.format(
+                    slots[0] / settings.slots,
+                    slots[1] / settings.slots)
+            print(line)
+
+            for low, high, samples, mean, p95 in timeline.latency_by_concurrency(settings.bands):
+                print('--- In flight {}: samples = {:,}, mean = {:0.2f}s, p95 = {:0.2f}s'
+                      .format(low if low == high else '{}..{}'.format(low, high),
+                              samples,
+                              mean,
+                              p95))
+
+            if writer is not None:
+                series = timeline.series(settings.resolution)
+                for row in zip(series['time'],
+                               series['in_flight'],
+                               series['running'],
+                               series['slots'],
+                               series['completions_per_second']):
+                    writer.writerow([index, label, *row])
+    finally:
+        if output_file is not None:
+            output_file.close()
@@ -12,30 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import numpy as np
-
-def std_trim(data,
-             m=3):
-    """ Trim outliers using mean/std deviation method """
-    return data[abs(data - np.mean(data)) < m * np.std(data)]
-
-def median_trim(data,
-                m =3.):
-    """ Trim outliers using scaled median distance method """
-    distance = np.abs(data - np.median(data))
-    mdev = np.median(distance)
-    scaled = distance/(mdev if mdev else 1.)
-    return data[scaled<m]
+""" Statistics reported for every series. Each function is evaluated over a
+Histogram summarising the series, so that every percentile and trim is computed
+from the same streaming summary (see Histogram.py for the error bounds) """
 
 stats_cfg = {
-    "mean": lambda x: np.average(x),
-    "std_dev": lambda x: np.std(x),
-    "min": lambda x: np.min(x),
-    "min_median_trim": lambda x: np.min(median_trim(np.array(x))),
-    "min_std_trim": lambda x: np.min(std_trim(np.array(x))),
-    "max": lambda x: np.max(x),
-    "max_median_trim": lambda x: np.max(median_trim(np.array(x))),
-    "max_std_trim": lambda x: np.max(std_trim(np.array(x))),
-    "95th_percentile": lambda x: np.percentile(x, 95),
-    "5th_percentile": lambda x: np.percentile(x, 5)
+    "mean": lambda x: x.mean(),
+    "std_dev": lambda x: x.std(),
+    "min": lambda x: x.min(),
+    "min_median_trim": lambda x: x.median_trim(m=3.)[0],
+    "min_std_trim": lambda x: x.std_trim(m=3)[0],
+    "max": lambda x: x.max(),
+    "max_median_trim": lambda x: x.median_trim(m=3.)[1],
+    "max_std_trim": lambda x: x.std_trim(m=3)[1],
+    "95th_percentile": lambda x: x.percentile(95),
+    "5th_percentile": lambda x: x.percentile(5)
 }
@@ -0,0 +1,56 @@
+# Copyright 2018 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Percentiles of Histogram and Bootstrap against np.percentile()
+
+Usage: python -m pytest test_Histogram.py """
+
+import numpy as np
+from Histogram import Histogram, RELATIVE_ACCURACY
+from Bootstrap import STATISTICS
+
+PERCENTILES = (0, 5, 25, 50, 75, 95, 99, 100)
+
+def histogram(values):
+    result = Histogram()
+    for value in values:
+        result.record(value)
+
+    return result
+
+def check_percentiles(values):
+    summary = histogram(values)
+    for q in PERCENTILES:
+        expected = np.percentile(values, q)
+        assert abs(summary.percentile(q) - expected) <= RELATIVE_ACCURACY * abs(expected) + 1e-12, q
+
+def test_small_samples():
+    check_percentiles([1, 2, 10])
+    check_percentiles([0.45, 0.5, 0.7, 0.76])
+    check_percentiles([3.2])
+    check_percentiles([0.5, 0.5, 0.9])
+
+def test_large_samples():
+    random_state = np.random.RandomState(0)
+    check_percentiles(random_state.lognormal(mean=0.0, sigma=1.0, size=100000))
+    check_percentiles(random_state.uniform(0.1, 5.0, size=10001))
+
+def test_bootstrap_percentiles():
+    random_state = np.random.RandomState(1)
+    for values in ([1, 2, 10], random_state.exponential(2.0, size=5000)):
+        buckets, counts = histogram(values).buckets()
+        for name, q in (('5th_percentile', 5), ('median', 50), ('95th_percentile', 95)):
+            estimate = STATISTICS[name](buckets, counts[None, :])[0]
+            expected = np.percentile(values, q)
+            assert abs(estimate - expected) <= 2 * RELATIVE_ACCURACY * expected, name